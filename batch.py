@@ -0,0 +1,153 @@
+import re
+import asyncio
+from urllib.parse import urlsplit
+from typing import List, Optional, Tuple
+
+# "Filename : URL", the URL may itself contain colons
+LINK_LINE_RE = re.compile(r"^(?P<filename>.+?)\s*:\s*(?P<url>(?:https?|ftp)://\S+)\s*$", re.IGNORECASE)
+
+# Extensions that mark a "url*key" link as an encrypted video
+ENCRYPTED_EXTENSIONS = [".mkv", ".mp4", ".avi", ".mov", ".wmv", ".flv", ".webm"]
+
+
+def parse_link_line(line: str) -> Optional[Tuple[str, str]]:
+    """Parse a single `Filename : URL` line, returns None if it is not one"""
+    line = line.strip()
+    match = LINK_LINE_RE.match(line)
+    if match:
+        return match.group("filename").strip(), match.group("url").strip()
+
+    # A URL with spaces in it misses the pattern, it is still a link if it parses as http(s)
+    if ":" not in line:
+        return None
+    filename, url = [x.strip() for x in line.split(":", 1)]
+    if not filename or not url or not is_http_url(url):
+        return None
+    return filename, url
+
+
+def is_http_url(url: str) -> bool:
+    try:
+        parts = urlsplit(url)
+    except ValueError:
+        return False
+    return parts.scheme.lower() in ("http", "https") and bool(parts.netloc)
+
+
+def parse_links(text: str) -> Tuple[List[Tuple[str, str]], List[str]]:
+    """Parse every `Filename : URL` line of a message or .txt file
+
+    Returns the parsed (filename, url) pairs and the lines that could not be parsed.
+    """
+    links, invalid = [], []
+    for line in text.splitlines():
+        if not line.strip():
+            continue
+        parsed = parse_link_line(line)
+        if parsed:
+            links.append(parsed)
+        else:
+            invalid.append(line.strip())
+    return links, invalid
+
+
+def is_encrypted_url(url: str) -> bool:
+    """Check if it's an encrypted video URL"""
+    return "*" in url and any(ext in url.lower() for ext in ENCRYPTED_EXTENSIONS)
+
+
+class BatchItem:
+    """One link of a batch and its progress"""
+    def __init__(self, index: int, filename: str, url: str):
+        self.index = index
+        self.filename = filename
+        self.url = url
+        self.is_encrypted = is_encrypted_url(url)
+        self.download_id = None
+        self.state = "queued"  # queued, downloading, waiting, uploading, done, failed
+        self.downloaded = 0
+        self.total = 0
+        self.uploaded = 0
+        self.upload_total = 0
+        self.error = None
+        self.planned_size = 0  # Expected size of the format picked for it
+        self.finished = asyncio.Event()
+
+    @property
+    def fraction(self) -> float:
+        """Completion of this item between 0 and 1, download and upload weigh half each"""
+        if self.state in ("done", "failed"):
+            return 1.0
+        if self.state in ("waiting", "uploading"):
+            if not self.upload_total:
+                return 0.5
+            return 0.5 + 0.5 * min(self.uploaded / self.upload_total, 1.0)
+        if not self.total:
+            return 0.0
+        return 0.5 * min(self.downloaded / self.total, 1.0)
+
+
+class Batch:
+    """Links submitted together, downloaded in parallel and uploaded in order"""
+    def __init__(
+        self,
+        user_id: int,
+        name: str,
+        links: List[Tuple[str, str]],
+        skipped: int = 0,
+        max_size: int = 0,  # Bytes the formats of all items may add up to, 0 for no limit
+    ):
+        self.user_id = user_id
+        self.name = name
+        self.skipped = skipped
+        self.max_size = max_size
+        self.items = [BatchItem(i, filename, url) for i, (filename, url) in enumerate(links)]
+        self.canceled = False
+
+    def __len__(self):
+        return len(self.items)
+
+    async def wait_turn(self, item: BatchItem):
+        """Wait until every earlier item has been uploaded (or has failed)"""
+        if item.index > 0:
+            await self.items[item.index - 1].finished.wait()
+
+    def finish(self, item: BatchItem, state: str, error: Optional[str] = None):
+        """Mark an item done or failed and let the next item upload"""
+        item.state = state
+        item.error = error
+        item.finished.set()
+
+    def cancel(self):
+        """Stop the batch, items that haven't started are failed right away"""
+        self.canceled = True
+        for item in self.items:
+            if item.state == "queued":
+                self.finish(item, "failed", "Canceled")
+
+    def size_cap(self) -> int:
+        """Share of what's left of max_size for each item that hasn't picked a format yet"""
+        if not self.max_size:
+            return 0
+        planned = sum(item.planned_size for item in self.items)
+        unplanned = sum(1 for item in self.items if not item.planned_size)
+        # Once the budget is spent every item gets the smallest format
+        return max(self.max_size - planned, 1) // max(unplanned, 1) or 1
+
+    def count(self, *states: str) -> int:
+        return sum(1 for item in self.items if item.state in states)
+
+    @property
+    def progress(self) -> float:
+        """Overall completion in percent"""
+        if not self.items:
+            return 100.0
+        return 100.0 * sum(item.fraction for item in self.items) / len(self.items)
+
+    @property
+    def is_finished(self) -> bool:
+        return all(item.finished.is_set() for item in self.items)
+
+    @property
+    def uploading(self) -> Optional[BatchItem]:
+        return next((item for item in self.items if item.state == "uploading"), None)
@@ -0,0 +1,414 @@
+"""Benchmark whole jobs, from the link message to the uploaded file, at several user counts.
+
+A local HTTP server serves an MP4 clip rendered by ffmpeg four ways: as a plain download, as a
+range-capable download, as HLS fragments and AES-encrypted behind a `*key`
+link. Every simulated user sends links to `handle_messages` one after another,
+cycling through the variants. Telegram is replaced by fake messages that count
+`reply_text`/`edit_text`/`reply_video` calls and read the uploaded file instead
+of sending it, and the database by an in-memory stand-in. The bot's own
+scheduler runs the jobs, so at high user counts WORKERS caps how many run at
+once and the latency includes the queue wait.
+
+Each user count runs in a fresh child process, so peak RSS and open file
+descriptors are not carried over between runs. Needs the bot's environment
+variables (API_ID etc.) like the bot itself, but no network access. Without
+ffmpeg the file is an MP4 layout around random bytes, and the probe, thumbnail
+and remux stages are skipped, as they can't run on it.
+
+Usage: python benchmarks/bench_pipeline.py [size_mib] [jobs_per_user] [user_counts] [upload_mib_s]
+"""
+import os
+import re
+import sys
+import json
+import time
+import asyncio
+import logging
+import shutil
+import resource
+import tempfile
+import threading
+import subprocess
+from types import SimpleNamespace
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+
+from Crypto.Cipher import AES
+from Crypto.Util.Padding import pad
+from decryptor import derive_key_iv
+
+KEY = "benchmark-key-123"
+HLS_SEGMENTS = 8
+VARIANTS = ["plain", "range", "hls", "encrypted"]
+LEVEL_TIMEOUT = 900
+SAMPLE_INTERVAL = 0.05
+# Length of the rendered clip, its bitrate is set to reach the requested size
+CLIP_SECONDS = 10
+
+
+def box(kind, payload):
+    return (8 + len(payload)).to_bytes(4, "big") + kind + payload
+
+
+def have_ffmpeg():
+    return shutil.which("ffmpeg") is not None and shutil.which("ffprobe") is not None
+
+
+def render_video(size_mib):
+    """A test pattern clip with a tone, noise keeps the encoder at the bitrate that gives the size"""
+    bitrate = size_mib * 1024 * 1024 * 8 // CLIP_SECONDS
+    with tempfile.TemporaryDirectory(prefix="bench_pipeline_") as folder:
+        path = os.path.join(folder, "clip.mp4")
+        subprocess.run(
+            [
+                "ffmpeg", "-v", "error",
+                "-f", "lavfi", "-i", f"testsrc=duration={CLIP_SECONDS}:size=1280x720:rate=30",
+                "-f", "lavfi", "-i", f"sine=frequency=440:duration={CLIP_SECONDS}",
+                "-vf", "noise=alls=40:allf=t",
+                # mpeg4 is in every ffmpeg build and MP4 carries it without remuxing
+                "-c:v", "mpeg4", "-b:v", str(bitrate), "-minrate", str(bitrate), "-maxrate", str(bitrate),
+                "-bufsize", str(bitrate), "-c:a", "aac", "-b:a", "128k",
+                "-movflags", "+faststart", "-y", path,
+            ],
+            check=True,
+        )
+        with open(path, "rb") as f:
+            return f.read()
+
+
+def make_video(size_mib):
+    """A real clip from ffmpeg, or an MP4 layout (ftyp, moov up front, mdat) around random data without it"""
+    if have_ffmpeg():
+        return render_video(size_mib)
+    header = box(b"ftyp", b"isom\0\0\2\0isomiso2mp41") + box(b"moov", box(b"mvhd", bytes(100)))
+    body = os.urandom(size_mib * 1024 * 1024 - len(header) - 8)
+    return header + box(b"mdat", body)
+
+
+def encrypt(data):
+    key_16, iv = derive_key_iv(KEY)
+    return AES.new(key_16, AES.MODE_CBC, iv).encrypt(pad(data, AES.block_size))
+
+
+def make_handler(video, encrypted):
+    segment_size = -(-len(video) // HLS_SEGMENTS)
+    playlist = "#EXTM3U\n#EXT-X-VERSION:3\n#EXT-X-TARGETDURATION:4\n#EXT-X-MEDIA-SEQUENCE:0\n"
+    playlist += "".join(f"#EXTINF:4.0,\nseg{i}.ts\n" for i in range(HLS_SEGMENTS)) + "#EXT-X-ENDLIST\n"
+    playlist = playlist.encode()
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def handle(self):
+            try:
+                super().handle()
+            except ConnectionError:
+                # Probes hang up as soon as they have the headers
+                pass
+
+        def _resolve(self):
+            """Return (body, content type, ranges allowed) for the path"""
+            path = self.path.split("?")[0]
+            if path.startswith("/plain/"):
+                return video, "video/mp4", False
+            if path.startswith("/range/"):
+                return video, "video/mp4", True
+            if path.startswith("/enc/"):
+                return encrypted, "video/mp4", False
+            if path.startswith("/hls/"):
+                if path.endswith(".m3u8"):
+                    return playlist, "application/vnd.apple.mpegurl", False
+                match = re.search(r"seg(\d+)\.ts$", path)
+                if match:
+                    start = int(match.group(1)) * segment_size
+                    return video[start:start + segment_size], "video/mp2t", False
+            return None, None, False
+
+        def _send(self, head_only):
+            body, content_type, ranges = self._resolve()
+            if body is None:
+                self.send_error(404)
+                return
+            start, end = 0, len(body) - 1
+            match = re.match(r"bytes=(\d+)-(\d*)", self.headers.get("Range", ""))
+            if ranges and match:
+                start = int(match.group(1))
+                end = min(int(match.group(2) or end), end)
+                self.send_response(206)
+                self.send_header("Content-Range", f"bytes {start}-{end}/{len(body)}")
+            else:
+                self.send_response(200)
+            if ranges:
+                self.send_header("Accept-Ranges", "bytes")
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(end - start + 1))
+            self.end_headers()
+            if not head_only:
+                self.wfile.write(memoryview(body)[start:end + 1])
+
+        def do_HEAD(self):
+            self._send(True)
+
+        def do_GET(self):
+            self._send(False)
+
+    return Handler
+
+
+class FakeDatabase:
+    """In-memory stand-in for the parts of Database a job touches"""
+    def __init__(self):
+        self.next_id = 0
+
+    async def add_download(self, user_id, filename, url, **fields):
+        self.next_id += 1
+        return SimpleNamespace(inserted_id=self.next_id)
+
+    async def get_cached_media(self, key):
+        # Every job downloads, nothing is served from the upload cache
+        return None
+
+    async def _ok(self, *args, **kwargs):
+        return True
+
+    cache_media = update_download_status = start_download_attempt = update_download_progress = _ok
+
+
+class Recorder:
+    """Telegram calls made by all fake messages of a run"""
+    def __init__(self, upload_rate):
+        # Simulated upload speed per file in MiB/s, 0 only reads the file
+        self.upload_rate = upload_rate
+        self.calls = {}
+        self.uploaded_bytes = 0
+        self.next_id = 0
+
+    def call(self, name):
+        self.calls[name] = self.calls.get(name, 0) + 1
+
+
+class FakeMessage:
+    """The parts of pyrogram's Message the bot uses, recording instead of sending"""
+    def __init__(self, recorder, user_id, text=None, job=None):
+        recorder.next_id += 1
+        self.recorder = recorder
+        self.id = recorder.next_id
+        self.chat = SimpleNamespace(id=user_id)
+        self.from_user = SimpleNamespace(id=user_id)
+        self.text = text
+        self.empty = False
+        self.video = None
+        self.document = None
+        # Set once the job this message belongs to has finished, with True on success
+        self.job = job or {"done": asyncio.Event(), "ok": False}
+
+    def _finish(self, ok):
+        self.job["ok"] = ok
+        self.job["done"].set()
+
+    async def reply_text(self, text, **kwargs):
+        self.recorder.call("reply_text")
+        if "uploaded successfully" in text:
+            self._finish(True)
+        return FakeMessage(self.recorder, self.chat.id, text, self.job)
+
+    async def edit_text(self, text, **kwargs):
+        self.recorder.call("edit_text")
+        self.text = text
+        if text.startswith("❌"):
+            self._finish(False)
+        return self
+
+    async def delete(self):
+        self.recorder.call("delete")
+
+    async def _upload(self, kind, path, progress=None, **kwargs):
+        self.recorder.call(f"reply_{kind}")
+        size = os.path.getsize(path)
+
+        def read():
+            with open(path, "rb") as f:
+                while f.read(1024 * 1024):
+                    pass
+
+        started = time.perf_counter()
+        await asyncio.to_thread(read)
+        if self.recorder.upload_rate:
+            transfer = size / (self.recorder.upload_rate * 1024 * 1024)
+            await asyncio.sleep(max(0.0, transfer - (time.perf_counter() - started)))
+        if progress:
+            await progress(size, size)
+        self.recorder.uploaded_bytes += size
+
+        sent = FakeMessage(self.recorder, self.chat.id, job=self.job)
+        media = SimpleNamespace(
+            file_id=f"file{sent.id}", file_name=os.path.basename(path), file_size=size,
+            width=kwargs.get("width", 0), height=kwargs.get("height", 0), duration=kwargs.get("duration", 0),
+        )
+        setattr(sent, kind, media)
+        return sent
+
+    async def reply_video(self, path, **kwargs):
+        return await self._upload("video", path, **kwargs)
+
+    async def reply_document(self, path, **kwargs):
+        return await self._upload("document", path, **kwargs)
+
+
+async def skip_metadata(self, video_path):
+    pass
+
+
+def sample(peaks):
+    """Record current RSS and open descriptors, Linux only"""
+    try:
+        with open("/proc/self/status") as f:
+            rss = next(int(line.split()[1]) for line in f if line.startswith("VmRSS:"))
+        peaks["rss_kib"] = max(peaks.get("rss_kib", 0), rss)
+        peaks["fds"] = max(peaks.get("fds", 0), len(os.listdir("/proc/self/fd")))
+    except (OSError, StopIteration):
+        pass
+
+
+async def run_level(users, base_url, jobs_per_user, upload_rate):
+    """Run every user's jobs through the bot and return the measurements"""
+    import bot
+    from metrics import metrics
+
+    bot.db = FakeDatabase()
+    bot.STREAM_UPLOADS = False
+    if not have_ffmpeg():
+        # ffprobe, the frame grab and ffmpeg would only fail on the random bytes
+        bot.REMUX_VIDEOS = False
+        bot.Downloader.extract_video_metadata = skip_metadata
+    recorder = Recorder(upload_rate)
+    latencies, failures = [], 0
+    by_variant = {variant: [] for variant in VARIANTS}
+
+    async def user(user_id):
+        nonlocal failures
+        bot.AUTH_USERS.append(user_id)
+        bot.USER_STATES[user_id] = {
+            "state": "waiting_file_url", "username": "@bench", "batch_name": "bench", "canceled": False,
+        }
+        for job in range(jobs_per_user):
+            variant = VARIANTS[(user_id + job) % len(VARIANTS)]
+            path = {
+                "plain": f"plain/{user_id}-{job}.mp4",
+                "range": f"range/{user_id}-{job}.mp4",
+                "hls": f"hls/{user_id}-{job}/index.m3u8",
+                "encrypted": f"enc/{user_id}-{job}.mp4*{KEY}",
+            }[variant]
+            message = FakeMessage(recorder, user_id, f"bench {user_id}-{job} : {base_url}/{path}")
+            started = time.perf_counter()
+            await bot.handle_messages(None, message)
+            await message.job["done"].wait()
+            elapsed = time.perf_counter() - started
+            latencies.append(elapsed)
+            by_variant[variant].append(elapsed)
+            failures += not message.job["ok"]
+
+    peaks = {}
+
+    async def sampler():
+        while True:
+            sample(peaks)
+            await asyncio.sleep(SAMPLE_INTERVAL)
+
+    sampling = asyncio.create_task(sampler())
+    started = time.perf_counter()
+    await asyncio.wait_for(asyncio.gather(*(user(1000 + i) for i in range(users))), LEVEL_TIMEOUT)
+    elapsed = time.perf_counter() - started
+    sampling.cancel()
+
+    await bot.scheduler.stop()
+    await bot.progress_renderer.stop()
+    latencies.sort()
+    stages = {
+        dict(labels)["stage"]: histogram.sum / histogram.count
+        for (name, labels), histogram in metrics.histograms.items()
+        if name == "stage_seconds" and histogram.count
+    }
+    return {
+        "users": users,
+        "jobs": len(latencies),
+        "failures": failures,
+        "seconds": elapsed,
+        "mib_s": recorder.uploaded_bytes / 1024 / 1024 / elapsed,
+        "p50": latencies[len(latencies) // 2],
+        "p99": latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))],
+        "variants": {v: sorted(t)[len(t) // 2] for v, t in by_variant.items() if t},
+        "stages": stages,
+        "peak_rss_mib": max(peaks.get("rss_kib", 0), resource.getrusage(resource.RUSAGE_SELF).ru_maxrss) / 1024,
+        "peak_fds": peaks.get("fds", 0),
+        "calls": recorder.calls,
+    }
+
+
+def child(users, base_url, jobs_per_user, upload_rate):
+    # Downloads land in a scratch folder, not the checkout
+    os.chdir(tempfile.mkdtemp(prefix="bench_pipeline_"))
+    import downloader  # Sets up the URLUploader logger
+    logging.getLogger("URLUploader").setLevel(logging.ERROR)
+    logging.getLogger("bot").setLevel(logging.ERROR)
+    result = asyncio.run(run_level(users, base_url, jobs_per_user, upload_rate))
+    # yt-dlp prints to stdout as well, the result goes last
+    print(json.dumps(result), flush=True)
+    os._exit(0)
+
+
+def main():
+    if len(sys.argv) == 6 and sys.argv[1] == "--child":
+        child(int(sys.argv[2]), sys.argv[3], int(sys.argv[4]), float(sys.argv[5]))
+        return
+
+    size_mib = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    jobs_per_user = int(sys.argv[2]) if len(sys.argv) > 2 else 2
+    user_counts = [int(n) for n in sys.argv[3].split(",")] if len(sys.argv) > 3 else [1, 10, 50]
+    upload_rate = float(sys.argv[4]) if len(sys.argv) > 4 else 0.0
+
+    if not have_ffmpeg():
+        print("Warning: ffmpeg not found, serving random bytes and skipping the probe, thumbnail and remux stages")
+    video = make_video(size_mib)
+    handler = make_handler(video, encrypt(video))
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_address[1]}"
+
+    print(f"File: {len(video) / 1024 / 1024:.1f} MiB, {jobs_per_user} jobs per user, variants: {', '.join(VARIANTS)}, "
+          f"upload: {f'{upload_rate} MiB/s' if upload_rate else 'read only'}")
+    print(f"{'users':>6}{'jobs':>6}{'fail':>6}{'MiB/s':>8}{'p50 s':>8}{'p99 s':>8}"
+          f"{'RSS MiB':>9}{'fds':>6}{'edits':>7}{'replies':>9}{'uploads':>9}")
+    for users in user_counts:
+        proc = subprocess.run(
+            [
+                sys.executable, os.path.abspath(__file__), "--child",
+                str(users), base_url, str(jobs_per_user), str(upload_rate),
+            ],
+            capture_output=True, text=True, cwd=REPO,
+        )
+        lines = proc.stdout.strip().splitlines()
+        if proc.returncode != 0 or not lines:
+            print(f"{users:>6} failed:\n{proc.stderr[-2000:]}")
+            continue
+        r = json.loads(lines[-1])
+        calls = r["calls"]
+        print(
+            f"{r['users']:>6}{r['jobs']:>6}{r['failures']:>6}{r['mib_s']:>8.1f}{r['p50']:>8.2f}{r['p99']:>8.2f}"
+            f"{r['peak_rss_mib']:>9.0f}{r['peak_fds']:>6}{calls.get('edit_text', 0):>7}"
+            f"{calls.get('reply_text', 0):>9}{calls.get('reply_video', 0) + calls.get('reply_document', 0):>9}"
+        )
+        print("       p50 by variant: " + ", ".join(f"{v} {t:.2f}s" for v, t in r["variants"].items()))
+        print("       mean per stage: " + ", ".join(f"{s} {t:.3f}s" for s, t in sorted(r["stages"].items())))
+
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+"""Benchmark the segmented range downloader against a single HTTP stream.
+
+Serves a generated file from a local range-capable HTTP server that caps the
+speed of every connection (like our CDN does), then downloads it with one
+plain streaming GET and with SegmentedDownloader at several connection counts.
+
+Usage: python benchmarks/bench_segmented.py [size_mib] [per_connection_mib_s]
+"""
+import os
+import asyncio
+import sys
+import time
+import hashlib
+import tempfile
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import requests
+from segmented import SegmentedDownloader
+from http_client import http_client
+
+CHUNK = 64 * 1024
+
+
+def make_handler(payload, rate):
+    class RangeHandler(BaseHTTPRequestHandler):
+        """Serves one file with Range support and a per-connection speed cap"""
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def _range(self):
+            header = self.headers.get("Range")
+            if not header or not header.startswith("bytes="):
+                return None
+            start, _, end = header[len("bytes="):].partition("-")
+            start = int(start)
+            end = int(end) if end else len(payload) - 1
+            return start, min(end, len(payload) - 1)
+
+        def do_HEAD(self):
+            self.send_response(200)
+            self.send_header("Accept-Ranges", "bytes")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+
+        def do_GET(self):
+            byte_range = self._range()
+            if byte_range:
+                start, end = byte_range
+                self.send_response(206)
+                self.send_header("Content-Range", f"bytes {start}-{end}/{len(payload)}")
+            else:
+                start, end = 0, len(payload) - 1
+                self.send_response(200)
+            self.send_header("Accept-Ranges", "bytes")
+            self.send_header("Content-Length", str(end - start + 1))
+            self.end_headers()
+
+            # Throttle this connection to `rate` bytes per second
+            began = time.perf_counter()
+            sent = 0
+            view = memoryview(payload)
+            for offset in range(start, end + 1, CHUNK):
+                block = view[offset:min(offset + CHUNK, end + 1)]
+                try:
+                    self.wfile.write(block)
+                except (BrokenPipeError, ConnectionResetError):
+                    return
+                sent += len(block)
+                ahead = sent / rate - (time.perf_counter() - began)
+                if ahead > 0:
+                    time.sleep(ahead)
+
+    return RangeHandler
+
+
+def single_stream(url, path):
+    with requests.get(url, stream=True) as response, open(path, "wb") as f:
+        for chunk in response.iter_content(chunk_size=256 * 1024):
+            f.write(chunk)
+
+
+def sha1_file(path):
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def main():
+    size_mib = int(sys.argv[1]) if len(sys.argv) > 1 else 64
+    rate_mib = float(sys.argv[2]) if len(sys.argv) > 2 else 8
+    payload = os.urandom(size_mib * 1024 * 1024)
+    expected = hashlib.sha1(payload).hexdigest()
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), make_handler(payload, rate_mib * 1024 * 1024))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}/video.mp4"
+
+    print(f"File: {size_mib} MiB, server cap: {rate_mib} MiB/s per connection")
+    print(f"{'mode':<22}{'time (s)':>10}{'MiB/s':>10}")
+    with tempfile.TemporaryDirectory() as tmp:
+        runs = [("single stream", lambda path: single_stream(url, path))]
+        for connections in (1, 4, 8, 16):
+            runs.append((
+                f"segmented x{connections}",
+                lambda path, n=connections: asyncio.run(SegmentedDownloader(url, path, connections=n).download()),
+            ))
+
+        for name, run in runs:
+            path = os.path.join(tmp, "out.mp4")
+            start = time.perf_counter()
+            run(path)
+            elapsed = time.perf_counter() - start
+            assert sha1_file(path) == expected, f"{name}: content mismatch"
+            print(f"{name:<22}{elapsed:>10.2f}{size_mib / elapsed:>10.1f}")
+            os.remove(path)
+
+    stats = http_client.stats()
+    print(f"Shared session: {stats['requests']} requests over {stats['connections']} connections "
+          f"({stats['reuse_rate']:.0%} reused)")
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
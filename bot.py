@@ -1,7 +1,12 @@
 import asyncio
 import os
 import time
-from pyrogram import Client, filters
+import uuid
+import threading
+from pyrogram import Client, filters, idle, StopTransmission
+from pyrogram.errors import (
+    FileIdInvalid, FileReferenceEmpty, FileReferenceExpired, FileReferenceInvalid, MediaEmpty, MediaInvalid
+)
 from pyrogram.types import (
     Message,
     InlineKeyboardMarkup,
@@ -9,16 +14,31 @@ from pyrogram.types import (
     ForceReply,
     CallbackQuery,
 )
-from config import API_ID, API_HASH, BOT_TOKEN, AUTH_USERS
-from database import db
-from downloader import Downloader
+from config import (
+    API_ID, API_HASH, BOT_TOKEN, OWNER_ID, AUTH_USERS, BATCH_PARALLEL, MAX_JOB_ATTEMPTS, STREAM_UPLOADS,
+    REMUX_VIDEOS, BATCH_SIZE_CAP,
+)
+from database import db, media_key
+from downloader import Downloader, VideoInfo
+from metadata import metadata_service
+from splitter import split_file, needs_split
+from remux import remuxer
+from storage import storage
+from metrics import metrics
+from http_client import http_client
+from info_cache import info_cache
+from thumbnails import thumbnail_service
+from scheduler import scheduler, Job, JobDropped
+from progress import progress_renderer
+from executors import executors
+from uploader import UploaderClient, StreamingUpload, StreamUnavailable, can_stream
+from batch import Batch, parse_links, is_encrypted_url
 import logging
 from pyrogram.enums import ParseMode
 import traceback
-import threading
 
 # Initialize bot
-app = Client("url_uploader_bot", api_id=API_ID, api_hash=API_HASH, bot_token=BOT_TOKEN)
+app = UploaderClient("url_uploader_bot", api_id=API_ID, api_hash=API_HASH, bot_token=BOT_TOKEN)
 
 # Set up logging for Pyrogram to avoid excessive messages
 logging.getLogger("pyrogram").setLevel(logging.WARNING)
@@ -37,8 +57,22 @@ logger.addHandler(handler)
 
 # User states
 USER_STATES = {}
-# Lock for updating progress messages
-update_locks = {}
+# Running batch tasks (kept referenced until they finish)
+BATCH_TASKS = set()
+# user_id -> batches still running, for the cancel handlers
+ACTIVE_BATCHES = {}
+# user_id -> event set when the user cancels the jobs submitted so far, kept apart from the session
+CANCEL_TOKENS = {}
+# Seconds between batch status message updates
+BATCH_UPDATE_INTERVAL = 3
+# Largest .txt link list accepted
+MAX_LINKS_FILE_SIZE = 1024 * 1024
+# Seconds between download progress writes to the database
+PROGRESS_SAVE_INTERVAL = 10
+# Errors for a cached file_id Telegram won't take anymore, anything else may pass
+STALE_MEDIA_ERRORS = (
+    FileIdInvalid, FileReferenceEmpty, FileReferenceExpired, FileReferenceInvalid, MediaEmpty, MediaInvalid
+)
 
 
 def format_size(size_bytes):
@@ -105,6 +139,256 @@ def format_eta(seconds):
         return f"{seconds}s"
 
 
+def cancel_markup():
+    """Cancel button shown under progress messages"""
+    return InlineKeyboardMarkup(
+        [[InlineKeyboardButton("❌ Cancel", callback_data="cancel_download")]]
+    )
+
+
+def render_queued_status(is_encrypted, position):
+    """Status text while a job waits for a worker"""
+    return (
+        f"{'🔐 ' if is_encrypted else ''}⏳ Qᴜᴇᴜᴇᴅ....\n\n"
+        f"┣⪼ 📋 Pᴏsɪᴛɪᴏɴ: {position}\n\n"
+        "Your file will start downloading once a worker is free."
+    )
+
+
+def render_download_status(is_encrypted, progress, speed, total_size, downloaded_size, eta):
+    """Status text while a file is downloading"""
+    return (
+        f"{'🔐 Dᴇᴄʀʏᴘᴛɪɴɢ & ' if is_encrypted else ''}Dᴏᴡɴʟᴏᴀᴅɪɴɢ....\n\n"
+        f"{create_progress_bar(progress)}\n\n"
+        "╭━━━━❰ᴘʀᴏɢʀᴇss ʙᴀʀ❱━➣\n"
+        f"┣⪼ 🗃️ Sɪᴢᴇ: {format_size(downloaded_size)} / {format_size(total_size)}\n"
+        f"┣⪼ ⏳️ Dᴏɴᴇ : {progress:.1f}%\n"
+        f"┣⪼ 🚀 Sᴩᴇᴇᴅ: {format_size(speed)}/s\n"
+        f"┣⪼ ⏰️ Eᴛᴀ: {format_eta(eta)}\n"
+        "╰━━━━━━━━━━━━━━━➣"
+    )
+
+
+def render_upload_status(current, total):
+    """Status text while a file is uploading"""
+    progress = (current / total) * 100 if total else 0
+    return (
+        "📤 Uᴘʟᴏᴀᴅɪɴɢ....\n\n"
+        f"{create_progress_bar(progress)}\n\n"
+        "╭━━━━❰ᴘʀᴏɢʀᴇss ʙᴀʀ❱━➣\n"
+        f"┣⪼ 🗃️ Sɪᴢᴇ: {format_size(current)} / {format_size(total)}\n"
+        f"┣⪼ ⏳️ Dᴏɴᴇ : {progress:.1f}%\n"
+        "╰━━━━━━━━━━━━━━━➣"
+    )
+
+
+def build_caption(filename, user_id, batch_name=None):
+    """Caption attached to every uploaded file"""
+    batch_name = batch_name or USER_STATES[user_id]['batch_name']
+    return (
+        "➖➖➖➖➖➖➖➖➖➖\n"
+        "📂 **File Details**\n"
+        "➖➖➖➖➖➖➖➖➖➖\n"
+        f"📝 **File Name:** `{filename}`\n"
+        f"👤 **Downloaded By:** _{USER_STATES[user_id]['username']}_\n"
+        f"🎯 **Batch:** `{batch_name}`\n"
+        f"⚡ **Status:** ✅ _Successfully Processed_\n"
+        "\n"
+        "🔗 __Stay Connected:__ [@MrGadhvii](https://t.me/MrGadhvii)\n"
+        "➖➖➖➖➖➖➖➖➖➖"
+    )
+
+
+async def send_parts(message: Message, result, video_info, caption, upload_progress, user_id, canceled):
+    """Split a file over Telegram's limit and upload each part as soon as it is cut"""
+    duration = video_info.duration if video_info else 0
+    logger.info(f"{os.path.basename(result)} is over the upload limit, splitting it")
+    try:
+        async for number, part in split_file(result, duration, is_video=is_video_file(result)):
+            if canceled():
+                os.remove(part)
+                break
+
+            part_info = None
+            if is_video_file(part):
+                # Every part gets its own duration and thumbnail
+                part_info = VideoInfo()
+                # Parts are deleted once uploaded, there's nothing to reuse
+                metadata = await metadata_service.extract(part, part, os.path.dirname(part), cache=False)
+                part_info.width = metadata["width"] or video_info.width
+                part_info.height = metadata["height"] or video_info.height
+                part_info.duration = metadata["duration"]
+                part_info.thumbnail = metadata["thumbnail"]
+
+            logger.info(f"Uploading part {number}: {os.path.basename(part)}")
+            await send_file(
+                message, part, part_info, f"🧩 **Part {number}**\n{caption}", upload_progress, user_id, canceled
+            )
+    finally:
+        if os.path.exists(result):
+            os.remove(result)
+        if video_info and video_info.thumbnail and os.path.exists(video_info.thumbnail):
+            os.remove(video_info.thumbnail)
+
+
+async def send_file(message: Message, result, video_info, caption, upload_progress, user_id, canceled, reserve=None):
+    """Upload a downloaded file as video or document and remove it afterwards
+
+    canceled() tells whether the job was canceled, it is checked between the parts of a split file.
+    reserve is the claim of the job's disk space, the remuxed copy is held through it.
+    """
+    if REMUX_VIDEOS and is_video_file(result):
+        result = await remuxer.remux(result, reserve)
+
+    if needs_split(result):
+        # Parts are not cached, there's no single file_id to re-send
+        await send_parts(message, result, video_info, caption, upload_progress, user_id, canceled)
+        return None
+
+    # Get thumbnail path from video_info
+    thumbnail_path = None
+    if (
+        video_info
+        and video_info.thumbnail
+        and os.path.exists(video_info.thumbnail)
+    ):
+        thumbnail_path = video_info.thumbnail
+        logger.info(f"Using thumbnail: {thumbnail_path}")
+
+    upload_started = time.perf_counter()
+    upload_size = os.path.getsize(result)
+
+    # Send as video if it's a video file, otherwise as document
+    if is_video_file(result):
+        try:
+            # Get video dimensions and duration from metadata
+            width = (
+                video_info.width
+                if video_info and video_info.width > 0
+                else 1280
+            )
+            height = (
+                video_info.height
+                if video_info and video_info.height > 0
+                else 720
+            )
+            duration = (
+                video_info.duration
+                if video_info and video_info.duration > 0
+                else 60
+            )
+
+            # Log video metadata for debugging
+            logger.info(
+                f"Sending video: {os.path.basename(result)}, {width}x{height}, {duration}s"
+            )
+            if thumbnail_path:
+                logger.info(
+                    f"Using thumbnail: {os.path.basename(thumbnail_path)}"
+                )
+
+            # Send as video with proper thumb and metadata
+            sent = await message.reply_video(
+                result,
+                caption=caption,
+                parse_mode=ParseMode.MARKDOWN,
+                supports_streaming=True,
+                width=width,
+                height=height,
+                duration=duration,
+                thumb=thumbnail_path,
+                progress=upload_progress,
+            )
+            logger.info(f"Successfully sent video to user {user_id}")
+        except Exception as video_error:
+            logger.error(f"Error sending as video: {video_error}")
+            logger.error(traceback.format_exc())
+            # Fallback to document if video send fails
+            sent = await message.reply_document(
+                result,
+                caption=caption,
+                parse_mode=ParseMode.MARKDOWN,
+                thumb=thumbnail_path,
+                progress=upload_progress,
+            )
+            logger.info(
+                f"Sent as document after video error for user {user_id}"
+            )
+    else:
+        # Send as document for non-video files
+        sent = await message.reply_document(
+            result,
+            caption=caption,
+            parse_mode=ParseMode.MARKDOWN,
+            thumb=thumbnail_path,
+            progress=upload_progress,
+        )
+        logger.info(f"Sent document to user {user_id}")
+
+    metrics.observe("stage_seconds", time.perf_counter() - upload_started, stage="upload")
+    metrics.count("upload_bytes", upload_size)
+
+    # Clean up the files after sending
+    if os.path.exists(result):
+        os.remove(result)
+        logger.info(f"Removed downloaded file: {result}")
+    if thumbnail_path and os.path.exists(thumbnail_path):
+        os.remove(thumbnail_path)
+        logger.info(f"Removed thumbnail: {thumbnail_path}")
+    return sent
+
+
+async def send_cached(message: Message, cached, caption):
+    """Re-send an earlier upload of the same link by its file_id, False if Telegram refuses it"""
+    try:
+        if cached["kind"] == "video":
+            await message.reply_video(
+                cached["file_id"],
+                caption=caption,
+                parse_mode=ParseMode.MARKDOWN,
+                supports_streaming=True,
+                width=cached.get("width") or 0,
+                height=cached.get("height") or 0,
+                duration=cached.get("duration") or 0,
+            )
+        else:
+            await message.reply_document(
+                cached["file_id"],
+                caption=caption,
+                parse_mode=ParseMode.MARKDOWN,
+            )
+        logger.info(f"Sent cached upload of {cached['url']}")
+        return True
+    except STALE_MEDIA_ERRORS as e:
+        # Stale or revoked file_id, forget it and upload again
+        logger.warning(f"Cached file_id for {cached['url']} is no longer valid: {e}")
+        await db.invalidate_cached_media(cached["_id"])
+        return False
+    except Exception as e:
+        # The file_id may still be good, keep it for the next time
+        logger.warning(f"Could not send cached upload of {cached['url']}: {e}")
+        return False
+
+
+async def remember_upload(url, sent: Message):
+    """Index a finished upload so the same link can be re-sent without downloading"""
+    if sent is None:
+        return
+    media = sent.video or sent.document
+    if media is None:
+        return
+    fields = {"file_name": media.file_name, "file_size": media.file_size}
+    if sent.video:
+        fields.update(width=media.width, height=media.height, duration=media.duration)
+    await db.cache_media(
+        media_key(url),
+        url.partition("*")[0],
+        media.file_id,
+        "video" if sent.video else "document",
+        **fields,
+    )
+
+
 @app.on_message(filters.command("start"))
 async def start_command(client: Client, message: Message):
     if message.from_user.id not in AUTH_USERS:
@@ -153,8 +437,7 @@ async def stop_command(client: Client, message: Message):
     user_id = message.from_user.id
     if user_id in USER_STATES:
         # Cancel any active downloads
-        if USER_STATES[user_id].get("canceled") != True:
-            USER_STATES[user_id]["canceled"] = True
+        await cancel_user_jobs(user_id)
 
         del USER_STATES[user_id]
         await message.reply_text(
@@ -173,7 +456,23 @@ async def stop_command(client: Client, message: Message):
         )
 
 
-@app.on_message(filters.text & filters.private & ~filters.command(["start", "stop"]))
+@app.on_message(filters.command("stats") & filters.user(OWNER_ID))
+async def stats_command(client: Client, message: Message):
+    """Pipeline numbers for the owner, the same ones the metrics endpoint serves"""
+    lines = [await executors.cpu.run(metrics.summary, await metrics.snapshot())]
+    usage = (await storage.usage())["users"]
+    if usage:
+        lines.append("")
+        lines.append("[disk per user]")
+        lines.extend(
+            f"{user}: {format_size(u['used'])} used, {format_size(u['reserved'])} reserved, {u['jobs']} jobs"
+            for user, u in usage.items()
+        )
+    text = "\n".join(lines)
+    await message.reply_text(f"```\n{text}\n```", parse_mode=ParseMode.MARKDOWN)
+
+
+@app.on_message(filters.text & filters.private & ~filters.command(["start", "stop", "stats"]))
 async def handle_messages(client: Client, message: Message):
     user_id = message.from_user.id
     if user_id not in AUTH_USERS:
@@ -219,13 +518,15 @@ async def handle_messages(client: Client, message: Message):
             "Example:\n"
             "`My Video : https://example.com/video.mp4`\n"
             "`Encrypted Video : https://example.com/video.mkv*12345`\n\n"
+            "Send several lines (or a .txt file) to queue a whole batch.\n"
             "Use /stop to end the session at any time.",
             parse_mode=ParseMode.MARKDOWN,
             reply_markup=ForceReply(selective=True),
         )
 
     elif state == "waiting_file_url":
-        if ":" not in message.text:
+        links, invalid = parse_links(message.text)
+        if not links:
             await message.reply_text(
                 "⚠️ Invalid format!\n\n"
                 "Please use the format:\n"
@@ -233,25 +534,22 @@ async def handle_messages(client: Client, message: Message):
                 "For encrypted videos: `Filename : URL.mkv*key`\n\n"
                 "Examples:\n"
                 "`My Video : https://example.com/video.mp4`\n"
-                "`Encrypted Video : https://example.com/video.mkv*12345`",
+                "`Encrypted Video : https://example.com/video.mkv*12345`\n\n"
+                "Send several lines (or a .txt file) to queue a whole batch.",
                 parse_mode=ParseMode.MARKDOWN,
                 reply_markup=ForceReply(selective=True),
             )
             return
 
-        filename, url = [x.strip() for x in message.text.split(":", 1)]
-        if not filename or not url:
-            await message.reply_text(
-                "⚠️ Invalid format!\n\n" "Please provide both filename and URL.",
-                reply_markup=ForceReply(selective=True),
-            )
+        # Several links at once are processed as a batch
+        if len(links) > 1:
+            await start_batch(message, user_id, links, invalid)
             return
 
+        filename, url = links[0]
+
         # Check if it's an encrypted video URL
-        is_encrypted = "*" in url and any(
-            ext in url.lower()
-            for ext in [".mkv", ".mp4", ".avi", ".mov", ".wmv", ".flv", ".webm"]
-        )
+        is_encrypted = is_encrypted_url(url)
 
         # Store current download info in case user wants to cancel
         USER_STATES[user_id]["current_task"] = {
@@ -262,23 +560,13 @@ async def handle_messages(client: Client, message: Message):
             "last_update_time": 0,
         }
 
-        # Set canceled flag to False for new download
-        USER_STATES[user_id]["canceled"] = False
+        # Canceling later must reach this job, but not one canceled before it
+        token = cancel_token(user_id)
         
-        # Create lock for this user if it doesn't exist
-        if user_id not in update_locks:
-            update_locks[user_id] = threading.Lock()
-
         # Initial status message
         status_message = await message.reply_text(
-            f"{'🔐 Dᴇᴄʀʏᴘᴛɪɴɢ & ' if is_encrypted else ''}Dᴏᴡɴʟᴏᴀᴅ Sᴛᴀʀᴛᴇᴅ....\n\n"
-            f"{create_progress_bar(0)}\n\n"
-            "╭━━━━❰ᴘʀᴏɢʀᴇss ʙᴀʀ❱━➣\n"
-            "┣⪼ 🗃️ Sɪᴢᴇ: Waiting... \n"
-            "┣⪼ ⏳️ Dᴏɴᴇ : 0%\n"
-            "┣⪼ 🚀 Sᴩᴇᴇᴅ: Calculating...\n"
-            "┣⪼ ⏰️ Eᴛᴀ: Calculating...\n"
-            "╰━━━━━━━━━━━━━━━➣",
+            f"{'🔐 ' if is_encrypted else ''}⏳ Qᴜᴇᴜᴇᴅ....\n\n"
+            "Your file will start downloading shortly.",
             reply_markup=InlineKeyboardMarkup(
                 [[InlineKeyboardButton("❌ Cancel", callback_data="cancel_download")]]
             ),
@@ -288,83 +576,203 @@ async def handle_messages(client: Client, message: Message):
         USER_STATES[user_id]["current_task"]["status_message"] = status_message
         USER_STATES[user_id]["current_task"]["message_id"] = status_message.id
         USER_STATES[user_id]["current_task"]["chat_id"] = status_message.chat.id
-        
-        # Progress callback - updates the status message
-        async def progress_callback(
-            progress, speed, total_size, downloaded_size, eta, filename=""
-        ):
-            try:
-                # Check if user has canceled
-                if user_id not in USER_STATES or USER_STATES[user_id].get(
-                    "canceled", False
-                ):
-                    return
-
-                # Get current task info
-                current_task = USER_STATES[user_id].get("current_task", {})
-                current_message = current_task.get("status_message")
-
-                # If no message to update, exit
-                if not current_message:
-                    logger.warning(f"No status message found for user {user_id}")
-                    return
-                
-                # Use lock to prevent multiple concurrent updates
-                with update_locks[user_id]:
-                    # Only update if enough time has passed since last update (rate limiting)
-                    now = time.time()
-                    last_update = current_task.get("last_update_time", 0)
-                    if now - last_update < 0.5:  # 0.5 seconds minimum between updates
-                        return
-                
-                    # Create progress text
-                    progress_bar = create_progress_bar(progress)
-                    status_text = (
-                        f"{'🔐 Dᴇᴄʀʏᴘᴛɪɴɢ & ' if is_encrypted else ''}Dᴏᴡɴʟᴏᴀᴅɪɴɢ....\n\n"
-                        f"{progress_bar}\n\n"
-                        "╭━━━━❰ᴘʀᴏɢʀᴇss ʙᴀʀ❱━➣\n"
-                        f"┣⪼ 🗃️ Sɪᴢᴇ: {format_size(downloaded_size)} / {format_size(total_size)}\n"
-                        f"┣⪼ ⏳️ Dᴏɴᴇ : {progress:.1f}%\n"
-                        f"┣⪼ 🚀 Sᴩᴇᴇᴅ: {format_size(speed)}/s\n"
-                        f"┣⪼ ⏰️ Eᴛᴀ: {format_eta(eta)}\n"
-                        "╰━━━━━━━━━━━━━━━➣"
-                    )
-    
-                    # Update the message with new progress
-                    try:
-                        await current_message.edit_text(
-                            status_text,
-                            reply_markup=InlineKeyboardMarkup(
-                                [
-                                    [
-                                        InlineKeyboardButton(
-                                            "❌ Cancel", callback_data="cancel_download"
-                                        )
-                                    ]
-                                ]
-                            ),
-                        )
-                        # Log successful update
-                        logger.info(f"Updated progress for user {user_id}: {progress:.1f}%")
-                        # Store the last update time
-                        current_task["last_update_time"] = now
-                    except Exception as e:
-                        logger.error(f"Failed to update progress message: {e}")
-
-            except Exception as e:
-                # Log the full exception with traceback
-                logger.error(f"Progress callback error: {e}")
-                logger.error(traceback.format_exc())
 
-        try:
-            # Create and start downloader
-            downloader = Downloader(url, filename, progress_callback)
-            success, result, video_info = await downloader.download()
+        # Show the queue position while waiting for a free worker
+        async def show_position(position):
+            progress_renderer.publish(
+                status_message,
+                render_queued_status,
+                is_encrypted,
+                position,
+                reply_markup=cancel_markup(),
+            )
+
+        # Persist the job so it survives a restart
+        record = await db.add_download(
+            user_id,
+            filename,
+            url,
+            chat_id=message.chat.id,
+            message_id=message.id,
+            username=USER_STATES[user_id].get("username"),
+            batch_name=USER_STATES[user_id].get("batch_name"),
+        )
+        download_id = record.inserted_id if record else None
+
+        scheduler.submit(
+            Job(
+                user_id,
+                lambda: process_download(
+                    message, status_message, user_id, token, filename, url, is_encrypted, download_id
+                ),
+                on_position=show_position,
+                on_cancel=lambda: progress_renderer.discard(status_message),
+            )
+        )
+
+
+async def track_download(download_id, status, **fields):
+    """Record a job state change in the database"""
+    if status in ("done", "failed", "canceled"):
+        metrics.count(f"jobs_{status}")
+    if download_id:
+        await db.update_download_status(download_id, status, **fields)
+
+
+def open_storage(download_id, user_id):
+    """Give a job its own folder, named after its database record when it has one"""
+    return storage.open(str(download_id) if download_id else uuid.uuid4().hex, user_id)
+
+
+async def download_or_resume(downloader: Downloader, download_id, resume_path=None):
+    """Run the download, or reuse a file finished before a restart"""
+    if download_id:
+        await db.start_download_attempt(download_id, temp_path=downloader.temp_path)
+
+    if resume_path and os.path.exists(resume_path):
+        logger.info(f"Reusing already downloaded file: {resume_path}")
+        if is_video_file(resume_path):
+            await downloader.extract_video_metadata(resume_path)
+        return True, resume_path, downloader.video_info
+
+    return await downloader.download()
+
+
+async def stream_upload(message: Message, url, filename, caption, upload_progress, user_id, token, download_id):
+    """Upload a document while it downloads, False if it has to go through the disk"""
+    async def progress(current, total):
+        if is_canceled(user_id, token):
+            raise StopTransmission()
+        await upload_progress(current, total)
+
+    upload = StreamingUpload(app, url, filename, progress=progress)
+    try:
+        total = await upload.open()
+        logger.info(f"Streaming {filename} ({total} bytes) straight to Telegram")
+        await track_download(download_id, "uploading", total_bytes=total)
+        with metrics.timer("upload"):
+            sent = await upload.send(message.chat.id, caption, reply_to_message_id=message.id)
+        metrics.count("upload_bytes", total)
+        logger.info(f"Streamed document to user {user_id}")
+        await remember_upload(url, sent)
+        return True
+    except StreamUnavailable as e:
+        logger.info(f"Not streaming {filename}: {e}")
+        return False
+    except StopTransmission:
+        raise
+    except Exception as e:
+        logger.warning(f"Streaming upload of {filename} failed ({e}), downloading to disk instead")
+        return False
+    finally:
+        upload.close()
+
+
+async def process_download(
+    message: Message,
+    status_message: Message,
+    user_id,
+    token: threading.Event,  # From cancel_token() when the job was submitted
+    filename,
+    url,
+    is_encrypted,
+    download_id=None,
+    resume_path=None,
+):
+    """Download a file and upload it to the chat, run by the job scheduler"""
+    # Check if user has canceled while the job was queued
+    if is_canceled(user_id, token):
+        progress_renderer.discard(status_message)
+        await track_download(download_id, "canceled")
+        return
+
+    # Replace any queue position update still waiting to be shown
+    progress_renderer.discard(status_message)
+    await status_message.edit_text(
+        f"{'🔐 Dᴇᴄʀʏᴘᴛɪɴɢ & ' if is_encrypted else ''}Dᴏᴡɴʟᴏᴀᴅ Sᴛᴀʀᴛᴇᴅ....\n\n"
+        f"{create_progress_bar(0)}\n\n"
+        "╭━━━━❰ᴘʀᴏɢʀᴇss ʙᴀʀ❱━➣\n"
+        "┣⪼ 🗃️ Sɪᴢᴇ: Waiting... \n"
+        "┣⪼ ⏳️ Dᴏɴᴇ : 0%\n"
+        "┣⪼ 🚀 Sᴩᴇᴇᴅ: Calculating...\n"
+        "┣⪼ ⏰️ Eᴛᴀ: Calculating...\n"
+        "╰━━━━━━━━━━━━━━━➣",
+        reply_markup=cancel_markup(),
+    )
+
+    # Last time the progress was saved to the database
+    last_save_time = 0
+    loop = asyncio.get_running_loop()
+    space, keep_files = None, False
+
+    # Progress callback - runs on the download thread, only publishes the numbers
+    def progress_callback(
+        progress, speed, total_size, downloaded_size, eta, filename=""
+    ):
+        nonlocal last_save_time
+        # Check if user has canceled
+        if is_canceled(user_id, token):
+            return
+
+        progress_renderer.publish(
+            status_message,
+            render_download_status,
+            is_encrypted,
+            progress,
+            speed or 0,
+            total_size,
+            downloaded_size,
+            eta,
+            reply_markup=cancel_markup(),
+        )
+
+        # Persist progress now and then so a restart can tell how far we got
+        if download_id and time.time() - last_save_time >= PROGRESS_SAVE_INTERVAL:
+            last_save_time = time.time()
+            asyncio.run_coroutine_threadsafe(
+                db.update_download_progress(download_id, downloaded_size or 0, total_size or 0),
+                loop,
+            )
+
+    try:
+        # Different caption formats for different file types
+        caption = build_caption(filename, user_id)
+
+        # Progress callback for upload, the renderer paces the edits
+        async def upload_progress(current, total):
+            # Check if user has canceled
+            if is_canceled(user_id, token):
+                return
+            progress_renderer.publish(status_message, render_upload_status, current, total)
+
+        # The same link was uploaded before, re-send it without downloading
+        cached = await db.get_cached_media(media_key(url))
+        delivered = cached is not None and await send_cached(message, cached, caption)
+
+        # Documents with a known size go to Telegram while they download
+        if not delivered and STREAM_UPLOADS and not is_encrypted and not resume_path and can_stream(url, filename):
+            delivered = await stream_upload(
+                message, url, filename, caption, upload_progress, user_id, token, download_id
+            )
+
+        if not delivered:
+            # Create and start downloader, the expected size is reserved on disk first
+            space = open_storage(download_id, user_id)
+            downloader = Downloader(
+                url,
+                filename,
+                progress_callback,
+                download_path=space.path,
+                temp_name=str(download_id) if download_id else None,
+                reserve=space.claim,
+                on_format=lambda plan: scheduler.expect(plan.size, plan.selector, space.path),
+                canceled=lambda: is_canceled(user_id, token),
+            )
+            success, result, video_info = await download_or_resume(downloader, download_id, resume_path)
+            progress_renderer.discard(status_message)
 
             # Check if user has canceled during download
-            if user_id not in USER_STATES or USER_STATES[user_id].get(
-                "canceled", False
-            ):
+            if is_canceled(user_id, token):
                 if result and os.path.exists(result):
                     os.remove(result)
                 if (
@@ -373,9 +781,11 @@ async def handle_messages(client: Client, message: Message):
                     and os.path.exists(video_info.thumbnail)
                 ):
                     os.remove(video_info.thumbnail)
+                await track_download(download_id, "canceled")
                 return
 
             if not success:
+                await track_download(download_id, "failed", error=result)
                 await status_message.edit_text(
                     f"❌ Download failed!\n\n"
                     f"Error: {result}\n\n"
@@ -392,177 +802,365 @@ async def handle_messages(client: Client, message: Message):
                 )
                 return
 
+            await track_download(download_id, "uploading", file_path=result)
             await status_message.edit_text(
                 "📤 Uploading to Telegram...\n\n"
                 "Please wait while we upload your file."
             )
 
-            # Different caption formats for different file types
-            caption = (
-                "➖➖➖➖➖➖➖➖➖➖\n"
-                "📂 **File Details**\n"
-                "➖➖➖➖➖➖➖➖➖➖\n"
-                f"📝 **File Name:** `{filename}`\n"
-                f"👤 **Downloaded By:** _{USER_STATES[user_id]['username']}_\n"
-                f"🎯 **Batch:** `{USER_STATES[user_id]['batch_name']}`\n"
-                f"⚡ **Status:** ✅ _Successfully Processed_\n"
-                "\n"
-                "🔗 __Stay Connected:__ [@MrGadhvii](https://t.me/MrGadhvii)\n"
-                "➖➖➖➖➖➖➖➖➖➖"
+            sent = await send_file(
+                message, result, video_info, caption, upload_progress, user_id, lambda: is_canceled(user_id, token),
+                space.claim,
             )
+            await remember_upload(url, sent)
 
-            # Last upload update time
-            last_upload_update_time = time.time()
-            update_interval = 1  # seconds between updates
-
-            # Progress callback for upload with rate limiting
-            async def upload_progress(current, total):
-                nonlocal last_upload_update_time
-                current_time = time.time()
-
-                # Throttle updates to avoid Telegram's rate limits
-                if (current_time - last_upload_update_time) < update_interval:
-                    return
-
-                last_upload_update_time = current_time
-
-                try:
-                    # Check if user has canceled
-                    if user_id not in USER_STATES or USER_STATES[user_id].get(
-                        "canceled", False
-                    ):
-                        return
-
-                    progress = (current / total) * 100
-                    progress_bar = create_progress_bar(progress)
-                    status_text = (
-                        "📤 Uᴘʟᴏᴀᴅɪɴɢ....\n\n"
-                        f"{progress_bar}\n\n"
-                        "╭━━━━❰ᴘʀᴏɢʀᴇss ʙᴀʀ❱━➣\n"
-                        f"┣⪼ 🗃️ Sɪᴢᴇ: {format_size(current)} / {format_size(total)}\n"
-                        f"┣⪼ ⏳️ Dᴏɴᴇ : {progress:.1f}%\n"
-                        "╰━━━━━━━━━━━━━━━➣"
-                    )
-                    await status_message.edit_text(status_text)
-                    logger.info(f"Upload progress for user {user_id}: {progress:.1f}%")
-                except Exception as e:
-                    logger.error(f"Upload progress error: {e}")
-
-            # Get thumbnail path from video_info
-            thumbnail_path = None
-            if (
-                video_info
-                and video_info.thumbnail
-                and os.path.exists(video_info.thumbnail)
-            ):
-                thumbnail_path = video_info.thumbnail
-                logger.info(f"Using thumbnail: {thumbnail_path}")
-
-            # Send as video if it's a video file, otherwise as document
-            if is_video_file(result):
-                try:
-                    # Get video dimensions and duration from metadata
-                    width = (
-                        video_info.width
-                        if video_info and video_info.width > 0
-                        else 1280
-                    )
-                    height = (
-                        video_info.height
-                        if video_info and video_info.height > 0
-                        else 720
-                    )
-                    duration = (
-                        video_info.duration
-                        if video_info and video_info.duration > 0
-                        else 60
-                    )
-
-                    # Log video metadata for debugging
-                    logger.info(
-                        f"Sending video: {os.path.basename(result)}, {width}x{height}, {duration}s"
-                    )
-                    if thumbnail_path:
-                        logger.info(
-                            f"Using thumbnail: {os.path.basename(thumbnail_path)}"
-                        )
+        await track_download(download_id, "done")
+        progress_renderer.discard(status_message)
 
-                    # Send as video with proper thumb and metadata
-                    await message.reply_video(
-                        result,
-                        caption=caption,
-                        parse_mode=ParseMode.MARKDOWN,
-                        supports_streaming=True,
-                        width=width,
-                        height=height,
-                        duration=duration,
-                        thumb=thumbnail_path,
-                        progress=upload_progress,
-                    )
-                    logger.info(f"Successfully sent video to user {user_id}")
-                except Exception as video_error:
-                    logger.error(f"Error sending as video: {video_error}")
-                    logger.error(traceback.format_exc())
-                    # Fallback to document if video send fails
-                    await message.reply_document(
-                        result,
-                        caption=caption,
-                        parse_mode=ParseMode.MARKDOWN,
-                        thumb=thumbnail_path,
-                        progress=upload_progress,
-                    )
-                    logger.info(
-                        f"Sent as document after video error for user {user_id}"
-                    )
-            else:
-                # Send as document for non-video files
-                await message.reply_document(
-                    result,
-                    caption=caption,
-                    parse_mode=ParseMode.MARKDOWN,
-                    thumb=thumbnail_path,
-                    progress=upload_progress,
-                )
-                logger.info(f"Sent document to user {user_id}")
-
-            # Clean up the files after sending
-            if os.path.exists(result):
-                os.remove(result)
-                logger.info(f"Removed downloaded file: {result}")
-            if thumbnail_path and os.path.exists(thumbnail_path):
-                os.remove(thumbnail_path)
-                logger.info(f"Removed thumbnail: {thumbnail_path}")
-
-            # Delete status message
-            try:
-                await status_message.delete()
-            except Exception as e:
-                logger.error(f"Error deleting status message: {e}")
+        # Delete status message
+        try:
+            await status_message.delete()
+        except Exception as e:
+            logger.error(f"Error deleting status message: {e}")
 
-            await message.reply_text(
-                "✅ File uploaded successfully!\n\n"
-                "Would you like to download another file?",
-                reply_markup=InlineKeyboardMarkup(
+        await message.reply_text(
+            "✅ File uploaded successfully!\n\n"
+            "Would you like to download another file?",
+            reply_markup=InlineKeyboardMarkup(
+                [
                     [
-                        [
-                            InlineKeyboardButton("✅ Yes", callback_data="continue"),
-                            InlineKeyboardButton("❌ No", callback_data="stop"),
-                        ]
+                        InlineKeyboardButton("✅ Yes", callback_data="continue"),
+                        InlineKeyboardButton("❌ No", callback_data="stop"),
                     ]
-                ),
-            )
-        except Exception as e:
-            logger.error(f"Download/upload error: {e}")
-            logger.error(traceback.format_exc())
-            await status_message.edit_text(
-                f"❌ An error occurred!\n\n"
-                f"Error: {str(e)}\n\n"
-                f"Please try again or contact support if the problem persists.",
-                reply_markup=InlineKeyboardMarkup(
-                    [[InlineKeyboardButton("🔄 Try Again", callback_data="continue")]]
-                ),
+                ]
+            ),
+        )
+    except StopTransmission:
+        # Canceled while streaming, the cancel handler already told the user
+        progress_renderer.discard(status_message)
+        await track_download(download_id, "canceled")
+    except asyncio.CancelledError:
+        # Shutting down, the resumed job picks its files up again
+        keep_files = True
+        raise
+    except Exception as e:
+        logger.error(f"Download/upload error: {e}")
+        logger.error(traceback.format_exc())
+        await track_download(download_id, "failed", error=str(e))
+        progress_renderer.discard(status_message)
+        await status_message.edit_text(
+            f"❌ An error occurred!\n\n"
+            f"Error: {str(e)}\n\n"
+            f"Please try again or contact support if the problem persists.",
+            reply_markup=InlineKeyboardMarkup(
+                [[InlineKeyboardButton("🔄 Try Again", callback_data="continue")]]
+            ),
+        )
+    finally:
+        # Whichever way the job ended, its status message gets no more updates
+        progress_renderer.discard(status_message)
+        if space is not None:
+            await storage.release(space, keep_files)
+
+
+def cancel_token(user_id) -> threading.Event:
+    """Event set when the user cancels the jobs submitted until then, safe to check from any thread"""
+    return CANCEL_TOKENS.setdefault(user_id, threading.Event())
+
+
+def is_canceled(user_id, token: threading.Event):
+    """Check if the user has canceled the job or ended the session"""
+    return user_id not in USER_STATES or token.is_set()
+
+
+def batch_canceled(batch: Batch):
+    """Check if the batch was canceled, every cancel of its user goes through Batch.cancel()"""
+    return batch.canceled
+
+
+async def cancel_user_jobs(user_id):
+    """Cancel the running and queued jobs of a user"""
+    # Jobs submitted from now on get a fresh token
+    CANCEL_TOKENS.pop(user_id, threading.Event()).set()
+    scheduler.cancel_user(user_id)
+    # Queued batch items are failed here, run_batch must not wait on jobs the scheduler dropped
+    for batch in ACTIVE_BATCHES.get(user_id, ()):
+        batch.cancel()
+    await db.cancel_user_downloads(user_id)
+
+
+def render_batch(batch: Batch):
+    """Aggregated status text for a batch"""
+    uploading = batch.uploading
+    text = (
+        f"📦 Bᴀᴛᴄʜ: {batch.name}\n\n"
+        f"{create_progress_bar(batch.progress)}\n\n"
+        "╭━━━━❰ʙᴀᴛᴄʜ ᴘʀᴏɢʀᴇss❱━➣\n"
+        f"┣⪼ 📋 Fɪʟᴇs: {batch.count('done', 'failed')} / {len(batch)}\n"
+        f"┣⪼ ⏳️ Dᴏɴᴇ : {batch.progress:.1f}%\n"
+        f"┣⪼ ⬇️ Dᴏᴡɴʟᴏᴀᴅɪɴɢ: {batch.count('downloading')}\n"
+        f"┣⪼ 📤 Uᴘʟᴏᴀᴅɪɴɢ: {uploading.filename if uploading else '-'}\n"
+        f"┣⪼ ✅ Uᴘʟᴏᴀᴅᴇᴅ: {batch.count('done')}\n"
+        f"┣⪼ ❌ Fᴀɪʟᴇᴅ: {batch.count('failed')}\n"
+        "╰━━━━━━━━━━━━━━━➣"
+    )
+    if batch.skipped:
+        text += f"\n\n⚠️ Skipped {batch.skipped} invalid line(s)"
+    return text
+
+
+async def start_batch(message: Message, user_id, links, invalid):
+    """Queue a batch of links tracked by a single status message"""
+    batch = Batch(user_id, USER_STATES[user_id]["batch_name"], links, skipped=len(invalid), max_size=BATCH_SIZE_CAP)
+
+    # Persist every item up front so a restart can pick up the rest of the batch
+    records = await db.add_downloads(
+        user_id,
+        [(item.filename, item.url, {"batch_index": item.index}) for item in batch.items],
+        chat_id=message.chat.id,
+        message_id=message.id,
+        username=USER_STATES[user_id].get("username"),
+        batch_name=batch.name,
+    )
+    if records:
+        # Ids come back in the order of the documents
+        for item, download_id in zip(batch.items, records.inserted_ids):
+            item.download_id = download_id
+
+    status_message = await message.reply_text(
+        render_batch(batch),
+        reply_markup=InlineKeyboardMarkup(
+            [[InlineKeyboardButton("❌ Cancel", callback_data="cancel_download")]]
+        ),
+    )
+    logger.info(f"User {user_id} started batch '{batch.name}' with {len(batch)} links")
+
+    ACTIVE_BATCHES.setdefault(user_id, set()).add(batch)
+    task = asyncio.get_running_loop().create_task(run_batch(message, status_message, batch))
+    BATCH_TASKS.add(task)
+    task.add_done_callback(BATCH_TASKS.discard)
+
+
+async def update_batch_status(status_message: Message, batch: Batch):
+    """Periodically refresh the batch status message until the batch is done"""
+    while not batch.is_finished:
+        # The renderer skips the edit when nothing visible changed
+        progress_renderer.publish(status_message, render_batch, batch, reply_markup=cancel_markup())
+        await asyncio.sleep(BATCH_UPDATE_INTERVAL)
+
+
+async def run_batch(message: Message, status_message: Message, batch: Batch):
+    """Feed batch items to the scheduler, at most BATCH_PARALLEL at a time"""
+    depth = max(1, BATCH_PARALLEL)
+    loop = asyncio.get_running_loop()
+    updater = loop.create_task(update_batch_status(status_message, batch))
+    # The items queue their download and upload jobs themselves, kept referenced here
+    tasks = []
+    try:
+        for item in batch.items:
+            # Items finish in order, so this keeps `depth` items in flight
+            if item.index >= depth:
+                await batch.items[item.index - depth].finished.wait()
+            if batch_canceled(batch):
+                batch.cancel()
+                break
+            tasks.append(loop.create_task(process_batch_item(message, batch, item)))
+
+        await asyncio.gather(*(item.finished.wait() for item in batch.items))
+    finally:
+        updater.cancel()
+        progress_renderer.discard(status_message)
+        ACTIVE_BATCHES.get(batch.user_id, set()).discard(batch)
+        if not ACTIVE_BATCHES.get(batch.user_id):
+            ACTIVE_BATCHES.pop(batch.user_id, None)
+
+    failed = [item for item in batch.items if item.state == "failed"]
+    summary = (
+        f"📦 Bᴀᴛᴄʜ: {batch.name}\n\n"
+        f"✅ Uploaded {batch.count('done')} of {len(batch)} files"
+    )
+    if failed:
+        summary += "\n\n❌ Failed:\n" + "\n".join(
+            f"• {item.filename}: {item.error}" for item in failed[:10]
+        )
+        if len(failed) > 10:
+            summary += f"\n• ... and {len(failed) - 10} more"
+    try:
+        await status_message.edit_text(summary)
+    except Exception as e:
+        logger.error(f"Failed to update batch status: {e}")
+
+    if not batch_canceled(batch):
+        await message.reply_text(
+            "✅ Batch finished!\n\n"
+            "Would you like to download more files?",
+            reply_markup=InlineKeyboardMarkup(
+                [
+                    [
+                        InlineKeyboardButton("✅ Yes", callback_data="continue"),
+                        InlineKeyboardButton("❌ No", callback_data="stop"),
+                    ]
+                ]
+            ),
+        )
+
+
+async def process_batch_item(message: Message, batch: Batch, item):
+    """Download one batch item, then upload it once all earlier items are uploaded
+
+    The download and the upload are separate scheduler jobs, waiting for
+    the earlier uploads in between holds no worker.
+    """
+    state, error = "failed", None
+    space, keep_files = None, False
+    try:
+        if batch_canceled(batch):
+            error = "Canceled"
+            return
+
+        caption = build_caption(item.filename, batch.user_id, batch.name)
+
+        # The same link was uploaded before, re-send it in turn without downloading
+        cached = await db.get_cached_media(media_key(item.url))
+        if cached is not None:
+            item.state = "waiting"
+            await batch.wait_turn(item)
+            if batch_canceled(batch):
+                error = "Canceled"
+                return
+            item.state = "uploading"
+            if await scheduler.call(batch.user_id, lambda: send_cached(message, cached, caption)):
+                state = "done"
+                return
+
+        space = open_storage(item.download_id, batch.user_id)
+        success, result, video_info = await scheduler.call(
+            batch.user_id, lambda: download_batch_item(batch, item, space)
+        )
+        if not success:
+            error = result
+            return
+
+        # Keep the chat in batch order, the folder is deleted on release if it's canceled meanwhile
+        item.state = "waiting"
+        await batch.wait_turn(item)
+        if batch_canceled(batch):
+            error = "Canceled"
+            return
+
+        item.state = "uploading"
+        await scheduler.call(
+            batch.user_id, lambda: upload_batch_item(message, batch, item, caption, result, video_info, space)
+        )
+        state = "done"
+    except JobDropped:
+        error = "Canceled"
+    except asyncio.CancelledError:
+        keep_files = True
+        raise
+    except Exception as e:
+        logger.error(f"Batch item {item.filename} failed: {e}")
+        logger.error(traceback.format_exc())
+        error = str(e)
+    finally:
+        if space is not None:
+            await storage.release(space, keep_files)
+        # A failed item must not let later items overtake earlier uploads
+        await batch.wait_turn(item)
+        batch.finish(item, state, error)
+        await track_download(item.download_id, state, error=error)
+
+
+async def download_batch_item(batch: Batch, item, space):
+    """Download a batch item into its folder, run by the job scheduler"""
+    # Started, a cancel from here on is up to this job
+    item.state = "downloading"
+    last_save_time = 0
+    loop = asyncio.get_running_loop()
+
+    # Runs on the download thread, the batch status loop renders the numbers
+    def progress_callback(
+        progress, speed, total_size, downloaded_size, eta, filename=""
+    ):
+        nonlocal last_save_time
+        item.downloaded = downloaded_size or 0
+        item.total = total_size or 0
+        if item.download_id and time.time() - last_save_time >= PROGRESS_SAVE_INTERVAL:
+            last_save_time = time.time()
+            asyncio.run_coroutine_threadsafe(
+                db.update_download_progress(item.download_id, item.downloaded, item.total),
+                loop,
             )
 
+    # The rest of the batch shares what's left of its size cap
+    def on_format(plan):
+        item.planned_size = plan.size
+        scheduler.expect(plan.size, plan.selector, space.path)
+
+    downloader = Downloader(
+        item.url,
+        item.filename,
+        progress_callback,
+        download_path=space.path,
+        temp_name=str(item.download_id) if item.download_id else None,
+        reserve=space.claim,
+        size_cap=batch.size_cap(),
+        on_format=on_format,
+        canceled=lambda: batch_canceled(batch),
+    )
+    return await download_or_resume(downloader, item.download_id)
+
+
+async def upload_batch_item(message: Message, batch: Batch, item, caption, result, video_info, space):
+    """Upload a downloaded batch item in its turn, run by the job scheduler"""
+    await track_download(item.download_id, "uploading", file_path=result)
+
+    async def upload_progress(current, total):
+        item.uploaded = current
+        item.upload_total = total
+
+    sent = await send_file(
+        message, result, video_info, caption, upload_progress, batch.user_id, lambda: batch_canceled(batch),
+        space.claim,
+    )
+    await remember_upload(item.url, sent)
+
+
+@app.on_message(filters.document & filters.private)
+async def handle_document(client: Client, message: Message):
+    user_id = message.from_user.id
+    if user_id not in AUTH_USERS:
+        return
+
+    if user_id not in USER_STATES or USER_STATES[user_id].get("state") != "waiting_file_url":
+        await message.reply_text(
+            "⚠️ Please start a session with /start and set a batch name before sending a link list."
+        )
+        return
+
+    document = message.document
+    if not (document.file_name or "").lower().endswith(".txt"):
+        await message.reply_text(
+            "⚠️ Only .txt files with one `Filename : URL` per line are supported.",
+            parse_mode=ParseMode.MARKDOWN,
+        )
+        return
+
+    if document.file_size > MAX_LINKS_FILE_SIZE:
+        await message.reply_text("⚠️ The link list is too large.")
+        return
+
+    data = await client.download_media(message, in_memory=True)
+    links, invalid = parse_links(bytes(data.getbuffer()).decode("utf-8", errors="ignore"))
+    if not links:
+        await message.reply_text(
+            "⚠️ No `Filename : URL` lines found in the file.",
+            parse_mode=ParseMode.MARKDOWN,
+        )
+        return
+
+    await start_batch(message, user_id, links, invalid)
+
 
 @app.on_callback_query()
 async def answer_callback(client: Client, callback_query: CallbackQuery):
@@ -572,6 +1170,8 @@ async def answer_callback(client: Client, callback_query: CallbackQuery):
 
     if data == "cancel":
         if user_id in USER_STATES:
+            # Ending the session cancels its jobs, even if a new one starts before they notice
+            await cancel_user_jobs(user_id)
             del USER_STATES[user_id]
 
         await message.edit_text(
@@ -584,7 +1184,9 @@ async def answer_callback(client: Client, callback_query: CallbackQuery):
     elif data == "cancel_download":
         # Mark the download as canceled
         if user_id in USER_STATES:
-            USER_STATES[user_id]["canceled"] = True
+            await cancel_user_jobs(user_id)
+            # A queued update must not overwrite the cancel notice
+            progress_renderer.discard(message)
             logger.info(f"User {user_id} canceled download")
             await message.edit_text(
                 "❌ Download cancelled.\n\n" "Send /start to begin a new session.",
@@ -612,6 +1214,7 @@ async def answer_callback(client: Client, callback_query: CallbackQuery):
                 "Example:\n"
                 "`My Video : https://example.com/video.mp4`\n"
                 "`Encrypted Video : https://example.com/video.mkv*12345`\n\n"
+                "Send several lines (or a .txt file) to queue a whole batch.\n"
                 "Use /stop to end the session at any time.",
                 parse_mode=ParseMode.MARKDOWN,
                 reply_markup=None,
@@ -619,6 +1222,7 @@ async def answer_callback(client: Client, callback_query: CallbackQuery):
 
     elif data == "stop":
         if user_id in USER_STATES:
+            await cancel_user_jobs(user_id)
             del USER_STATES[user_id]
 
         await message.edit_text(
@@ -638,7 +1242,8 @@ async def answer_callback(client: Client, callback_query: CallbackQuery):
             "/stop - Stop the current session\n\n"
             "**URL Formats:**\n"
             "- Regular videos: `Filename : https://example.com/video.mp4`\n"
-            "- Encrypted videos: `Filename : https://example.com/video.mkv*decryption_key`\n\n"
+            "- Encrypted videos: `Filename : https://example.com/video.mkv*decryption_key`\n"
+            "- Batches: one `Filename : URL` per line, in a message or a .txt file\n\n"
             "**Features:**\n"
             "- High-quality video uploads with thumbnails\n"
             "- Real-time progress display\n"
@@ -654,7 +1259,95 @@ async def answer_callback(client: Client, callback_query: CallbackQuery):
     await callback_query.answer()
 
 
+async def resume_interrupted_jobs():
+    """Requeue jobs left unfinished by a restart or crash"""
+    jobs = await db.claim_interrupted_downloads(MAX_JOB_ATTEMPTS)
+    for job in jobs:
+        user_id = job["user_id"]
+        try:
+            message = await app.get_messages(job["chat_id"], job["message_id"])
+            if not message or message.empty:
+                raise ValueError("original message is gone")
+        except Exception as e:
+            logger.error(f"Cannot resume job {job['_id']}: {e}")
+            await track_download(job["_id"], "failed", error=f"Cannot resume: {e}")
+            continue
+
+        # Restore the session so the job is not treated as canceled
+        USER_STATES.setdefault(
+            user_id,
+            {
+                "state": "waiting_file_url",
+                "username": job.get("username"),
+                "batch_name": job.get("batch_name"),
+            },
+        )
+        # Keep its partial files until the job runs again
+        storage.pin(str(job["_id"]))
+        status_message = await message.reply_text(
+            f"♻️ Resuming interrupted download....\n\n📝 `{job['filename']}`",
+            parse_mode=ParseMode.MARKDOWN,
+            reply_markup=InlineKeyboardMarkup(
+                [[InlineKeyboardButton("❌ Cancel", callback_data="cancel_download")]]
+            ),
+        )
+        token = cancel_token(user_id)
+        scheduler.submit(
+            Job(
+                user_id,
+                lambda job=job, message=message, status_message=status_message, token=token: process_download(
+                    message,
+                    status_message,
+                    job["user_id"],
+                    token,
+                    job["filename"],
+                    job["url"],
+                    is_encrypted_url(job["url"]),
+                    job["_id"],
+                    job.get("file_path"),
+                ),
+            )
+        )
+
+    if jobs:
+        logger.info(f"Resumed {len(jobs)} interrupted jobs")
+
+
+def register_metrics():
+    """Export the stats() of every subsystem through the metrics endpoint and /stats"""
+    metrics.register("scheduler", scheduler.stats)
+    metrics.register("executors", executors.stats)
+    metrics.register("storage", storage.stats)
+    metrics.register("progress", progress_renderer.stats)
+    metrics.register("upload", app.upload_engine.stats)
+    metrics.register("remux", remuxer.stats)
+    metrics.register("http", http_client.stats)
+    metrics.register("info_cache", info_cache.stats)
+    metrics.register("thumbnails", thumbnail_service.stats)
+    metrics.register("metadata", metadata_service.cache.stats)
+    metrics.register("database", db.stats)
+
+
+async def main():
+    register_metrics()
+    await metrics.start()
+    await app.start()
+    progress_renderer.start()
+    await db.create_indexes()
+    db.start()
+    await resume_interrupted_jobs()
+    storage.start()
+    await idle()
+    await scheduler.stop()
+    await storage.stop()
+    await metrics.stop()
+    await progress_renderer.stop()
+    await db.close()
+    await app.stop()
+    executors.shutdown(wait=False)
+
+
 # Start the bot
 if __name__ == "__main__":
     logger.info("Starting URL Uploader Bot...")
-    app.run()
+    app.run(main())
@@ -15,10 +15,85 @@ AUTH_USERS = [int(user_id) for user_id in os.getenv("AUTH_USERS").split()]
 
 # Worker Configuration
 WORKERS = int(os.getenv("WORKERS", "6"))
+# Number of links of one batch downloaded in parallel
+BATCH_PARALLEL = int(os.getenv("BATCH_PARALLEL", "3"))
+# Interrupted jobs are given up after this many attempts
+MAX_JOB_ATTEMPTS = int(os.getenv("MAX_JOB_ATTEMPTS", "3"))
+# Queued jobs are held back while less than this is free in DOWNLOAD_DIR
+MIN_FREE_SPACE = int(os.getenv("MIN_FREE_SPACE_MB", "1024")) * 1024 * 1024
+# Threads for blocking network work (yt-dlp, HTTP transfers, thumbnail fetches)
+NETWORK_THREADS = int(os.getenv("NETWORK_THREADS", str(WORKERS * 2)))
+# Threads for CPU-bound work (decrypting, hashing)
+CPU_THREADS = int(os.getenv("CPU_THREADS", str(os.cpu_count() or 2)))
+# Threads for blocking file work (reading parts, copying, deleting and walking folders)
+DISK_THREADS = int(os.getenv("DISK_THREADS", "4"))
 
 # Database Configuration
 DATABASE_URL = os.getenv("DATABASE_URL")
+# Most connections the bot keeps open to MongoDB
+MONGO_POOL_SIZE = int(os.getenv("MONGO_POOL_SIZE", "20"))
+# Seconds between writes of buffered download status and progress updates
+DB_FLUSH_INTERVAL = float(os.getenv("DB_FLUSH_INTERVAL", "2"))
 
 # Download Configuration
 DOWNLOAD_DIR = "tmpvideos"
-os.makedirs(DOWNLOAD_DIR, exist_ok=True) 
+os.makedirs(DOWNLOAD_DIR, exist_ok=True)
+
+# Parallel HTTP connections for direct file downloads
+DOWNLOAD_CONNECTIONS = int(os.getenv("DOWNLOAD_CONNECTIONS", "8"))
+# Header-only encrypted sources AES-encrypt this many KiB at the start of the file
+ENCRYPTED_HEADER_SIZE = int(os.getenv("ENCRYPTED_HEADER_KB", "1024")) * 1024
+
+# Storage Configuration
+# Bytes running jobs may reserve in DOWNLOAD_DIR together, 0 leaves only the MIN_FREE_SPACE check
+DISK_QUOTA = int(os.getenv("DISK_QUOTA_MB", "0")) * 1024 * 1024
+# Seconds a job waits for disk space before it is refused
+RESERVE_TIMEOUT = int(os.getenv("RESERVE_TIMEOUT", "600"))
+# Leftover files no running job owns are deleted once untouched for this long
+STORAGE_TTL = int(os.getenv("STORAGE_TTL_HOURS", "6")) * 3600
+# Seconds between janitor sweeps of DOWNLOAD_DIR
+JANITOR_INTERVAL = int(os.getenv("JANITOR_INTERVAL", "600"))
+
+# HTTP Client Configuration
+# Keep-alive connections kept per host, should cover parallel range requests
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "32"))
+# Seconds a resolved hostname is reused
+DNS_CACHE_TTL = int(os.getenv("DNS_CACHE_TTL", "300"))
+
+# Uploaded files are re-sent by file_id for this long after their last reuse
+MEDIA_CACHE_TTL = int(os.getenv("MEDIA_CACHE_TTL_DAYS", "30")) * 24 * 3600
+
+# Metadata Cache Configuration
+METADATA_CACHE_SIZE = int(os.getenv("METADATA_CACHE_SIZE", "500"))
+# Seconds a resolved yt-dlp info dict is reused for the same URL
+INFO_CACHE_TTL = int(os.getenv("INFO_CACHE_TTL", "600"))
+
+# Upload Configuration
+# Files above this are split into parts before uploading (Telegram allows 2000 MiB for bots)
+SPLIT_SIZE = int(os.getenv("SPLIT_SIZE_MB", "2000")) * 1024 * 1024
+# Videos are stream-copied into MP4 with the index up front so Telegram can stream them
+REMUX_VIDEOS = os.getenv("REMUX_VIDEOS", "true").lower() == "true"
+# Documents with a known size are uploaded while they download
+STREAM_UPLOADS = os.getenv("STREAM_UPLOADS", "true").lower() == "true"
+# Upload parts held in memory between the download and the upload
+STREAM_UPLOAD_BUFFER = int(os.getenv("STREAM_UPLOAD_BUFFER", "8"))
+# Parts of one file sent at the same time, spread over UPLOAD_SESSIONS media connections
+UPLOAD_WORKERS = int(os.getenv("UPLOAD_WORKERS", "8"))
+UPLOAD_SESSIONS = int(os.getenv("UPLOAD_SESSIONS", "2"))
+# Part size in KiB, a power of two up to 512
+UPLOAD_PART_SIZE = int(os.getenv("UPLOAD_PART_SIZE_KB", "512")) * 1024
+
+# Format Selection Configuration
+# Largest yt-dlp format picked for a single link, 0 leaves only the SPLIT_SIZE limit
+FORMAT_SIZE_CAP = int(os.getenv("FORMAT_SIZE_CAP_MB", "0")) * 1024 * 1024
+# Formats picked for the links of one batch stay under this together, 0 for no limit
+BATCH_SIZE_CAP = int(os.getenv("BATCH_SIZE_CAP_MB", "0")) * 1024 * 1024
+
+# Progress Message Configuration
+# Status message edits per second across all chats
+PROGRESS_EDIT_BUDGET = float(os.getenv("PROGRESS_EDIT_BUDGET", "10"))
+
+# Metrics Configuration
+# Prometheus metrics are served here (the Dockerfile exposes 8080), a port of 0 turns them off
+METRICS_HOST = os.getenv("METRICS_HOST", "0.0.0.0")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "8080"))
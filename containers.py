@@ -0,0 +1,254 @@
+import struct
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+# read(offset, size) returns the bytes of a file at offset, fewer at its end
+Reader = Callable[[int, int], bytes]
+
+# Box types a MP4/MOV file starts with
+MP4_BOXES = (b"ftyp", b"styp", b"moov", b"mdat", b"free", b"skip", b"wide")
+MKV_MAGIC = b"\x1a\x45\xdf\xa3"
+# Largest moov read into memory to look at the sample tables
+MAX_MOOV_SIZE = 64 * 1024 * 1024
+# Codecs whose samples are length-prefixed NAL units, with the config box holding the prefix length
+NAL_CODECS = {b"avc1": b"avcC", b"avc3": b"avcC", b"hvc1": b"hvcC", b"hev1": b"hvcC"}
+# Top-level elements of a Matroska segment
+MKV_LEVEL1 = {0x114D9B74, 0x1549A966, 0x1654AE6B, 0x1F43B675, 0x1C53BB6B, 0x1043A770, 0x1254C367, 0x1941A469, 0xEC, 0xBF}
+MKV_EBML, MKV_SEGMENT = 0x1A45DFA3, 0x18538067
+# Void and CRC-32 elements
+MKV_PADDING = {0xEC, 0xBF}
+TS_PACKET = 188
+# Packets whose sync bytes are checked past the boundary
+TS_CHECKED_PACKETS = 8
+
+
+def box_header(data: bytes, size: int, offset: int) -> Optional[Tuple[int, bytes, int]]:
+    """(box size, type, header length) of the box at the start of data, None if it can't be one"""
+    if len(data) < 8:
+        return None
+    box_size, kind = struct.unpack(">I4s", data[:8])
+    header = 8
+    if box_size == 1:
+        if len(data) < 16:
+            return None
+        box_size, header = struct.unpack(">Q", data[8:16])[0], 16
+    elif box_size == 0:
+        box_size = size - offset
+    if box_size < header or offset + box_size > size:
+        return None
+    # Box types are printable, apart from the (c) of iTunes metadata
+    if not all(32 <= c < 127 or c == 0xA9 for c in kind):
+        return None
+    return box_size, kind, header
+
+
+def iter_boxes(data: bytes, start: int = 0, end: Optional[int] = None) -> Iterator[Tuple[bytes, int, int]]:
+    """(type, payload start, payload end) of the boxes in data[start:end]"""
+    end = len(data) if end is None else end
+    while start < end:
+        parsed = box_header(data[start:start + 16], end, start)
+        if parsed is None:
+            return
+        box_size, kind, header = parsed
+        yield kind, start + header, start + box_size
+        start += box_size
+
+
+def find_box(data: bytes, path: List[bytes], start: int = 0, end: Optional[int] = None) -> Optional[Tuple[int, int]]:
+    """Payload range of the first box along path, e.g. [b"mdia", b"hdlr"]"""
+    for kind, payload, box_end in iter_boxes(data, start, end):
+        if kind == path[0]:
+            return (payload, box_end) if len(path) == 1 else find_box(data, path[1:], payload, box_end)
+    return None
+
+
+def video_sample(moov: bytes, boundary: int) -> Optional[Tuple[int, int, int]]:
+    """(offset, size, NAL length size) of the first sample of a chunk at or past boundary
+
+    Only video tracks whose samples are length-prefixed NAL units are
+    looked at, their layout can be checked without decoding anything.
+    """
+    for kind, trak, trak_end in iter_boxes(moov):
+        if kind != b"trak":
+            continue
+        hdlr = find_box(moov, [b"mdia", b"hdlr"], trak, trak_end)
+        stbl = find_box(moov, [b"mdia", b"minf", b"stbl"], trak, trak_end)
+        if not hdlr or not stbl or moov[hdlr[0] + 8:hdlr[0] + 12] != b"vide":
+            continue
+        stsd = find_box(moov, [b"stsd"], *stbl)
+        # The sample entry follows the 8 bytes of version, flags and entry count
+        entry = box_header(moov[stsd[0] + 8:stsd[0] + 24], stsd[1], stsd[0] + 8) if stsd else None
+        if entry is None or entry[1] not in NAL_CODECS:
+            continue
+        # Child boxes of a visual sample entry start after 78 bytes of fields
+        entry_start = stsd[0] + 8
+        config = find_box(moov, [NAL_CODECS[entry[1]]], entry_start + entry[2] + 78, entry_start + entry[0])
+        if config is None:
+            continue
+        length_byte = config[0] + (4 if entry[1] in (b"avc1", b"avc3") else 21)
+        length_size = (moov[length_byte] & 3) + 1
+
+        chunks = table(moov, find_box(moov, [b"stco"], *stbl), 4) or table(moov, find_box(moov, [b"co64"], *stbl), 8)
+        stsc = find_box(moov, [b"stsc"], *stbl)
+        stsz = find_box(moov, [b"stsz"], *stbl)
+        if not chunks or not stsc or not stsz:
+            continue
+        chunk = next((i for i, offset in enumerate(chunks) if offset >= boundary), None)
+        if chunk is None:
+            continue
+
+        # Samples before the chunk, from the runs of chunks with the same sample count
+        count = struct.unpack(">I", moov[stsc[0] + 4:stsc[0] + 8])[0]
+        runs = [struct.unpack(">II", moov[p:p + 8]) for p in range(stsc[0] + 8, stsc[0] + 8 + count * 12, 12)]
+        target = chunk + 1  # stsc counts chunks from 1
+        sample = 0
+        for i, (first, per_chunk) in enumerate(runs):
+            next_first = runs[i + 1][0] if i + 1 < len(runs) else len(chunks) + 1
+            sample += per_chunk * max(0, min(next_first, target) - first)
+        fixed_size, count = struct.unpack(">II", moov[stsz[0] + 4:stsz[0] + 12])
+        if fixed_size:
+            size = fixed_size
+        elif sample < count:
+            size = struct.unpack(">I", moov[stsz[0] + 12 + sample * 4:stsz[0] + 16 + sample * 4])[0]
+        else:
+            continue
+        return chunks[chunk], size, length_size
+    return None
+
+
+def table(moov: bytes, box: Optional[Tuple[int, int]], width: int) -> List[int]:
+    """Entries of a stco (4 byte) or co64 (8 byte) chunk offset table"""
+    if box is None:
+        return []
+    count = struct.unpack(">I", moov[box[0] + 4:box[0] + 8])[0]
+    data = moov[box[0] + 8:box[0] + 8 + count * width]
+    return list(struct.unpack(f">{len(data) // width}{'I' if width == 4 else 'Q'}", data))
+
+
+def check_nal_units(read: Reader, offset: int, size: int, length_size: int) -> bool:
+    """Whether a sample is a chain of length-prefixed NAL units filling it exactly"""
+    end = offset + size
+    while offset < end:
+        data = read(offset, length_size + 1)
+        if len(data) < length_size + 1:
+            return False
+        length = int.from_bytes(data[:length_size], "big")
+        # The forbidden_zero_bit of the NAL header
+        if not length or data[length_size] & 0x80:
+            return False
+        offset += length_size + length
+    return offset == end
+
+
+def check_mp4(read: Reader, size: int, boundary: int) -> Optional[bool]:
+    offset, moov, past = 0, None, False
+    while offset < size:
+        parsed = box_header(read(offset, 16), size, offset)
+        if parsed is None:
+            return False
+        box_size, kind, header = parsed
+        past = past or offset >= boundary
+        if kind == b"moov":
+            moov = (offset + header, box_size - header)
+        offset += box_size
+    if past:
+        # Boxes past the boundary that end exactly with the file
+        return True
+
+    # Every box starts before the boundary, look inside the media data instead
+    if moov is None or moov[1] > MAX_MOOV_SIZE:
+        return None
+    sample = video_sample(read(*moov), boundary)
+    if sample is None:
+        return None
+    return check_nal_units(read, *sample)
+
+
+def read_vint(data: bytes, pos: int, marker: bool) -> Optional[Tuple[int, int]]:
+    """(value, length) of an EBML variable-length integer, -1 for an unknown size"""
+    if pos >= len(data) or not data[pos]:
+        return None
+    length = 9 - data[pos].bit_length()
+    if pos + length > len(data):
+        return None
+    value = int.from_bytes(data[pos:pos + length], "big")
+    if not marker:
+        value &= (1 << (7 * length)) - 1
+        if value == (1 << (7 * length)) - 1:
+            value = -1
+    return value, length
+
+
+def element_at(read: Reader, pos: int) -> Optional[Tuple[int, int, int]]:
+    """(ID, header length, data size) of the EBML element at pos"""
+    data = read(pos, 12)
+    element = read_vint(data, 0, True)
+    length = read_vint(data, element[1], False) if element else None
+    if length is None:
+        return None
+    return element[0], element[1] + length[1], length[0]
+
+
+def check_mkv(read: Reader, size: int, boundary: int) -> Optional[bool]:
+    header = element_at(read, 0)
+    if header is None or header[0] != MKV_EBML:
+        return False
+    segment = element_at(read, header[1] + header[2])
+    if segment is None or segment[0] != MKV_SEGMENT:
+        return False
+
+    pos = header[1] + header[2] + segment[1]
+    while pos < size:
+        element = element_at(read, pos)
+        if element is None or element[0] not in MKV_LEVEL1:
+            return False
+        if element[2] >= 0 and pos + element[1] + element[2] > size:
+            return False
+        # One byte IDs match random data too often to count
+        if pos >= boundary and element[0] not in MKV_PADDING:
+            return True
+        if element[2] < 0:
+            # A live stream's cluster of unknown size
+            return None
+        pos += element[1] + element[2]
+    return None if pos == size else False
+
+
+def check_ts(read: Reader, size: int, boundary: int) -> Optional[bool]:
+    start = -(-boundary // TS_PACKET) * TS_PACKET
+    data = read(start, TS_PACKET * TS_CHECKED_PACKETS)
+    if not data:
+        return None
+    return all(data[i] == 0x47 for i in range(0, len(data), TS_PACKET))
+
+
+# Container checks by the signature the file starts with
+CHECKS: Dict[str, Callable[[Reader, int, int], Optional[bool]]] = {
+    "mp4": check_mp4,
+    "mkv": check_mkv,
+    "ts": check_ts,
+}
+
+
+def container_of(head: bytes) -> Optional[str]:
+    if head[4:8] in MP4_BOXES:
+        return "mp4"
+    if head.startswith(MKV_MAGIC):
+        return "mkv"
+    if head[:1] == b"\x47":
+        return "ts"
+    return None
+
+
+def holds_past(read: Reader, size: int, boundary: int) -> Optional[bool]:
+    """Whether the file still parses as its container past boundary
+
+    None when its container can't be checked or nothing in it starts past
+    the boundary.
+    """
+    check = CHECKS.get(container_of(read(0, 16)))
+    if check is None:
+        return None
+    try:
+        return check(read, size, boundary)
+    except (struct.error, IndexError):
+        return False
@@ -1,13 +1,120 @@
 import time
+import asyncio
+import hashlib
+import logging
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Tuple
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
 from motor.motor_asyncio import AsyncIOMotorClient
-from config import DATABASE_URL
+from pymongo import UpdateOne
+from config import DATABASE_URL, MEDIA_CACHE_TTL, MONGO_POOL_SIZE, DB_FLUSH_INTERVAL
+
+logger = logging.getLogger("URLUploader")
+
+# Download states that still have work left
+ACTIVE_STATUSES = ["pending", "downloading", "uploading"]
+# Status changes that are written right away instead of waiting for the next flush
+FINAL_STATUSES = ["done", "failed", "canceled"]
+# Seconds a get_user result is served from memory
+USER_CACHE_TTL = 300
+
+
+def media_key(url: str) -> str:
+    """Cache key of a link: its normalized URL plus the decryption key, if any"""
+    url, _, key = url.strip().partition("*")
+    parts = urlsplit(url)
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or "").lower()
+    if parts.port and (scheme, parts.port) not in (("http", 80), ("https", 443)):
+        host = f"{host}:{parts.port}"
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+    normalized = urlunsplit((scheme, host, parts.path or "/", query, ""))
+    return hashlib.sha1(f"{normalized}*{key}".encode("utf-8")).hexdigest()
+
+
+def merge_update(target: dict, update: dict):
+    """Fold a newer update document into an older one for the same record"""
+    for operator, fields in update.items():
+        merged = target.setdefault(operator, {})
+        if operator == "$inc":
+            for field, value in fields.items():
+                merged[field] = merged.get(field, 0) + value
+        else:
+            merged.update(fields)
+
 
 class Database:
     def __init__(self):
-        self.client = AsyncIOMotorClient(DATABASE_URL, serverSelectionTimeoutMS=5000)
+        self.client = AsyncIOMotorClient(
+            DATABASE_URL,
+            serverSelectionTimeoutMS=5000,
+            maxPoolSize=MONGO_POOL_SIZE,
+            minPoolSize=min(2, MONGO_POOL_SIZE),
+            maxIdleTimeMS=60000,
+        )
         self.db = self.client.url_uploader
         self.users = self.db.users
         self.downloads = self.db.downloads
+        self.media_cache = self.db.media_cache
+        # Write-behind buffer of download updates, one merged update per record
+        self.pending_updates = {}
+        # One flush at a time, an older batch must not land after a newer one
+        self.flush_lock = asyncio.Lock()
+        self.flush_task = None
+        self.flushes = 0
+        self.coalesced = 0
+        self.user_cache = {}
+
+    def start(self):
+        """Start flushing buffered writes on the running event loop"""
+        if self.flush_task is None:
+            self.flush_task = asyncio.get_running_loop().create_task(self._flush_loop())
+
+    async def close(self):
+        if self.flush_task:
+            self.flush_task.cancel()
+            await asyncio.gather(self.flush_task, return_exceptions=True)
+            self.flush_task = None
+        await self.flush()
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(DB_FLUSH_INTERVAL)
+            await self.flush()
+
+    def _buffer_update(self, download_id, update: dict):
+        pending = self.pending_updates.get(download_id)
+        if pending is None:
+            self.pending_updates[download_id] = update
+        else:
+            merge_update(pending, update)
+            self.coalesced += 1
+
+    async def flush(self):
+        """Write every buffered download update in one bulk_write"""
+        async with self.flush_lock:
+            return await self._flush()
+
+    async def _flush(self):
+        if not self.pending_updates:
+            return True
+        batch, self.pending_updates = self.pending_updates, {}
+        try:
+            await self.downloads.bulk_write(
+                [UpdateOne({"_id": download_id}, update) for download_id, update in batch.items()],
+                ordered=False
+            )
+            self.flushes += 1
+            return True
+        except Exception as e:
+            logger.error(f"Database error in flush ({len(batch)} updates): {e}")
+            # Keep them for the next flush, under anything newer that came in meanwhile
+            for download_id, update in batch.items():
+                newer = self.pending_updates.get(download_id)
+                if newer is not None:
+                    merge_update(update, newer)
+                self.pending_updates[download_id] = update
+            return False
 
     async def add_user(self, user_id: int, username: str, batch_name: str):
         try:
@@ -16,41 +123,167 @@ class Database:
                 {"$set": {"username": username, "batch_name": batch_name}},
                 upsert=True
             )
+            # Dropped after the write, a get_user in between would cache the old record again
+            self.user_cache.pop(user_id, None)
             return True
         except Exception as e:
-            print(f"Database error in add_user: {e}")
+            logger.error(f"Database error in add_user: {e}")
             return False
 
     async def get_user(self, user_id: int):
+        cached = self.user_cache.get(user_id)
+        if cached and cached[0] > time.monotonic():
+            return cached[1]
         try:
-            return await self.users.find_one({"user_id": user_id})
+            user = await self.users.find_one({"user_id": user_id})
+            self.user_cache[user_id] = (time.monotonic() + USER_CACHE_TTL, user)
+            return user
         except Exception as e:
-            print(f"Database error in get_user: {e}")
+            logger.error(f"Database error in get_user: {e}")
             return None
 
-    async def add_download(self, user_id: int, filename: str, url: str):
+    async def create_indexes(self):
         try:
-            return await self.downloads.insert_one({
-                "user_id": user_id,
-                "filename": filename,
-                "url": url,
-                "status": "pending",
-                "timestamp": time.time()
-            })
+            await self.users.create_index("user_id", unique=True)
+            await self.downloads.create_index([("status", 1), ("timestamp", 1)])
+            await self.downloads.create_index([("user_id", 1), ("status", 1)])
+            # Cached uploads expire when they haven't been reused for MEDIA_CACHE_TTL
+            await self.media_cache.create_index("last_used", expireAfterSeconds=MEDIA_CACHE_TTL)
+            return True
         except Exception as e:
-            print(f"Database error in add_download: {e}")
+            logger.error(f"Database error in create_indexes: {e}")
+            return False
+
+    @staticmethod
+    def _new_download(user_id: int, filename: str, url: str, **fields) -> Dict[str, Any]:
+        now = time.time()
+        return {
+            "user_id": user_id,
+            "filename": filename,
+            "url": url,
+            "status": "pending",
+            "bytes_done": 0,
+            "total_bytes": 0,
+            "temp_path": None,
+            "file_path": None,
+            "attempts": 0,
+            "timestamp": now,
+            "updated_at": now,
+            **fields,
+        }
+
+    async def add_download(self, user_id: int, filename: str, url: str, **fields):
+        try:
+            return await self.downloads.insert_one(self._new_download(user_id, filename, url, **fields))
+        except Exception as e:
+            logger.error(f"Database error in add_download: {e}")
             return None
 
-    async def update_download_status(self, download_id, status: str):
+    async def add_downloads(self, user_id: int, links: List[Tuple[str, str, Dict[str, Any]]], **fields):
+        """Insert the records of several (filename, url, own fields) links in one round trip"""
         try:
-            await self.downloads.update_one(
-                {"_id": download_id},
-                {"$set": {"status": status, "updated_at": time.time()}}
+            return await self.downloads.insert_many([
+                self._new_download(user_id, filename, url, **fields, **own) for filename, url, own in links
+            ])
+        except Exception as e:
+            logger.error(f"Database error in add_downloads: {e}")
+            return None
+
+    async def update_download_status(self, download_id, status: str, **fields):
+        """Buffer a status change, final states are written right away"""
+        self._buffer_update(download_id, {"$set": {"status": status, "updated_at": time.time(), **fields}})
+        if status in FINAL_STATUSES:
+            # A finished job must not be resumed after a crash
+            return await self.flush()
+        return True
+
+    async def start_download_attempt(self, download_id, **fields):
+        """Count an attempt, written right away so a job that crashes the bot still runs out of attempts"""
+        self._buffer_update(download_id, {
+            "$set": {"status": "downloading", "updated_at": time.time(), **fields},
+            "$inc": {"attempts": 1},
+        })
+        return await self.flush()
+
+    async def update_download_progress(self, download_id, bytes_done: int, total_bytes: int):
+        self._buffer_update(
+            download_id,
+            {"$set": {"bytes_done": bytes_done, "total_bytes": total_bytes, "updated_at": time.time()}}
+        )
+        return True
+
+    async def cancel_user_downloads(self, user_id: int):
+        try:
+            # Buffered updates, and a flush already on its way, must not land after (and undo) the cancel
+            async with self.flush_lock:
+                await self._flush()
+                await self.downloads.update_many(
+                    {"user_id": user_id, "status": {"$in": ACTIVE_STATUSES}},
+                    {"$set": {"status": "canceled", "updated_at": time.time()}}
+                )
+            return True
+        except Exception as e:
+            logger.error(f"Database error in cancel_user_downloads: {e}")
+            return False
+
+    async def claim_interrupted_downloads(self, max_attempts: int):
+        """Return jobs left unfinished by a restart or crash, oldest first"""
+        try:
+            await self.flush()
+            # Give up on jobs that keep failing
+            await self.downloads.update_many(
+                {"status": {"$in": ACTIVE_STATUSES}, "attempts": {"$gte": max_attempts}},
+                {"$set": {"status": "failed", "error": "Too many attempts", "updated_at": time.time()}}
+            )
+            cursor = self.downloads.find({"status": {"$in": ACTIVE_STATUSES}}).sort("timestamp", 1)
+            return await cursor.to_list(length=None)
+        except Exception as e:
+            logger.error(f"Database error in claim_interrupted_downloads: {e}")
+            return []
+
+    async def get_cached_media(self, key: str):
+        """Return a previous upload of the same link and mark it as used"""
+        try:
+            return await self.media_cache.find_one_and_update(
+                {"_id": key},
+                {"$set": {"last_used": datetime.now(timezone.utc)}, "$inc": {"hits": 1}}
+            )
+        except Exception as e:
+            logger.error(f"Database error in get_cached_media: {e}")
+            return None
+
+    async def cache_media(self, key: str, url: str, file_id: str, kind: str, **fields):
+        """Remember the Telegram file_id an upload of this link produced"""
+        try:
+            now = datetime.now(timezone.utc)
+            await self.media_cache.update_one(
+                {"_id": key},
+                {
+                    "$set": {"url": url, "file_id": file_id, "kind": kind, "last_used": now, **fields},
+                    "$setOnInsert": {"created_at": now, "hits": 0},
+                },
+                upsert=True
             )
             return True
         except Exception as e:
-            print(f"Database error in update_download_status: {e}")
+            logger.error(f"Database error in cache_media: {e}")
             return False
 
+    async def invalidate_cached_media(self, key: str):
+        try:
+            await self.media_cache.delete_one({"_id": key})
+            return True
+        except Exception as e:
+            logger.error(f"Database error in invalidate_cached_media: {e}")
+            return False
+
+    def stats(self):
+        return {
+            "pending_updates": len(self.pending_updates),
+            "flushes": self.flushes,
+            "coalesced": self.coalesced,
+            "cached_users": len(self.user_cache),
+        }
+
 # Create a single instance
 db = Database() 
\ No newline at end of file
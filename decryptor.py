@@ -0,0 +1,449 @@
+import os
+import mmap
+import time
+import logging
+import queue
+import threading
+from typing import Optional, Tuple
+from Crypto.Cipher import AES
+from Crypto.Util.Padding import unpad
+from config import ENCRYPTED_HEADER_SIZE
+from containers import MP4_BOXES, MKV_MAGIC, Reader, holds_past
+from executors import executors
+
+logger = logging.getLogger("URLUploader")
+
+# Chunk size for streaming decryption (must be a multiple of the AES block size)
+DECRYPT_CHUNK_SIZE = 4 * 1024 * 1024
+# Maximum number of ciphertext chunks buffered between fetcher and decryptor
+PIPELINE_QUEUE_SIZE = 8
+# Bytes trial-decrypted to find the scheme, enough for an MPEG-TS sync byte in the second packet
+DETECT_SIZE = 192
+# Bytes at the start of the file that XOR-prefix sources scramble
+XOR_PREFIX_SIZE = 28
+# Files being decrypted in place carry this suffix, one left behind is half plaintext
+DECRYPTING_SUFFIX = ".decrypting"
+
+# Signatures of the other containers we download
+MAGIC_BYTES = (MKV_MAGIC, b"FLV", b"RIFF", b"OggS", b"ID3", b"\x00\x00\x01\xba")
+
+
+class SchemeUndecided(ValueError):
+    """The file can't tell whether only its header or all of it is encrypted"""
+
+
+def derive_key_iv(key: str) -> Tuple[bytes, bytes]:
+    """Derive the AES key and IV from the user supplied key string"""
+    # Use first 16 bytes as key and iv
+    raw_key = key.encode('utf-8')[:16].ljust(16, b'\0')
+    return raw_key, raw_key
+
+
+def looks_like_media(head: bytes) -> bool:
+    """Whether the first bytes of a file carry the signature of a known container"""
+    if head[4:8] in MP4_BOXES or head.startswith(MAGIC_BYTES):
+        return True
+    # MPEG-TS packets are 188 bytes, each starting with a sync byte
+    return head[:1] == b"\x47" and head[188:189] in (b"", b"\x47")
+
+
+def cbc_head(key: str, head: bytes) -> bytes:
+    """Trial-decrypt the first bytes of a file as the start of an AES-CBC stream"""
+    key_16, iv = derive_key_iv(key)
+    head = head[:DETECT_SIZE]
+    return AES.new(key_16, AES.MODE_CBC, iv).decrypt(head[:len(head) - len(head) % AES.block_size])
+
+
+def padding_length(key: str, read: Reader, size: int) -> Optional[int]:
+    """Bytes of PKCS7 padding a full-file CBC stream of this size ends in, None if it doesn't"""
+    key_16, iv = derive_key_iv(key)
+    # CBC only needs the previous ciphertext block as IV
+    if size > AES.block_size:
+        iv = read(size - 2 * AES.block_size, AES.block_size)
+    last_block = AES.new(key_16, AES.MODE_CBC, iv).decrypt(read(size - AES.block_size, AES.block_size))
+    try:
+        return AES.block_size - len(unpad(last_block, AES.block_size))
+    except ValueError:
+        return None
+
+
+def plaintext_reader(key: str, read: Reader, encrypted: int) -> Reader:
+    """Reader of the plaintext of a file whose first `encrypted` bytes are one CBC stream"""
+    key_16, iv = derive_key_iv(key)
+
+    def read_plain(offset: int, size: int) -> bytes:
+        end = offset + size
+        plain = b""
+        if offset < encrypted:
+            start = offset - offset % AES.block_size
+            stop = min(end + -end % AES.block_size, encrypted)
+            if start:
+                data = read(start - AES.block_size, stop - start + AES.block_size)
+                block_iv, data = data[:AES.block_size], data[AES.block_size:]
+            else:
+                block_iv, data = iv, read(0, stop)
+            data = data[:len(data) - len(data) % AES.block_size]
+            plain = AES.new(key_16, AES.MODE_CBC, block_iv).decrypt(data)[offset - start:end - start]
+        if end > encrypted:
+            plain += read(max(offset, encrypted), end - max(offset, encrypted))
+        return plain
+
+    return read_plain
+
+
+def header_only(key: str, size: int, read: Optional[Reader], header_size: int = ENCRYPTED_HEADER_SIZE) -> bool:
+    """Tell header-only encryption from a full-file CBC stream, the first block decrypts the same in both
+
+    A full stream is block aligned and ends in valid padding. Past that,
+    the file must still parse as its container past the header when read as
+    plaintext there or when decrypted, and only one of the two may hold up.
+    SchemeUndecided is raised rather than guessing.
+    """
+    if size % AES.block_size:
+        return True
+    if not size or read is None:
+        raise SchemeUndecided("Cannot tell the encryption scheme without reading the whole file")
+    padding = padding_length(key, read, size)
+    if padding is None:
+        return True
+    boundary = header_size - header_size % AES.block_size
+    if size <= boundary:
+        # Both decrypt the whole file, and the padding is valid either way
+        return False
+
+    # None means nothing past the boundary could be checked, only False rules a reading out
+    full = holds_past(plaintext_reader(key, read, size), size - padding, boundary) is not False
+    header = holds_past(plaintext_reader(key, read, boundary), size, boundary) is not False
+    if full != header:
+        return header
+    raise SchemeUndecided(
+        f"Cannot tell whether the first {boundary} bytes or the whole file is encrypted"
+    )
+
+
+class StreamDecryptor:
+    """Incremental AES-CBC decryptor that works on block-aligned chunks"""
+    def __init__(self, key: str):
+        key_16, iv = derive_key_iv(key)
+        # The cipher object carries the CBC chaining state between calls
+        self.cipher = AES.new(key_16, AES.MODE_CBC, iv)
+        self.pending = b""
+
+    def update(self, data: bytes) -> bytes:
+        """Decrypt the next chunk, holding back the last block for unpadding"""
+        if self.pending:
+            data = self.pending + bytes(data)
+        view = memoryview(data)
+
+        # Keep any partial block plus the final full block: the latter may
+        # carry the PKCS7 padding and is only decrypted in finalize()
+        cut = max(len(view) - (len(view) % AES.block_size or AES.block_size), 0)
+        self.pending = bytes(view[cut:])
+        if not cut:
+            return b""
+        return self.cipher.decrypt(view[:cut])
+
+    def finalize(self) -> bytes:
+        """Decrypt the held back block and strip the PKCS7 padding"""
+        if len(self.pending) != AES.block_size:
+            raise ValueError("Ciphertext length is not a multiple of the AES block size")
+        last_block, self.pending = self.pending, b""
+        return unpad(self.cipher.decrypt(last_block), AES.block_size)
+
+
+class HeaderDecryptor:
+    """Incremental decryptor for files whose first `size` bytes are AES-CBC, the rest passes through"""
+    def __init__(self, key: str, size: int):
+        key_16, iv = derive_key_iv(key)
+        self.cipher = AES.new(key_16, AES.MODE_CBC, iv)
+        self.remaining = size - size % AES.block_size
+        self.pending = b""
+
+    def update(self, data: bytes) -> bytes:
+        if not self.remaining:
+            return data
+        if self.pending:
+            data, self.pending = self.pending + bytes(data), b""
+        view = memoryview(data)
+
+        head = min(self.remaining, len(view))
+        cut = head - head % AES.block_size
+        self.remaining -= cut
+        plain = self.cipher.decrypt(view[:cut]) if cut else b""
+        if self.remaining:
+            # Still inside the header, a partial block waits for the next chunk
+            self.pending = bytes(view[cut:])
+            return plain
+        return plain + bytes(view[cut:])
+
+    def finalize(self) -> bytes:
+        """The file ended inside the header, a trailing partial block is left as it is"""
+        pending, self.pending = self.pending, b""
+        return pending
+
+
+class XorPrefixDecryptor:
+    """Incremental decryptor for files whose first XOR_PREFIX_SIZE bytes are XORed with the key"""
+    def __init__(self, key: str):
+        raw_key = key.encode("utf-8")
+        # Past the end of the key each byte is XORed with its own offset
+        self.mask = bytes(raw_key[i] if i < len(raw_key) else i for i in range(XOR_PREFIX_SIZE))
+        self.offset = 0
+
+    def update(self, data: bytes) -> bytes:
+        if self.offset >= len(self.mask):
+            return data
+        head = bytearray(data[:len(self.mask) - self.offset])
+        for i in range(len(head)):
+            head[i] ^= self.mask[self.offset + i]
+        self.offset += len(head)
+        return bytes(head) + bytes(data[len(head):])
+
+    def finalize(self) -> bytes:
+        return b""
+
+
+class CBCScheme:
+    """The whole file is one AES-CBC stream with PKCS7 padding"""
+    name = "cbc"
+
+    def __init__(self, key: str):
+        self.key = key
+
+    def decryptor(self) -> StreamDecryptor:
+        return StreamDecryptor(self.key)
+
+    def decrypt_in_place(self, view: memoryview, chunk_size: int) -> int:
+        """Decrypt a writable buffer holding the whole file, returns the plaintext size"""
+        size = len(view)
+        if size % AES.block_size:
+            raise ValueError("Ciphertext length is not a multiple of the AES block size")
+        key_16, iv = derive_key_iv(self.key)
+        cipher = AES.new(key_16, AES.MODE_CBC, iv)
+        for offset in range(0, size, chunk_size):
+            cipher.decrypt(view[offset:offset + chunk_size], output=view[offset:offset + chunk_size])
+        return size - AES.block_size + len(unpad(bytes(view[size - AES.block_size:]), AES.block_size))
+
+
+class HeaderScheme:
+    """Only the first ENCRYPTED_HEADER_SIZE bytes are AES-CBC encrypted, without padding"""
+    name = "header"
+
+    def __init__(self, key: str, size: int = ENCRYPTED_HEADER_SIZE):
+        self.key = key
+        self.size = size
+
+    def decryptor(self) -> HeaderDecryptor:
+        return HeaderDecryptor(self.key, self.size)
+
+    def decrypt_in_place(self, view: memoryview, chunk_size: int) -> int:
+        end = min(self.size, len(view))
+        end -= end % AES.block_size
+        key_16, iv = derive_key_iv(self.key)
+        cipher = AES.new(key_16, AES.MODE_CBC, iv)
+        for offset in range(0, end, chunk_size):
+            chunk_end = min(offset + chunk_size, end)
+            cipher.decrypt(view[offset:chunk_end], output=view[offset:chunk_end])
+        return len(view)
+
+
+class XorPrefixScheme:
+    """The first XOR_PREFIX_SIZE bytes are XORed with the key, the rest is plain"""
+    name = "xor"
+
+    def __init__(self, key: str):
+        self.key = key
+
+    @staticmethod
+    def matches(key: str, head: bytes) -> bool:
+        return looks_like_media(XorPrefixDecryptor(key).update(head[:DETECT_SIZE]))
+
+    def decryptor(self) -> XorPrefixDecryptor:
+        return XorPrefixDecryptor(self.key)
+
+    def decrypt_in_place(self, view: memoryview, chunk_size: int) -> int:
+        mask = XorPrefixDecryptor(self.key).mask
+        for i in range(min(len(mask), len(view))):
+            view[i] ^= mask[i]
+        return len(view)
+
+
+def detect_scheme(key: str, head: bytes, size: int = 0, read: Optional[Reader] = None):
+    """Pick the scheme whose trial decryption of the first bytes gives a known container
+
+    size and read(offset, size), which returns raw bytes of the encrypted
+    file, are needed to tell header-only encryption from a full-file CBC
+    stream, see header_only().
+    """
+    if XorPrefixScheme.matches(key, head):
+        scheme = XorPrefixScheme(key)
+    elif not looks_like_media(cbc_head(key, head)):
+        logger.warning("No known container after trial decryption, assuming full-file CBC")
+        return CBCScheme(key)
+    elif header_only(key, size, read):
+        scheme = HeaderScheme(key)
+    else:
+        scheme = CBCScheme(key)
+    logger.info(f"Detected {scheme.name} encryption")
+    return scheme
+
+
+def decrypt_bytes(data: bytes, key: str) -> bytes:
+    """Decrypt a complete in-memory buffer in one go"""
+    read = lambda offset, size: data[offset:offset + size]
+    decryptor = detect_scheme(key, data[:DETECT_SIZE], len(data), read).decryptor()
+    return decryptor.update(data) + decryptor.finalize()
+
+
+def decrypt_file(src_path: str, dst_path: str, key: str, chunk_size: int = DECRYPT_CHUNK_SIZE) -> int:
+    """Decrypt src_path into dst_path chunk by chunk, returns plaintext size"""
+    if chunk_size <= 0 or chunk_size % AES.block_size:
+        raise ValueError(f"Chunk size must be a positive multiple of {AES.block_size}")
+
+    written = 0
+    with open(src_path, "rb") as src, open(dst_path, "wb") as dst:
+        size = os.fstat(src.fileno()).st_size
+        read = lambda offset, length: os.pread(src.fileno(), length, offset)
+        decryptor = detect_scheme(key, read(0, DETECT_SIZE), size, read).decryptor()
+        while True:
+            chunk = src.read(chunk_size)
+            if not chunk:
+                break
+            plain = decryptor.update(chunk)
+            dst.write(plain)
+            written += len(plain)
+
+        plain = decryptor.finalize()
+        dst.write(plain)
+        written += len(plain)
+
+    logger.info(f"Decrypted {src_path} -> {dst_path} ({written} bytes)")
+    return written
+
+
+def decrypt_file_in_place(src_path: str, dst_path: str, key: str, chunk_size: int = DECRYPT_CHUNK_SIZE) -> int:
+    """Decrypt src_path inside its own pages, then strip the padding and rename it to dst_path
+
+    The file is memory-mapped and the encrypted ranges are decrypted into
+    the buffer they were read from, so there is no second file and no
+    plaintext copy, and partially encrypted files only touch their head.
+    The ciphertext is gone afterwards, even when decryption fails halfway,
+    so the file is renamed with DECRYPTING_SUFFIX first: a crash leaves a
+    file nobody mistakes for either the ciphertext or the result.
+    """
+    if chunk_size <= 0 or chunk_size % AES.block_size:
+        raise ValueError(f"Chunk size must be a positive multiple of {AES.block_size}")
+
+    work_path = src_path + DECRYPTING_SUFFIX
+    os.replace(src_path, work_path)
+    with open(work_path, "r+b") as f:
+        size = os.fstat(f.fileno()).st_size
+        if not size:
+            raise ValueError("Nothing to decrypt, the file is empty")
+
+        with mmap.mmap(f.fileno(), size) as mapped:
+            with memoryview(mapped) as view:
+                read = lambda offset, length: bytes(view[offset:offset + length])
+                scheme = detect_scheme(key, read(0, DETECT_SIZE), size, read)
+                if scheme.name == CBCScheme.name and hasattr(mapped, "madvise"):
+                    mapped.madvise(mmap.MADV_SEQUENTIAL)
+                written = scheme.decrypt_in_place(view, chunk_size)
+
+        if written != size:
+            f.truncate(written)
+
+    os.replace(work_path, dst_path)
+    logger.info(f"Decrypted {src_path} in place ({scheme.name}) -> {dst_path} ({written} bytes)")
+    return written
+
+
+class DecryptPipeline:
+    """Producer/consumer stage that decrypts chunks while they are still arriving
+
+    The scheme is picked by the caller from the first bytes, see
+    detect_scheme(), as telling them apart may need reads of the source.
+    The consumer runs on the cpu pool only while there are chunks to take,
+    so a slow download doesn't hold a cpu thread between them.
+    """
+    def __init__(self, dst_path: str, scheme, max_pending: int = PIPELINE_QUEUE_SIZE):
+        self.dst_path = dst_path
+        self.scheme = scheme
+        self.decryptor = scheme.decryptor()
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.lock = threading.Lock()
+        self.draining = False
+        self.done = threading.Event()
+        self.dst = open(dst_path, "wb")
+        self.written = 0
+        self.decrypt_seconds = 0.0  # Time spent decrypting, not waiting for chunks
+        self.error = None
+        self.aborted = False
+
+    def _write(self, plain: bytes):
+        self.dst.write(plain)
+        self.written += len(plain)
+
+    def _decrypt(self, chunk: bytes):
+        started = time.perf_counter()
+        plain = self.decryptor.update(chunk)
+        self.decrypt_seconds += time.perf_counter() - started
+        self._write(plain)
+
+    def _finish(self):
+        self._write(self.decryptor.finalize())
+
+    def _schedule(self):
+        with self.lock:
+            if self.draining:
+                return
+            self.draining = True
+        executors.cpu.submit(self._drain)
+
+    def _drain(self):
+        """Decrypt queued ciphertext into the output file until the queue runs dry"""
+        while True:
+            with self.lock:
+                try:
+                    chunk = self.queue.get_nowait()
+                except queue.Empty:
+                    # feed() schedules a new run for the next chunk
+                    self.draining = False
+                    return
+            if chunk is not None and self.error:
+                # Keep draining so the producer never blocks on a dead consumer
+                continue
+            try:
+                if chunk is not None:
+                    self._decrypt(chunk)
+                elif not self.error and not self.aborted:
+                    self._finish()
+            except Exception as e:
+                self.error = e
+            if chunk is None:
+                self.dst.close()
+                self.done.set()
+
+    def _end(self):
+        self.queue.put(None)
+        self._schedule()
+        self.done.wait()
+
+    def feed(self, chunk: bytes):
+        """Queue a ciphertext chunk, blocking while the decryptor is behind"""
+        if self.error:
+            raise self.error
+        self.queue.put(chunk)
+        self._schedule()
+
+    def close(self) -> int:
+        """Flush the last block and wait for the decryptor, returns plaintext size"""
+        self._end()
+        if self.error:
+            raise self.error
+        logger.info(f"Pipelined {self.scheme.name} decryption finished: {self.dst_path} ({self.written} bytes)")
+        return self.written
+
+    def abort(self):
+        """Stop the decryptor without finalizing the output"""
+        self.aborted = True
+        self._end()
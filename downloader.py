@@ -2,22 +2,26 @@ import os
 import yt_dlp
 from config import DOWNLOAD_DIR
 import time
-import asyncio
 from urllib.parse import urlparse
-import requests
 import re
+import itertools
 import logging
-from datetime import datetime
 import sys
-import subprocess
-import shutil
-from pathlib import Path
-import json
 import traceback
-from concurrent.futures import ThreadPoolExecutor
-from Crypto.Cipher import AES
-from Crypto.Util.Padding import unpad
-from typing import Callable, Optional, Tuple, Dict, Any
+from pathlib import Path
+from requests import RequestException
+from decryptor import (
+    decrypt_bytes, decrypt_file_in_place, detect_scheme, DecryptPipeline, SchemeUndecided, DECRYPTING_SUFFIX, DETECT_SIZE
+)
+from metadata import metadata_service
+from segmented import SegmentedDownloader, RangesNotSupported
+from http_client import http_client
+from thumbnails import thumbnail_service
+from info_cache import info_cache, expected_size
+from formats import FormatPlan, plan_format
+from executors import executors
+from metrics import metrics
+from typing import Awaitable, Callable, Optional, Tuple, Dict, Any
 
 # Configure modern terminal logging with cleaner format
 class ColoredFormatter(logging.Formatter):
@@ -88,6 +92,15 @@ def format_time(seconds):
     except:
         return "--:--"
 
+class NotAFile(Exception):
+    """The URL serves a web page, yt-dlp has to find the media in it"""
+
+
+# Streaming errors after which yt-dlp fetches the file again, any other error came from decrypting it.
+# An undecided scheme, e.g. without a Content-Length, is decided again once the whole file is on disk.
+FALLBACK_ERRORS = (RequestException, RangesNotSupported, NotAFile, SchemeUndecided)
+
+
 class VideoInfo:
     """Class to store video metadata"""
     def __init__(self):
@@ -97,31 +110,59 @@ class VideoInfo:
         self.thumbnail = None
         self.title = None
         self.format = None
+        self.size = 0  # Expected bytes, known before the transfer when the site reports it
 
-# Global event loop for callbacks
-loop = asyncio.get_event_loop()
+# Extensions of links that point straight at a file
+DIRECT_EXTENSIONS = [
+    ".mp4", ".mkv", ".avi", ".mov", ".wmv", ".flv", ".webm", ".m4v", ".3gp",
+    ".pdf", ".zip", ".rar", ".jpg", ".jpeg", ".png",
+]
+
+# Size of the ciphertext chunks read from the network in pipelined mode
+STREAM_CHUNK_SIZE = 1024 * 1024
+# Headers used when fetching encrypted files directly
+STREAM_HEADERS = {
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 "
+                  "(KHTML, like Gecko) Chrome/96.0.4664.55 Safari/537.36",
+}
+# Bytes fetched per range request when detecting the encryption scheme of a stream
+RANGE_WINDOW_SIZE = 64 * 1024
 
 class Downloader:
     def __init__(
         self,
         url: str,
         filename: str,
-        progress_callback: Optional[Callable] = None,
-        download_path: str = "downloads",
+        progress_callback: Optional[Callable] = None,  # Called from worker threads, must not block
+        download_path: str = DOWNLOAD_DIR,
+        temp_name: Optional[str] = None,
+        reserve: Optional[Callable[[int], Awaitable]] = None,  # Awaited with the expected size before a transfer
+        size_cap: int = 0,  # Largest yt-dlp format to pick next to FORMAT_SIZE_CAP, 0 for no extra limit
+        on_format: Optional[Callable[[FormatPlan], None]] = None,  # Called with the format picked for yt-dlp
+        canceled: Optional[Callable[[], bool]] = None,  # Whether the job was canceled, checked on every progress update
     ):
         self.url = url
         self.filename = filename
+        # Stable per-job name so an interrupted download can be resumed
+        self.temp_name = temp_name
         self.progress_callback = progress_callback
+        self.reserve = reserve
+        self.size_cap = size_cap
+        self.on_format = on_format
+        self.canceled = canceled
+        self.refused = None  # Why the disk space for this download was refused
+        self.decrypt_failed = None  # Why the ciphertext couldn't be decrypted, fetching it again won't help
         self.download_path = download_path
+        self.temp_path = os.path.join(download_path, temp_name) if temp_name else None
         self.download_started = False
         self.download_canceled = False
+        self.segmented = None  # The running segmented download, stopped on cancel
         self.is_encrypted = False
         self.encryption_key = None
         self.video_info = VideoInfo()
-        self.event_loop = loop
         self.update_interval = 0.3  # seconds between progress updates
         self.last_update_time = 0
-        self.executor = ThreadPoolExecutor(max_workers=2)  # For running background tasks
+        self.thumbnail_task = None  # Remote thumbnail fetch started once the info dict is known
         
         # Create download directory if it doesn't exist
         os.makedirs(download_path, exist_ok=True)
@@ -138,15 +179,7 @@ class Downloader:
     def decrypt_vid_data(self, vid_data, key):
         """Decrypt video data using the provided key"""
         try:
-            key = key.encode('utf-8')
-            # Use first 16 bytes as key and iv
-            key_16 = key[:16].ljust(16, b'\0')
-            iv = key[:16].ljust(16, b'\0')
-            
-            cipher = AES.new(key_16, AES.MODE_CBC, iv)
-            decrypted_data = unpad(cipher.decrypt(vid_data), AES.block_size)
-            
-            return decrypted_data
+            return decrypt_bytes(vid_data, key)
         except Exception as e:
             logger.error(f"Decryption error: {e}")
             raise e
@@ -174,14 +207,22 @@ class Downloader:
         """Send initial progress update to initialize UI"""
         if self.progress_callback:
             try:
-                await self.progress_callback(0, 0, 0, 0, 0, self.filename)
+                self.progress_callback(0, 0, self.video_info.size, 0, 0, self.filename)
                 logger.info("Sent initial progress update")
             except Exception as e:
                 logger.error(f"Error sending initial progress update: {e}")
                 logger.error(traceback.format_exc())
 
+    def cancel(self):
+        """Stop the download, the transfer gives up at its next progress update"""
+        self.download_canceled = True
+        if self.segmented:
+            self.segmented.cancel()
+
     def progress_hook(self, d: Dict[str, Any]) -> None:
         """Progress hook for yt-dlp"""
+        if not self.download_canceled and self.canceled and self.canceled():
+            self.cancel()
         if self.download_canceled:
             raise Exception("Download was canceled")
         
@@ -192,7 +233,7 @@ class Downloader:
                 # Extract information from the progress data
                 downloaded_bytes = d.get("downloaded_bytes", 0)
                 total_bytes = d.get("total_bytes") or d.get("total_bytes_estimate", 0)
-                speed = d.get("speed", 0)
+                speed = d.get("speed") or 0
                 elapsed = d.get("elapsed", 0)
                 filename = d.get("filename", "")
                 
@@ -208,7 +249,7 @@ class Downloader:
                     progress = 0
                 
                 # Calculate ETA
-                eta = d.get("eta", None)
+                eta = d.get("eta") or 0
                 
                 # Limit update frequency to avoid overwhelming the UI
                 current_time = time.time()
@@ -216,7 +257,7 @@ class Downloader:
                     self.last_update_time = current_time
                     
                     # Format the output like yt-dlp
-                    logger.info(
+                    logger.debug(
                         f"[download] {progress:.1f}% of {total_bytes/1024/1024:.1f}MB "
                         f"at {speed/1024/1024:.1f}MB/s ETA {eta:.1f}s"
                     )
@@ -224,19 +265,11 @@ class Downloader:
                     # Call the progress callback if provided
                     if self.progress_callback:
                         try:
-                            # Use asyncio.run_coroutine_threadsafe to ensure the callback
-                            # is executed in the correct event loop context
-                            coro = self.progress_callback(
+                            # The callback only publishes the numbers, rendering and
+                            # message edits happen on the progress renderer task
+                            self.progress_callback(
                                 progress, speed, total_bytes, downloaded_bytes, eta, filename
                             )
-                            
-                            # Schedule the coroutine to run in the event loop
-                            if self.event_loop and self.event_loop.is_running():
-                                # If event loop is running, use run_coroutine_threadsafe
-                                asyncio.run_coroutine_threadsafe(coro, self.event_loop)
-                            else:
-                                # If event loop is not running, create a new one
-                                asyncio.run(coro)
                         except Exception as e:
                             logger.error(f"Error in progress callback: {e}")
                             logger.error(traceback.format_exc())
@@ -249,85 +282,29 @@ class Downloader:
                     info = d["info_dict"]
                     self.video_info.title = info.get("title", "")
                     self.video_info.format = info.get("format", "")
-                    
-                    # Try to get thumbnail from info dict
-                    if "thumbnail" in info and info["thumbnail"]:
-                        thumbnail_url = info["thumbnail"]
-                        try:
-                            # Download thumbnail
-                            thumbnail_path = os.path.join(
-                                self.download_path, 
-                                f"{os.path.basename(d.get('filename', 'video'))}_thumb.jpg"
-                            )
-                            
-                            # Use yt-dlp to download thumbnail
-                            ydl_opts = {
-                                "quiet": True,
-                                "no_warnings": True,
-                                "outtmpl": thumbnail_path,
-                            }
-                            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                                ydl.download([thumbnail_url])
-                            
-                            if os.path.exists(thumbnail_path):
-                                self.video_info.thumbnail = thumbnail_path
-                                logger.info(f"Downloaded thumbnail from URL: {thumbnail_path}")
-                        except Exception as e:
-                            logger.error(f"Error downloading thumbnail: {e}")
         
         except Exception as e:
             logger.error(f"Error in progress hook: {e}")
             logger.error(traceback.format_exc())
 
-    def extract_video_metadata(self, video_path):
-        """Extract video metadata using ffprobe"""
+    async def extract_video_metadata(self, video_path):
+        """Extract video metadata and a thumbnail without blocking the event loop"""
         try:
-            # Extract video metadata using ffprobe
-            cmd = [
-                "ffprobe",
-                "-v", "error",
-                "-select_streams", "v:0",
-                "-show_entries", "stream=width,height,duration",
-                "-of", "json",
-                video_path
-            ]
-            
-            # Run ffprobe
-            result = subprocess.run(cmd, capture_output=True, text=True)
-            
-            if result.returncode == 0:
-                # Parse the output
-                try:
-                    data = json.loads(result.stdout)
-                    if 'streams' in data and len(data['streams']) > 0:
-                        stream = data['streams'][0]
-                        self.video_info.width = int(stream.get('width', 0))
-                        self.video_info.height = int(stream.get('height', 0))
-                        self.video_info.duration = float(stream.get('duration', 0))
-                        logger.info(f"Extracted video metadata: {self.video_info.width}x{self.video_info.height}, {self.video_info.duration}s")
-                except json.JSONDecodeError:
-                    logger.warning("Could not parse ffprobe output as JSON")
-            
-            # Generate thumbnail
-            thumbnail_path = os.path.join(self.download_path, f"{Path(video_path).stem}_thumb.jpg")
-            cmd = [
-                "ffmpeg",
-                "-i", video_path,
-                "-ss", "00:00:05",  # 5 seconds in
-                "-vframes", "1",
-                "-vf", "scale=320:-1",  # 320px width, keep aspect ratio
-                "-y",  # Overwrite without asking
-                thumbnail_path
-            ]
+            # Prefer the site's thumbnail, it has been fetching while we downloaded
+            if self.thumbnail_task is not None:
+                thumbnail_path = os.path.join(self.download_path, f"{Path(video_path).stem}_thumb.jpg")
+                self.video_info.thumbnail = await thumbnail_service.get(self.thumbnail_task, thumbnail_path)
             
-            # Run ffmpeg
-            result = subprocess.run(cmd, capture_output=True)
-            
-            if result.returncode == 0 and os.path.exists(thumbnail_path):
-                self.video_info.thumbnail = thumbnail_path
-                logger.info(f"Generated thumbnail: {thumbnail_path}")
-            else:
-                logger.warning("Could not generate thumbnail")
+            metadata = await metadata_service.extract(
+                self.url, video_path, self.download_path,
+                with_thumbnail=self.video_info.thumbnail is None,
+            )
+            # Keep what the info dict said if ffprobe couldn't read the file
+            self.video_info.width = metadata["width"] or self.video_info.width
+            self.video_info.height = metadata["height"] or self.video_info.height
+            self.video_info.duration = metadata["duration"] or self.video_info.duration
+            if metadata["thumbnail"]:
+                self.video_info.thumbnail = metadata["thumbnail"]
         
         except Exception as e:
             logger.error(f"Error extracting video metadata: {e}")
@@ -342,6 +319,7 @@ class Downloader:
             
             output_path = os.path.join(self.download_path, self.filename)
             logger.info(f"Starting download of {self.url} to {output_path}")
+            started = time.perf_counter()
             
             final_path = None
             
@@ -349,65 +327,78 @@ class Downloader:
                 # For encrypted videos, handle differently
                 logger.info(f"Processing encrypted video: {self.url}")
                 
-                # Download with yt-dlp in a separate thread to prevent blocking
-                download_success, temp_file = await self._download_with_ytdlp()
+                # Ensure proper file extension
+                output_path = self.ensure_proper_extension(output_path)
                 
-                if not download_success:
-                    logger.error(f"Failed to download encrypted video: {temp_file}")
-                    return False, f"Download failed: {temp_file}", self.video_info
+                # Decrypt while the ciphertext is still arriving
+                stream_success, result = await self._download_encrypted_stream(output_path)
                 
-                # Decrypt the file after downloading
-                logger.info(f"Downloaded encrypted file to {temp_file}, decrypting...")
-                try:
-                    # Ensure proper file extension
-                    output_path = self.ensure_proper_extension(output_path)
-                    
-                    # Read encrypted data
-                    with open(temp_file, "rb") as f:
-                        encrypted_data = f.read()
-                    
-                    # Decrypt the data
-                    decrypted_data = self.decrypt_vid_data(encrypted_data, self.encryption_key)
-                    
-                    # Write decrypted data
-                    with open(output_path, "wb") as f:
-                        f.write(decrypted_data)
+                if stream_success:
+                    final_path = result
+                elif self.download_canceled:
+                    return False, "Download was canceled", self.video_info
+                elif self.refused:
+                    return False, self.refused, self.video_info
+                elif self.decrypt_failed:
+                    return False, f"Decryption failed: {self.decrypt_failed}", self.video_info
+                else:
+                    logger.warning(f"Pipelined decryption unavailable ({result}), falling back to yt-dlp")
+                    # A crash during an earlier in-place decrypt left half plaintext, fetch it again
+                    self._discard_partial_decrypts()
                     
-                    logger.info(f"Decryption successful, saved to {output_path}")
-                    final_path = output_path
+                    # Download with yt-dlp in a separate thread to prevent blocking
+                    download_success, temp_file = await self._download_with_ytdlp()
                     
-                    # Extract metadata from the decrypted file
-                    await self.extract_video_metadata(final_path)
+                    if not download_success:
+                        logger.error(f"Failed to download encrypted video: {temp_file}")
+                        return False, f"Download failed: {temp_file}", self.video_info
                     
-                    # Clean up temporary file
-                    if os.path.exists(temp_file):
-                        os.remove(temp_file)
-                except Exception as e:
-                    logger.error(f"Decryption error: {e}")
-                    logger.error(traceback.format_exc())
-                    return False, f"Decryption failed: {str(e)}", self.video_info
+                    # Decrypt the file after downloading
+                    logger.info(f"Downloaded encrypted file to {temp_file}, decrypting...")
+                    try:
+                        # Decrypt the mapped file in place and rename it, no second copy on disk
+                        with metrics.timer("decrypt"):
+                            await executors.cpu.run(decrypt_file_in_place, temp_file, output_path, self.encryption_key)
+                        
+                        logger.info(f"Decryption successful, saved to {output_path}")
+                        final_path = output_path
+                    except Exception as e:
+                        logger.error(f"Decryption error: {e}")
+                        logger.error(traceback.format_exc())
+                        return False, f"Decryption failed: {str(e)}", self.video_info
+                
+                self._record_download(final_path, started)
+                # Extract metadata from the decrypted file
+                await self.extract_video_metadata(final_path)
             
             else:
-                # For regular videos, use yt-dlp directly
-                download_success, temp_file = await self._download_with_ytdlp()
-                
-                if not download_success:
-                    logger.error(f"Download failed: {temp_file}")
-                    return False, f"Download failed: {temp_file}", self.video_info
-                
                 # Ensure proper file extension
                 output_path = self.ensure_proper_extension(output_path)
                 
-                # Rename if needed
-                if temp_file != output_path and os.path.exists(temp_file):
-                    # Make sure target directory exists
-                    os.makedirs(os.path.dirname(output_path), exist_ok=True)
-                    # Move the file to final destination
-                    shutil.move(temp_file, output_path)
-                    logger.info(f"Moved downloaded file from {temp_file} to {output_path}")
+                # Direct file links are fetched over several connections
+                segmented_success, result = False, "Not a direct file URL"
+                if self.is_direct_url():
+                    segmented_success, result = await self._download_segmented(output_path)
                 
-                final_path = output_path
+                if segmented_success:
+                    final_path = result
+                elif self.download_canceled:
+                    return False, "Download was canceled", self.video_info
+                elif self.refused:
+                    return False, self.refused, self.video_info
+                else:
+                    logger.info(f"Segmented download unavailable ({result}), using yt-dlp")
+                    
+                    # For regular videos, yt-dlp writes straight to the final path
+                    download_success, result = await self._download_with_ytdlp(output_path)
+                    
+                    if not download_success:
+                        logger.error(f"Download failed: {result}")
+                        return False, f"Download failed: {result}", self.video_info
+                    
+                    final_path = result
                 
+                self._record_download(final_path, started)
                 # Extract metadata from the downloaded file
                 await self.extract_video_metadata(final_path)
             
@@ -418,6 +409,77 @@ class Downloader:
             logger.error(traceback.format_exc())
             return False, str(e), self.video_info
 
+    def _discard_partial_decrypts(self):
+        """Delete files an interrupted in-place decrypt of this job left behind"""
+        if not self.temp_name:
+            return
+        for name in os.listdir(self.download_path):
+            if name.startswith(f"{self.temp_name}.") and name.endswith(DECRYPTING_SUFFIX):
+                logger.info(f"Removing half decrypted {name}, downloading it again")
+                os.remove(os.path.join(self.download_path, name))
+
+    def _record_download(self, path: str, started: float):
+        """Report how long the transfer took and how fast it went"""
+        elapsed = time.perf_counter() - started
+        size = os.path.getsize(path)
+        metrics.observe("stage_seconds", elapsed, stage="download")
+        metrics.count("download_bytes", size)
+        if elapsed > 0:
+            metrics.observe("download_speed_bytes", size / elapsed)
+
+    async def _reserve(self, size: int):
+        """Claim disk space for the expected size before the transfer starts"""
+        if not self.reserve or not size:
+            return
+        try:
+            await self.reserve(size)
+        except Exception as e:
+            self.refused = str(e)
+            raise
+
+    def is_direct_url(self):
+        """Check if the URL points straight at a file rather than a web page"""
+        path = urlparse(self.url).path.lower()
+        return os.path.splitext(path)[1] in DIRECT_EXTENSIONS
+
+    async def _download_segmented(self, output_path: str) -> Tuple[bool, str]:
+        """Fetch a direct file URL over several HTTP range requests"""
+        logger.info(f"Starting segmented download for {self.url}")
+        start_time = time.time()
+        
+        def report(downloaded_bytes, total_bytes):
+            elapsed = time.time() - start_time
+            speed = downloaded_bytes / elapsed if elapsed > 0 else 0
+            eta = (total_bytes - downloaded_bytes) / speed if speed else 0
+            self.progress_hook({
+                "status": "downloading",
+                "downloaded_bytes": downloaded_bytes,
+                "total_bytes": total_bytes,
+                "speed": speed,
+                "elapsed": elapsed,
+                "eta": eta,
+                "filename": output_path,
+            })
+        
+        segmented = SegmentedDownloader(self.url, output_path, progress=report)
+        self.segmented = segmented
+        
+        try:
+            segmented.total_bytes = await executors.network.run(segmented.probe)
+            await self._reserve(segmented.total_bytes)
+        except Exception as e:
+            return False, str(e)
+        
+        try:
+            # The segments run on the network pool
+            await segmented.download()
+            return True, output_path
+        except RangesNotSupported as e:
+            return False, str(e)
+        except Exception as e:
+            logger.error(f"Segmented download error: {e}")
+            return False, str(e)
+
     def ensure_proper_extension(self, filepath):
         """Ensure the file has the correct extension based on the URL"""
         url_path = self.url.split("?")[0]  # Remove query params
@@ -432,17 +494,24 @@ class Downloader:
         
         return filepath
 
-    async def _download_with_ytdlp(self) -> Tuple[bool, str]:
-        """Run yt-dlp download in a separate thread to avoid blocking"""
+    async def _download_with_ytdlp(self, output_path: Optional[str] = None) -> Tuple[bool, str]:
+        """Run yt-dlp download in a separate thread to avoid blocking
+        
+        With output_path the file is written there directly, the extension
+        follows the format yt-dlp picks.
+        """
         logger.info(f"Starting yt-dlp download for {self.url}")
         
         try:
-            # Send initial progress update
-            if self.progress_callback and not self.download_started:
-                await self.send_initial_progress()
-            
             # Set up yt-dlp options
-            outtmpl = os.path.join(self.download_path, "%(title).100s.%(ext)s")
+            if output_path:
+                base_path = os.path.splitext(output_path)[0]
+                outtmpl = base_path.replace("%", "%%") + ".%(ext)s"
+            elif self.temp_name:
+                # yt-dlp picks up the partial file under this name (continuedl)
+                outtmpl = os.path.join(self.download_path, f"{self.temp_name}.%(ext)s")
+            else:
+                outtmpl = os.path.join(self.download_path, "%(title).100s.%(ext)s")
             
             ydl_opts = {
                 "quiet": False,
@@ -450,7 +519,7 @@ class Downloader:
                 "progress_hooks": [self.progress_hook],
                 "outtmpl": outtmpl,
                 "format": "best/bestvideo+bestaudio",
-                "writeinfojson": True,
+                "writeinfojson": False,
                 "retries": 10,
                 "fragment_retries": 10,
                 "concurrent_fragment_downloads": 10,  # Download fragments concurrently for faster speed
@@ -460,39 +529,172 @@ class Downloader:
                 "nooverwrites": False,
                 "continuedl": True,
             }
+            output_ext = os.path.splitext(output_path or "")[1].lstrip(".").lower()
+            if output_ext in ("mp4", "mkv", "webm"):
+                # Keep the requested container when separate streams get merged
+                ydl_opts["merge_output_format"] = output_ext
             
-            # Function to run in the thread pool
-            def run_download():
-                try:
-                    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                        info = ydl.extract_info(self.url, download=True)
-                        
-                        # Get the actual filename that was downloaded
-                        if info:
-                            filename = ydl.prepare_filename(info)
-                            
-                            # If info_dict has resolution, update video_info
-                            self.video_info.width = info.get("width", 0)
-                            self.video_info.height = info.get("height", 0)
-                            self.video_info.duration = info.get("duration", 0)
-                            self.video_info.title = info.get("title", "")
-                            
-                            # Check if thumbnail info exists
-                            if "thumbnail" in info and info["thumbnail"]:
-                                self.video_info.thumbnail = info.get("thumbnail", "")
-                            
-                            return True, filename
-                        return False, "Could not extract video info"
-                except Exception as e:
-                    logger.error(f"yt-dlp download error: {e}")
-                    logger.error(traceback.format_exc())
-                    return False, str(e)
-            
-            # Run the download in a separate thread
-            result = await loop.run_in_executor(self.executor, run_download)
-            return result
+            ydl = yt_dlp.YoutubeDL(ydl_opts)
+            try:
+                # Probe once up front, the info dict drives everything below
+                with metrics.timer("extract_info"):
+                    info = await executors.network.run(info_cache.extract_info, ydl, self.url)
+                if not info:
+                    return False, "Could not extract video info"
+                
+                self.video_info.width = info.get("width") or 0
+                self.video_info.height = info.get("height") or 0
+                self.video_info.duration = info.get("duration") or 0
+                self.video_info.title = info.get("title", "")
+                self.video_info.format = info.get("format", "")
+                self.video_info.size = expected_size(info)
+                
+                plan = plan_format(info, self.size_cap)
+                if plan:
+                    # Select again on the same info dict, there is no second extraction
+                    ydl.params["format"] = plan.selector
+                    ydl.format_selector = ydl.build_format_selector(plan.selector)
+                    self.video_info.width = plan.width or self.video_info.width
+                    self.video_info.height = plan.height or self.video_info.height
+                    self.video_info.format = str(plan)
+                    self.video_info.size = plan.size or self.video_info.size
+                    if self.on_format:
+                        self.on_format(plan)
+                await self._reserve(self.video_info.size)
+                
+                # Show the real size before the first byte arrives
+                if self.progress_callback and not self.download_started:
+                    await self.send_initial_progress()
+                
+                if info.get("thumbnail"):
+                    self.thumbnail_task = thumbnail_service.fetch(info["thumbnail"])
+                
+                info = await executors.network.run(ydl.process_ie_result, info, True)
+                
+                # Get the actual filename that was downloaded (after any merge)
+                downloads = info.get("requested_downloads") or [{}]
+                filename = downloads[0].get("filepath") or ydl.prepare_filename(info)
+                
+                return True, filename
+            except Exception as e:
+                logger.error(f"yt-dlp download error: {e}")
+                logger.error(traceback.format_exc())
+                return False, str(e)
+            finally:
+                ydl.close()
         
         except Exception as e:
             logger.error(f"Error setting up yt-dlp download: {e}")
             logger.error(traceback.format_exc())
-            return False, str(e) 
+            return False, str(e)
+
+    def _range_reader(self, total_bytes: int) -> Callable[[int, int], bytes]:
+        """Random access to the source through range requests, whole windows are fetched and kept"""
+        windows: Dict[int, bytes] = {}
+
+        def read(offset: int, size: int) -> bytes:
+            end = min(offset + size, total_bytes)
+            if offset >= end:
+                return b""
+            first = offset // RANGE_WINDOW_SIZE
+            last = (end - 1) // RANGE_WINDOW_SIZE
+            missing = [i for i in range(first, last + 1) if i not in windows]
+            if missing:
+                start = missing[0] * RANGE_WINDOW_SIZE
+                stop = min((missing[-1] + 1) * RANGE_WINDOW_SIZE, total_bytes)
+                headers = dict(STREAM_HEADERS, Range=f"bytes={start}-{stop - 1}")
+                # Streamed so a server that ignores the range doesn't send the whole file
+                with http_client.get(self.url, headers=headers, stream=True, timeout=30) as response:
+                    if response.status_code != 206:
+                        raise RangesNotSupported(f"HTTP {response.status_code}, no byte range support")
+                    data = response.raw.read(stop - start)
+                if len(data) != stop - start:
+                    raise RangesNotSupported(f"Short range response, {len(data)} of {stop - start} bytes")
+                for i in range(missing[0], missing[-1] + 1):
+                    windows[i] = data[(i - missing[0]) * RANGE_WINDOW_SIZE:(i - missing[0] + 1) * RANGE_WINDOW_SIZE]
+            data = b"".join(windows[i] for i in range(first, last + 1))
+            return data[offset - first * RANGE_WINDOW_SIZE:end - first * RANGE_WINDOW_SIZE]
+
+        return read
+
+    def _probe_size(self) -> int:
+        """Size of the source from a HEAD request, 0 if the server doesn't say"""
+        try:
+            response = http_client.head(self.url, headers=STREAM_HEADERS, allow_redirects=True, timeout=30)
+            if response.ok:
+                return int(response.headers.get("Content-Length") or 0)
+        except Exception as e:
+            logger.warning(f"Could not get the size of {self.url}: {e}")
+        return 0
+
+    async def _download_encrypted_stream(self, output_path: str) -> Tuple[bool, str]:
+        """Fetch the ciphertext over HTTP and decrypt it while it is arriving"""
+        logger.info(f"Starting pipelined download and decryption for {self.url}")
+        
+        def run_stream():
+            pipeline = None
+            try:
+                with http_client.get(self.url, headers=STREAM_HEADERS, stream=True, timeout=30) as response:
+                    response.raise_for_status()
+                    if "text/html" in response.headers.get("Content-Type", ""):
+                        raise NotAFile("URL does not point to a file")
+                    
+                    total_bytes = int(response.headers.get("Content-Length") or 0)
+                    chunks = response.iter_content(chunk_size=STREAM_CHUNK_SIZE)
+                    head = b""
+                    for chunk in chunks:
+                        head += chunk
+                        if len(head) >= DETECT_SIZE:
+                            break
+                    # Telling header-only from full-file CBC reads past the header and at the end,
+                    # those range requests go out from this thread before the decryptor starts
+                    read = self._range_reader(total_bytes) if total_bytes else None
+                    scheme = detect_scheme(self.encryption_key, head[:DETECT_SIZE], total_bytes, read)
+                    pipeline = DecryptPipeline(output_path, scheme)
+                    downloaded_bytes = 0
+                    start_time = time.time()
+                    
+                    for chunk in itertools.chain([head], chunks):
+                        # Blocks while the decryptor is behind, bounding memory
+                        pipeline.feed(chunk)
+                        downloaded_bytes += len(chunk)
+                        
+                        elapsed = time.time() - start_time
+                        speed = downloaded_bytes / elapsed if elapsed > 0 else 0
+                        eta = (total_bytes - downloaded_bytes) / speed if speed and total_bytes else 0
+                        self.progress_hook({
+                            "status": "downloading",
+                            "downloaded_bytes": downloaded_bytes,
+                            "total_bytes": total_bytes,
+                            "speed": speed,
+                            "elapsed": elapsed,
+                            "eta": eta,
+                            "filename": output_path,
+                        })
+                
+                pipeline.close()
+                metrics.observe("stage_seconds", pipeline.decrypt_seconds, stage="decrypt")
+                return True, output_path
+            except Exception as e:
+                logger.error(f"Pipelined download error: {e}")
+                if not isinstance(e, FALLBACK_ERRORS):
+                    self.decrypt_failed = str(e)
+                if pipeline:
+                    pipeline.abort()
+                if os.path.exists(output_path):
+                    os.remove(output_path)
+                return False, str(e)
+        
+        try:
+            # Space is claimed before the body is opened, not while a network thread holds it
+            await self._reserve(await executors.network.run(self._probe_size))
+        except Exception as e:
+            return False, str(e)
+        
+        try:
+            # The fetch runs on the network pool, the decryptor on the cpu pool
+            return await executors.network.run(run_stream)
+        except Exception as e:
+            logger.error(f"Error setting up pipelined download: {e}")
+            logger.error(traceback.format_exc())
+            return False, str(e)
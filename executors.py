@@ -0,0 +1,82 @@
+import asyncio
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict
+from config import NETWORK_THREADS, CPU_THREADS, DISK_THREADS
+
+logger = logging.getLogger("URLUploader")
+
+
+class BoundedPool:
+    """Fixed-size thread pool that knows how much work is queued and running"""
+    def __init__(self, name: str, workers: int):
+        self.name = name
+        self.workers = max(1, workers)
+        self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix=name)
+        self.lock = threading.Lock()
+        self.queued = 0
+        self.running = 0
+        self.completed = 0
+
+    async def run(self, func: Callable[..., Any], *args) -> Any:
+        """Run a blocking call on the pool and await it from the running loop"""
+        return await asyncio.wrap_future(self.submit(func, *args))
+
+    def submit(self, func: Callable[..., Any], *args) -> Future:
+        """Start a blocking call on the pool, for callers that are threads themselves"""
+        with self.lock:
+            self.queued += 1
+
+        def call():
+            with self.lock:
+                self.queued -= 1
+                self.running += 1
+            try:
+                return func(*args)
+            finally:
+                with self.lock:
+                    self.running -= 1
+                    self.completed += 1
+
+        return self.executor.submit(call)
+
+    def shutdown(self, wait: bool = True):
+        # Calls still waiting for a thread are dropped
+        self.executor.shutdown(wait=wait, cancel_futures=True)
+
+    def stats(self) -> Dict[str, float]:
+        with self.lock:
+            return {
+                "workers": self.workers,
+                "running": self.running,
+                "queued": self.queued,
+                "saturation": self.running / self.workers,
+                "completed": self.completed,
+            }
+
+
+class Executors:
+    """Shared pools: network for yt-dlp and HTTP transfers, cpu for decrypting and hashing, disk for file work"""
+    def __init__(
+        self,
+        network_threads: int = NETWORK_THREADS,
+        cpu_threads: int = CPU_THREADS,
+        disk_threads: int = DISK_THREADS,
+    ):
+        self.network = BoundedPool("network", network_threads)
+        self.cpu = BoundedPool("cpu", cpu_threads)
+        self.disk = BoundedPool("disk", disk_threads)
+
+    def shutdown(self, wait: bool = True):
+        logger.info("Shutting down executor pools")
+        self.network.shutdown(wait)
+        self.cpu.shutdown(wait)
+        self.disk.shutdown(wait)
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        return {"network": self.network.stats(), "cpu": self.cpu.stats(), "disk": self.disk.stats()}
+
+
+# Create a single instance
+executors = Executors()
@@ -0,0 +1,121 @@
+import logging
+from typing import Any, Dict, List, Optional
+from config import SPLIT_SIZE, FORMAT_SIZE_CAP
+
+logger = logging.getLogger("URLUploader")
+
+# Extensions of MP4 video and audio streams
+MP4_EXTENSIONS = ("mp4", "m4a")
+# yt-dlp marks formats it knows to be broken or useless with a preference below this
+UNUSABLE_PREFERENCE = -1000
+
+
+def has_video(fmt: Dict[str, Any]) -> bool:
+    # A missing codec means the site didn't say, not that the stream is absent
+    return fmt.get("vcodec") != "none"
+
+
+def has_audio(fmt: Dict[str, Any]) -> bool:
+    return fmt.get("acodec") != "none"
+
+
+def format_size(fmt: Dict[str, Any], duration: float) -> int:
+    """Bytes a single format will take, estimated from its bitrate when the site doesn't say"""
+    size = fmt.get("filesize") or fmt.get("filesize_approx")
+    if size:
+        return int(size)
+    # tbr is in KBit/s
+    return int((fmt.get("tbr") or 0) * 1000 / 8 * (duration or 0))
+
+
+class FormatPlan:
+    """The format, or video and audio pair, picked for a download and what it will cost"""
+    def __init__(self, formats: List[Dict[str, Any]], size: int):
+        self.formats = formats
+        self.size = size  # 0 if unknown
+
+    @property
+    def selector(self) -> str:
+        """yt-dlp format selector for exactly these formats"""
+        return "+".join(f["format_id"] for f in self.formats)
+
+    @property
+    def merged(self) -> bool:
+        """Separate streams that ffmpeg has to merge after the download"""
+        return len(self.formats) > 1
+
+    @property
+    def mp4(self) -> bool:
+        """Everything is MP4 already, Telegram streams it without a conversion"""
+        return all(f.get("ext") in MP4_EXTENSIONS for f in self.formats)
+
+    @property
+    def width(self) -> int:
+        return max(f.get("width") or 0 for f in self.formats)
+
+    @property
+    def height(self) -> int:
+        return max(f.get("height") or 0 for f in self.formats)
+
+    @property
+    def tbr(self) -> float:
+        return sum(f.get("tbr") or 0 for f in self.formats)
+
+    def rank(self):
+        """Sort key, higher is better: formats that need no merge, then resolution, MP4 first"""
+        return (not self.merged, self.height, self.mp4, self.tbr, -self.size)
+
+    def __str__(self):
+        size = f"{self.size / 1024 / 1024:.0f}MB" if self.size else "unknown size"
+        return f"{self.selector} ({self.height}p, {size}{', merged' if self.merged else ''})"
+
+
+def candidates(info: Dict[str, Any]) -> List[FormatPlan]:
+    """Every format or video and audio pair of an info dict that can be downloaded"""
+    duration = info.get("duration") or 0
+    formats = [
+        f for f in info.get("formats") or []
+        if f.get("format_id")
+        and (has_video(f) or has_audio(f))
+        and f.get("protocol") != "mhtml"  # Storyboards
+        and (f.get("preference") or 0) > UNUSABLE_PREFERENCE
+    ]
+    muxed = [f for f in formats if has_video(f) and has_audio(f)]
+    videos = [f for f in formats if has_video(f) and not has_audio(f)]
+    audios = [f for f in formats if has_audio(f) and not has_video(f)]
+
+    plans = [FormatPlan([f], format_size(f, duration)) for f in muxed]
+    for video in videos:
+        for audio in audios:
+            plans.append(FormatPlan([video, audio], format_size(video, duration) + format_size(audio, duration)))
+    if not plans:
+        # Sites that only offer video-only or only audio streams
+        plans = [FormatPlan([f], format_size(f, duration)) for f in videos or audios]
+    return plans
+
+
+def plan_format(info: Dict[str, Any], size_cap: int = 0) -> Optional[FormatPlan]:
+    """Best format that fits the size caps and the Telegram limit, None leaves the choice to yt-dlp
+
+    Files above SPLIT_SIZE would have to be split to go to Telegram, so it
+    counts as a cap next to FORMAT_SIZE_CAP and the size_cap of the job.
+    If nothing fits, the smallest format is taken. Without any cap every
+    format fits.
+    """
+    plans = candidates(info)
+    if len(plans) < 2:
+        return None
+
+    limit = min((cap for cap in (SPLIT_SIZE, FORMAT_SIZE_CAP, size_cap) if cap), default=0)
+    fitting = [p for p in plans if not limit or (p.size and p.size <= limit)]
+    if fitting:
+        plan = max(fitting, key=FormatPlan.rank)
+    elif any(not p.size for p in plans):
+        # Nothing is known to fit, a format of unknown size may still do
+        plan = max((p for p in plans if not p.size), key=FormatPlan.rank)
+    else:
+        plan = min(plans, key=lambda p: p.size)
+        logger.info(f"No format of {info.get('webpage_url')} fits in {limit} bytes, taking the smallest")
+
+    logger.info(f"Picked format {plan} out of {len(plans)} for {info.get('webpage_url')}")
+    return plan
@@ -0,0 +1,145 @@
+import time
+import socket
+import logging
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.exceptions import ConnectTimeoutError, NewConnectionError
+from typing import Dict
+from config import HTTP_POOL_SIZE, DNS_CACHE_TTL
+
+logger = logging.getLogger("URLUploader")
+
+# Number of hosts whose connection pools are kept around
+POOL_HOSTS = 32
+# Expired DNS entries are pruned once the cache grows past this
+DNS_CACHE_PRUNE_SIZE = 1024
+
+DEFAULT_HEADERS = {
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 "
+                  "(KHTML, like Gecko) Chrome/96.0.4664.55 Safari/537.36",
+}
+
+
+class DNSCache:
+    """getaddrinfo cache with a fixed TTL"""
+    def __init__(self, ttl: float = DNS_CACHE_TTL):
+        self.ttl = ttl
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def getaddrinfo(self, host, port, family=0, type=0, proto=0, flags=0):
+        key = (host, port, family, type, proto, flags)
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and entry[0] > now:
+                self.hits += 1
+                return entry[1]
+
+        result = socket.getaddrinfo(host, port, family, type, proto, flags)
+        with self.lock:
+            self.misses += 1
+            if len(self.entries) >= DNS_CACHE_PRUNE_SIZE:
+                self.entries = {k: v for k, v in self.entries.items() if v[0] > now}
+            self.entries[key] = (now + self.ttl, result)
+        return result
+
+
+
+class CachedResolution:
+    """urllib3 connection mixin that looks the host up in `dns_cache` before connecting"""
+    dns_cache: DNSCache = None
+
+    def _new_conn(self):
+        host = self._dns_host
+        try:
+            infos = self.dns_cache.getaddrinfo(host, self.port, 0, socket.SOCK_STREAM)
+        except socket.gaierror:
+            # Let urllib3 fail the lookup itself and raise its usual error
+            return super()._new_conn()
+
+        error = None
+        # Connect to the addresses in turn like create_connection(), only without a lookup
+        for address in dict.fromkeys(info[4][0] for info in infos):
+            self._dns_host = address
+            try:
+                return super()._new_conn()
+            except (NewConnectionError, ConnectTimeoutError) as e:
+                error = e
+            finally:
+                self._dns_host = host
+        raise error
+
+
+def cached_pool(pool_cls, connection_cls, dns_cache: DNSCache):
+    """Subclass of a urllib3 connection pool whose connections resolve through dns_cache"""
+    connection = type(connection_cls.__name__, (CachedResolution, connection_cls), {"dns_cache": dns_cache})
+    return type(pool_cls.__name__, (pool_cls,), {"ConnectionCls": connection})
+
+
+class CachedDNSAdapter(HTTPAdapter):
+    """HTTPAdapter whose connections look host names up in a DNSCache, other sockets are left alone"""
+    def __init__(self, dns_cache: DNSCache, **kwargs):
+        # Needed by init_poolmanager(), which the base class calls
+        self.dns_cache = dns_cache
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": cached_pool(HTTPConnectionPool, HTTPConnection, self.dns_cache),
+            "https": cached_pool(HTTPSConnectionPool, HTTPSConnection, self.dns_cache),
+        }
+
+
+class HttpClient:
+    """Shared keep-alive HTTP session used by every download"""
+    def __init__(self, pool_size: int = HTTP_POOL_SIZE):
+        self.session = requests.Session()
+        self.session.headers.update(DEFAULT_HEADERS)
+        self.dns_cache = DNSCache()
+        # One pool per host, enough connections for parallel range requests
+        self.adapter = CachedDNSAdapter(self.dns_cache, pool_connections=POOL_HOSTS, pool_maxsize=pool_size)
+        self.session.mount("http://", self.adapter)
+        self.session.mount("https://", self.adapter)
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        return self.session.get(url, **kwargs)
+
+    def head(self, url: str, **kwargs) -> requests.Response:
+        return self.session.head(url, **kwargs)
+
+    def download_file(self, url: str, path: str, timeout: int = 30) -> str:
+        """Fetch a small file (e.g. a thumbnail) to disk"""
+        with self.session.get(url, stream=True, timeout=timeout) as response:
+            response.raise_for_status()
+            with open(path, "wb") as f:
+                for chunk in response.iter_content(chunk_size=64 * 1024):
+                    f.write(chunk)
+        return path
+
+    def stats(self) -> Dict[str, float]:
+        """Connection reuse and DNS cache numbers"""
+        requests_made = connections = 0
+        pools = self.adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is not None:
+                requests_made += pool.num_requests
+                connections += pool.num_connections
+        return {
+            "requests": requests_made,
+            "connections": connections,
+            "reuse_rate": 1 - connections / requests_made if requests_made else 0.0,
+            "dns_hits": self.dns_cache.hits,
+            "dns_misses": self.dns_cache.misses,
+        }
+
+
+# Create a single instance
+http_client = HttpClient()
@@ -0,0 +1,68 @@
+import copy
+import time
+import logging
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+from config import INFO_CACHE_TTL
+
+logger = logging.getLogger("URLUploader")
+
+# Most info dicts kept in memory at once
+INFO_CACHE_SIZE = 256
+
+
+def expected_size(info: Dict[str, Any]) -> int:
+    """Bytes the selected format(s) will take, 0 if the site doesn't say"""
+    formats = info.get("requested_formats") or [info]
+    return int(sum(f.get("filesize") or f.get("filesize_approx") or 0 for f in formats))
+
+
+class InfoCache:
+    """yt-dlp info dicts per URL, kept for a short TTL since media URLs expire"""
+    def __init__(self, ttl: float = INFO_CACHE_TTL, max_entries: int = INFO_CACHE_SIZE):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key) -> Optional[Dict[str, Any]]:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                self.entries.pop(key, None)
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(key)
+            # yt-dlp mutates the dict while processing it
+            return copy.deepcopy(entry[1])
+
+    def put(self, key, info: Dict[str, Any]):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, copy.deepcopy(info))
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def extract_info(self, ydl, url: str) -> Optional[Dict[str, Any]]:
+        """Resolve a URL without downloading it, reusing a recent result for the same format"""
+        key = (url, ydl.params.get("format"))
+        info = self.get(key)
+        if info is not None:
+            logger.info(f"Info cache hit for {url}")
+            return info
+
+        info = ydl.extract_info(url, download=False)
+        if info:
+            self.put(key, info)
+        return info
+
+    def stats(self) -> Dict[str, int]:
+        return {"entries": len(self.entries), "hits": self.hits, "misses": self.misses}
+
+
+# Create a single instance
+info_cache = InfoCache()
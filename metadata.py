@@ -0,0 +1,259 @@
+import os
+import json
+import time
+import shutil
+import asyncio
+import hashlib
+import logging
+import threading
+import traceback
+from collections import OrderedDict
+from pathlib import Path
+from typing import Optional, Dict, Any
+from config import DOWNLOAD_DIR, METADATA_CACHE_SIZE
+from executors import executors
+from metrics import metrics
+
+logger = logging.getLogger("URLUploader")
+
+# Timeouts (seconds) for the ffprobe and ffmpeg thumbnail subprocesses
+PROBE_TIMEOUT = 30
+THUMBNAIL_TIMEOUT = 60
+# Where the thumbnail is taken from, falls back to the first frame for short clips
+THUMBNAIL_SEEK = "00:00:05"
+# Bytes hashed from the head and the tail of a file for its content key
+PARTIAL_HASH_SIZE = 1024 * 1024
+
+CACHE_DIR = os.path.join(DOWNLOAD_DIR, ".metacache")
+
+
+async def run_command(cmd, timeout):
+    """Run a command as an asyncio subprocess and return (returncode, stdout)"""
+    process = await asyncio.create_subprocess_exec(
+        *cmd,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    try:
+        stdout, _ = await asyncio.wait_for(process.communicate(), timeout)
+    except (asyncio.TimeoutError, asyncio.CancelledError):
+        # Don't leave a stuck (or abandoned) ffmpeg/ffprobe behind
+        process.kill()
+        await process.wait()
+        raise
+    return process.returncode, stdout
+
+
+def content_key(url: str, path: str) -> str:
+    """Build a cache key from the URL, the file size and a partial content hash"""
+    size = os.path.getsize(path)
+    digest = hashlib.sha1(f"{url}|{size}".encode("utf-8"))
+    with open(path, "rb") as f:
+        digest.update(f.read(PARTIAL_HASH_SIZE))
+        if size > 2 * PARTIAL_HASH_SIZE:
+            f.seek(-PARTIAL_HASH_SIZE, os.SEEK_END)
+            digest.update(f.read(PARTIAL_HASH_SIZE))
+    return digest.hexdigest()
+
+
+def parse_probe_output(output) -> Optional[Dict[str, Any]]:
+    """Parse combined ffprobe stream/format JSON into width, height and duration"""
+    data = json.loads(output)
+    video = next(
+        (s for s in data.get("streams", []) if s.get("codec_type") == "video"),
+        None,
+    )
+    if video is None:
+        return None
+
+    # MKV streams often carry no duration, the container always does
+    duration = video.get("duration") or data.get("format", {}).get("duration") or 0
+    return {
+        "width": int(video.get("width", 0)),
+        "height": int(video.get("height", 0)),
+        "duration": float(duration),
+    }
+
+
+async def probe_video(video_path: str) -> Optional[Dict[str, Any]]:
+    """Read stream dimensions and container duration with a single ffprobe call"""
+    cmd = [
+        "ffprobe",
+        "-v", "error",
+        "-show_entries", "stream=codec_type,width,height,duration:format=duration",
+        "-of", "json",
+        video_path
+    ]
+    with metrics.timer("probe"):
+        returncode, stdout = await run_command(cmd, PROBE_TIMEOUT)
+    if returncode != 0:
+        return None
+    # Parse the output off the loop thread
+    return await executors.cpu.run(parse_probe_output, stdout)
+
+
+async def generate_thumbnail(video_path: str, thumbnail_path: str) -> bool:
+    """Grab a 320px thumbnail using a fast input-side keyframe seek"""
+    for seek in (THUMBNAIL_SEEK, "0"):
+        cmd = [
+            "ffmpeg",
+            "-ss", seek,  # Before -i: jump to the nearest keyframe instead of decoding up to it
+            "-i", video_path,
+            "-frames:v", "1",
+            "-vf", "scale=320:-1",  # 320px width, keep aspect ratio
+            "-y",  # Overwrite without asking
+            thumbnail_path
+        ]
+        with metrics.timer("thumbnail"):
+            returncode, _ = await run_command(cmd, THUMBNAIL_TIMEOUT)
+        # Seeking past the end of a short clip succeeds without writing a frame
+        if returncode == 0 and os.path.exists(thumbnail_path):
+            return True
+    return False
+
+
+class MetadataCache:
+    """On-disk LRU cache of probe results and thumbnails keyed by content"""
+    def __init__(self, cache_dir: str = CACHE_DIR, max_entries: int = METADATA_CACHE_SIZE):
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.index_path = os.path.join(cache_dir, "index.json")
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.index_path, "r") as f:
+                entries = json.load(f)
+            # Oldest first, as written by _save()
+            for key, entry in sorted(entries.items(), key=lambda item: item[1].get("used", 0)):
+                self.entries[key] = entry
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.warning(f"Could not load metadata cache index: {e}")
+
+    def _save(self):
+        temp_path = f"{self.index_path}.tmp"
+        with open(temp_path, "w") as f:
+            json.dump(self.entries, f)
+        os.replace(temp_path, self.index_path)
+
+    def thumbnail_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.jpg")
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """Return a cached entry and mark it as most recently used"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            entry["used"] = time.time()
+            self.entries.move_to_end(key)
+            return dict(entry)
+
+    def put(self, key: str, entry: Dict[str, Any], thumbnail: Optional[str] = None):
+        """Store an entry (and a copy of its thumbnail), evicting the least recently used"""
+        entry = dict(entry, used=time.time(), thumbnail=None)
+        with self.lock:
+            if thumbnail and os.path.exists(thumbnail):
+                shutil.copyfile(thumbnail, self.thumbnail_path(key))
+                entry["thumbnail"] = self.thumbnail_path(key)
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+
+            while len(self.entries) > self.max_entries:
+                old_key, old_entry = self.entries.popitem(last=False)
+                if old_entry.get("thumbnail") and os.path.exists(old_entry["thumbnail"]):
+                    os.remove(old_entry["thumbnail"])
+                logger.info(f"Evicted metadata cache entry {old_key}")
+
+            self._save()
+
+    def stats(self) -> Dict[str, int]:
+        return {"entries": len(self.entries), "hits": self.hits, "misses": self.misses}
+
+
+class MetadataService:
+    """Probe results and thumbnails for finished files, served from cache when possible"""
+    def __init__(self, cache: Optional[MetadataCache] = None):
+        self.cache = cache or MetadataCache()
+
+    async def extract(
+        self, url: str, video_path: str, download_path: str, with_thumbnail: bool = True, cache: bool = True
+    ) -> Dict[str, Any]:
+        """Return width, height, duration and thumbnail path for a downloaded video
+
+        with_thumbnail=False skips the ffmpeg frame grab, e.g. when the site provided one.
+        cache=False probes without looking up or storing anything, for temporary files.
+        """
+        thumbnail_path = os.path.join(download_path, f"{Path(video_path).stem}_thumb.jpg")
+        result = {"width": 0, "height": 0, "duration": 0, "thumbnail": None}
+
+        key = None
+        if cache:
+            try:
+                key = await executors.disk.run(content_key, url, video_path)
+            except Exception as e:
+                logger.warning(f"Could not hash {video_path} for metadata cache: {e}")
+
+        entry = self.cache.get(key) if key else None
+        if entry is not None:
+            # Cache hit: skip probing, hand out a private copy of the thumbnail
+            result.update({k: entry[k] for k in ("width", "height", "duration")})
+            has_thumbnail = entry.get("thumbnail") and os.path.exists(entry["thumbnail"])
+            if with_thumbnail and has_thumbnail:
+                await executors.disk.run(shutil.copyfile, entry["thumbnail"], thumbnail_path)
+                result["thumbnail"] = thumbnail_path
+            elif with_thumbnail:
+                # Cached without a thumbnail (the site had one last time), grab a frame now
+                try:
+                    if await generate_thumbnail(video_path, thumbnail_path):
+                        result["thumbnail"] = thumbnail_path
+                except Exception as e:
+                    logger.warning(f"Thumbnail generation failed: {e!r}")
+            logger.info(f"Metadata cache hit for {video_path}")
+            return result
+
+        # Run the probe and the thumbnail seek concurrently
+        probe_result, thumb_result = await asyncio.gather(
+            probe_video(video_path),
+            generate_thumbnail(video_path, thumbnail_path) if with_thumbnail else asyncio.sleep(0, False),
+            return_exceptions=True,
+        )
+
+        if isinstance(probe_result, BaseException):
+            logger.warning(f"ffprobe failed: {probe_result!r}")
+        elif probe_result:
+            result.update(probe_result)
+            logger.info(f"Extracted video metadata: {result['width']}x{result['height']}, {result['duration']}s")
+        else:
+            logger.warning("Could not read video metadata with ffprobe")
+
+        if isinstance(thumb_result, BaseException):
+            logger.warning(f"Thumbnail generation failed: {thumb_result!r}")
+        elif thumb_result:
+            result["thumbnail"] = thumbnail_path
+            logger.info(f"Generated thumbnail: {thumbnail_path}")
+        elif with_thumbnail:
+            logger.warning("Could not generate thumbnail")
+
+        # Only cache complete results so a transient failure is retried next time
+        if key and not isinstance(probe_result, BaseException) and probe_result:
+            try:
+                await executors.disk.run(self.cache.put, key, probe_result, result["thumbnail"])
+            except Exception as e:
+                logger.warning(f"Could not update metadata cache: {e}")
+                logger.debug(traceback.format_exc())
+
+        return result
+
+
+# Create a single instance
+metadata_service = MetadataService()
@@ -0,0 +1,230 @@
+import time
+import bisect
+import asyncio
+import inspect
+import logging
+import traceback
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Tuple
+from config import METRICS_HOST, METRICS_PORT
+from executors import executors
+
+logger = logging.getLogger("URLUploader")
+
+PREFIX = "uploader"
+# Histogram bucket upper bounds: seconds for durations, bytes per second for speeds
+DURATION_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900, 3600)
+SPEED_BUCKETS = tuple(mib * 1024 * 1024 for mib in (0.5, 1, 2, 5, 10, 20, 50, 100, 200))
+BUCKETS = {
+    "stage_seconds": DURATION_BUCKETS,
+    "queue_wait_seconds": DURATION_BUCKETS,
+    "download_speed_bytes": SPEED_BUCKETS,
+}
+HELP = {
+    "stage_seconds": "Time spent in each pipeline stage",
+    "queue_wait_seconds": "Time jobs spent in the scheduler queue",
+    "download_speed_bytes": "Average speed of finished downloads in bytes per second",
+}
+REQUEST_TIMEOUT = 5
+
+
+class Histogram:
+    """Observations counted into fixed buckets, one bisect per event"""
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # The last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def copy(self) -> "Histogram":
+        histogram = Histogram(self.buckets)
+        histogram.counts = list(self.counts)
+        histogram.sum = self.sum
+        histogram.count = self.count
+        return histogram
+
+    def quantile(self, q: float) -> float:
+        """Upper bound of the bucket the q-th observation fell in"""
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+
+def flatten(prefix: str, values: Dict[str, Any]):
+    """Yield (name, number) pairs from a possibly nested stats() dict"""
+    for key, value in values.items():
+        name = f"{prefix}_{key}" if prefix else str(key)
+        if isinstance(value, dict):
+            yield from flatten(name, value)
+        elif isinstance(value, (int, float)):
+            yield name, value
+
+
+def format_value(value: float) -> str:
+    return str(value) if isinstance(value, int) else f"{value:.4g}"
+
+
+class Metrics:
+    """Counters and histograms for the hot paths, plus the stats() of every subsystem
+
+    Recording is a dict update or a bisect with no locks, cheap enough to call
+    per event. Subsystem stats are only collected when someone asks for them.
+    Everything is copied on the event loop by snapshot(), render() and
+    summary() only format a snapshot and can run in a thread.
+    """
+    def __init__(self):
+        self.counters: Dict[str, float] = {}
+        self.histograms: Dict[Tuple[str, Tuple], Histogram] = {}
+        self.collectors: Dict[str, Callable[[], Any]] = {}
+        self.server = None
+        self.started_at = time.time()
+
+    def count(self, name: str, value: float = 1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        key = (name, tuple(labels.items()))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram(BUCKETS.get(name, DURATION_BUCKETS))
+        histogram.observe(value)
+
+    @contextmanager
+    def timer(self, stage: str):
+        """Time a pipeline stage, works around awaits too"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe("stage_seconds", time.perf_counter() - started, stage=stage)
+
+    def register(self, name: str, collect: Callable[[], Any]):
+        """Export the numbers of a subsystem's stats() as gauges, which may be a coroutine function"""
+        self.collectors[name] = collect
+
+    async def collect(self) -> Dict[str, Dict[str, Any]]:
+        results = {}
+        for name, collect in list(self.collectors.items()):
+            try:
+                values = collect()
+                if inspect.isawaitable(values):
+                    values = await values
+                results[name] = values
+            except Exception as e:
+                logger.error(f"Could not collect {name} stats: {e}")
+        return results
+
+    async def snapshot(self) -> Dict[str, Any]:
+        """Copy of every number, taken on the event loop that records them"""
+        return {
+            "uptime": time.time() - self.started_at,
+            "counters": dict(self.counters),
+            "histograms": {key: histogram.copy() for key, histogram in list(self.histograms.items())},
+            "collected": await self.collect(),
+        }
+
+    def render(self, snapshot: Dict[str, Any]) -> str:
+        """A snapshot in the Prometheus text format"""
+        lines = [
+            f"# TYPE {PREFIX}_uptime_seconds gauge",
+            f"{PREFIX}_uptime_seconds {snapshot['uptime']:.0f}",
+        ]
+        for name, value in sorted(snapshot["counters"].items()):
+            lines.append(f"# TYPE {PREFIX}_{name}_total counter")
+            lines.append(f"{PREFIX}_{name}_total {value}")
+
+        described = set()
+        for (name, labels), histogram in sorted(snapshot["histograms"].items()):
+            if name not in described:
+                described.add(name)
+                lines.append(f"# HELP {PREFIX}_{name} {HELP.get(name, name)}")
+                lines.append(f"# TYPE {PREFIX}_{name} histogram")
+            label_text = "".join(f'{key}="{value}",' for key, value in labels)
+            cumulative = 0
+            for bound, count in zip(histogram.buckets + ("+Inf",), histogram.counts):
+                cumulative += count
+                lines.append(f'{PREFIX}_{name}_bucket{{{label_text}le="{bound}"}} {cumulative}')
+            label_set = f"{{{label_text.rstrip(',')}}}" if labels else ""
+            lines.append(f"{PREFIX}_{name}_sum{label_set} {histogram.sum}")
+            lines.append(f"{PREFIX}_{name}_count{label_set} {histogram.count}")
+
+        for subsystem, values in snapshot["collected"].items():
+            for name, value in flatten(f"{PREFIX}_{subsystem}", values):
+                lines.append(f"# TYPE {name} gauge")
+                lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self, snapshot: Dict[str, Any]) -> str:
+        """Short plain-text report of a snapshot for the /stats command"""
+        uptime = int(snapshot["uptime"])
+        lines = [f"uptime {uptime // 3600}h{uptime % 3600 // 60:02d}m"]
+        for name, value in sorted(snapshot["counters"].items()):
+            lines.append(f"{name}: {format_value(value)}")
+
+        lines.append("")
+        for (name, labels), histogram in sorted(snapshot["histograms"].items()):
+            label = ",".join(str(value) for _, value in labels) or name
+            mean = histogram.sum / histogram.count if histogram.count else 0
+            if name == "download_speed_bytes":
+                lines.append(f"{label}: n={histogram.count} avg={mean / 1024 / 1024:.1f}MB/s")
+            else:
+                lines.append(
+                    f"{label}: n={histogram.count} avg={mean:.2f}s p95<={histogram.quantile(0.95):g}s"
+                )
+
+        for subsystem, values in snapshot["collected"].items():
+            lines.append("")
+            lines.append(f"[{subsystem}]")
+            lines.extend(f"{name}: {format_value(value)}" for name, value in flatten("", values))
+        return "\n".join(lines)
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), REQUEST_TIMEOUT)
+            path = request.split(b" ", 2)[1].decode("latin-1") if request.count(b" ") >= 2 else ""
+            if path.split("?")[0] in ("/", "/metrics"):
+                body = (await executors.cpu.run(self.render, await self.snapshot())).encode("utf-8")
+                status, content_type = "200 OK", "text/plain; version=0.0.4; charset=utf-8"
+            else:
+                body, status, content_type = b"Not Found\n", "404 Not Found", "text/plain"
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\n"
+                f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode("latin-1") + body
+            )
+            await writer.drain()
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except Exception as e:
+            logger.error(f"Metrics request error: {e}")
+            logger.error(traceback.format_exc())
+        finally:
+            writer.close()
+
+    async def start(self, host: str = METRICS_HOST, port: int = METRICS_PORT):
+        """Serve /metrics over HTTP, a port of 0 leaves the endpoint off"""
+        if not port or self.server is not None:
+            return
+        try:
+            self.server = await asyncio.start_server(self._handle, host, port)
+            logger.info(f"Metrics endpoint listening on {host}:{port}")
+        except OSError as e:
+            logger.error(f"Could not start metrics endpoint on {host}:{port}: {e}")
+
+    async def stop(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+
+
+# Create a single instance
+metrics = Metrics()
@@ -0,0 +1,152 @@
+import time
+import asyncio
+import logging
+import threading
+import traceback
+from typing import Callable, Dict, Optional
+from pyrogram.errors import FloodWait, MessageNotModified
+from config import PROGRESS_EDIT_BUDGET
+
+logger = logging.getLogger("URLUploader")
+
+# Minimum seconds between two edits of the same message
+MIN_EDIT_INTERVAL = 2
+# Lowest global edit rate (edits per second) we back off to after FloodWait
+MIN_EDIT_RATE = 0.5
+
+
+class ProgressSlot:
+    """Latest progress published for one status message"""
+    def __init__(self, message):
+        self.message = message
+        self.pending = None  # (render, args, reply_markup) not shown yet
+        self.last_text = None
+        self.last_edit = 0.0
+
+
+class ProgressRenderer:
+    """Single task that edits every status message within a global edit budget"""
+    def __init__(self, edit_budget: float = PROGRESS_EDIT_BUDGET, min_interval: float = MIN_EDIT_INTERVAL):
+        self.edit_budget = edit_budget
+        # Current edit rate, lowered after a FloodWait and slowly restored
+        self.rate = edit_budget
+        self.min_interval = min_interval
+        self.slots: Dict[tuple, ProgressSlot] = {}
+        self.lock = threading.Lock()
+        self.task = None
+        self.paused_until = 0.0
+        self.edits = 0
+        self.skipped = 0
+        self.flood_waits = 0
+
+    def start(self):
+        """Start the renderer task on the running event loop"""
+        if self.task is None:
+            self.task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+
+    @staticmethod
+    def _key(message) -> tuple:
+        return message.chat.id, message.id
+
+    def publish(self, message, render: Callable[..., str], *args, reply_markup=None):
+        """Store the latest numbers for a message, safe to call from any thread
+
+        render(*args) builds the message text when the renderer gets to it.
+        """
+        with self.lock:
+            slot = self.slots.get(self._key(message))
+            if slot is None:
+                slot = self.slots[self._key(message)] = ProgressSlot(message)
+            slot.pending = (render, args, reply_markup)
+
+        if self.task is None:
+            try:
+                asyncio.get_running_loop()
+            except RuntimeError:
+                # Published from a worker thread, the loop thread will start us
+                return
+            self.start()
+
+    def discard(self, message):
+        """Stop updating a message, e.g. before its final edit or deletion"""
+        with self.lock:
+            self.slots.pop(self._key(message), None)
+
+    def _take_due(self, now: float) -> Optional[tuple]:
+        """Pop the pending update of the message that waited longest"""
+        with self.lock:
+            # Spread the budget over all active messages
+            interval = max(self.min_interval, len(self.slots) / self.rate)
+            due = [
+                slot for slot in self.slots.values()
+                if slot.pending and now - slot.last_edit >= interval
+            ]
+            if not due:
+                return None
+            slot = min(due, key=lambda s: s.last_edit)
+            pending, slot.pending = slot.pending, None
+            return slot, pending
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(1 / self.rate)
+            now = time.time()
+            if now < self.paused_until:
+                continue
+
+            due = self._take_due(now)
+            if due is None:
+                continue
+            slot, (render, args, reply_markup) = due
+
+            try:
+                text = render(*args)
+            except Exception as e:
+                logger.error(f"Progress render error: {e}")
+                logger.error(traceback.format_exc())
+                continue
+
+            # Nothing visible changed, don't spend an edit on it
+            if text == slot.last_text:
+                self.skipped += 1
+                continue
+
+            try:
+                await slot.message.edit_text(text, reply_markup=reply_markup)
+                slot.last_text = text
+                slot.last_edit = time.time()
+                self.edits += 1
+                self.rate = min(self.edit_budget, self.rate * 1.05)
+            except FloodWait as e:
+                # Counted in metrics by the client
+                self.flood_waits += 1
+                self.paused_until = time.time() + e.value
+                self.rate = max(MIN_EDIT_RATE, self.rate / 2)
+                logger.warning(f"FloodWait for {e.value}s, edit rate lowered to {self.rate:.1f}/s")
+                # Show these numbers after the wait unless newer ones arrive
+                with self.lock:
+                    if slot.pending is None:
+                        slot.pending = (render, args, reply_markup)
+            except MessageNotModified:
+                slot.last_text = text
+            except Exception as e:
+                logger.error(f"Failed to update progress message: {e}")
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "messages": len(self.slots),
+            "edits": self.edits,
+            "skipped": self.skipped,
+            "flood_waits": self.flood_waits,
+            "rate": self.rate,
+        }
+
+
+# Create a single instance
+progress_renderer = ProgressRenderer()
@@ -0,0 +1,170 @@
+import os
+import json
+import time
+import struct
+import logging
+import traceback
+from typing import Any, Awaitable, Callable, Dict, Optional
+from metadata import run_command
+from executors import executors
+from metrics import metrics
+from storage import QuotaExceeded
+
+logger = logging.getLogger("URLUploader")
+
+PROBE_TIMEOUT = 30
+REMUX_TIMEOUT = 900
+# Codecs MP4 can carry as-is and Telegram clients play while streaming
+VIDEO_CODECS = ["h264", "hevc", "av1", "mpeg4"]
+AUDIO_CODECS = ["aac", "mp3", "ac3", "eac3", "opus"]
+# Files that go out as they are once the index is up front, a .mov still gets an MP4 copy
+MP4_EXTENSIONS = [".mp4", ".m4v"]
+
+
+def moov_first(path: str) -> bool:
+    """Check whether an MP4 has its index (moov) before the media data (mdat)"""
+    with open(path, "rb") as f:
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                return False
+            size, box = struct.unpack(">I4s", header)
+            if box == b"moov":
+                return True
+            if box == b"mdat":
+                return False
+            if size == 1:
+                # 64-bit size follows the box type
+                size = struct.unpack(">Q", f.read(8))[0] - 8
+            elif size == 0:
+                # Box runs to the end of the file
+                return False
+            f.seek(size - 8, os.SEEK_CUR)
+
+
+def plan_streams(output) -> Optional[Dict[str, Any]]:
+    """Pick the streams to copy into MP4, None when the video can't be copied as-is"""
+    streams = json.loads(output).get("streams", [])
+    video = [
+        s for s in streams
+        if s.get("codec_type") == "video" and not s.get("disposition", {}).get("attached_pic")
+    ]
+    audio = [s for s in streams if s.get("codec_type") == "audio"]
+    if not video or video[0].get("codec_name") not in VIDEO_CODECS:
+        return None
+
+    copied = [s for s in audio if s.get("codec_name") in AUDIO_CODECS]
+    if audio and not copied:
+        # Dropping the only audio is worse than not streaming
+        return None
+    # Subtitles and other incompatible tracks are left out
+    return {
+        "codec": video[0]["codec_name"],
+        "streams": [video[0]["index"]] + [s["index"] for s in copied],
+    }
+
+
+class Remuxer:
+    """Stream-copies downloaded videos into MP4 with the index up front
+
+    Telegram only plays MP4 while it downloads when the moov atom comes
+    first. Nothing is re-encoded: videos whose codecs MP4 can't carry are
+    sent unchanged.
+    """
+    def __init__(self):
+        self.remuxed = 0
+        # MP4s that already stream
+        self.ready = 0
+        self.skipped = 0
+        self.failures = 0
+        self.seconds = 0.0
+        self.bytes = 0
+
+    async def _probe(self, path: str) -> Optional[Dict[str, Any]]:
+        cmd = [
+            "ffprobe",
+            "-v", "error",
+            "-show_entries", "stream=index,codec_type,codec_name:stream_disposition=attached_pic",
+            "-of", "json",
+            path
+        ]
+        returncode, stdout = await run_command(cmd, PROBE_TIMEOUT)
+        if returncode != 0:
+            return None
+        return await executors.cpu.run(plan_streams, stdout)
+
+    async def remux(self, path: str, reserve: Optional[Callable[[int], Awaitable]] = None) -> str:
+        """Return the path of a streamable MP4 of the video, or the original path
+
+        reserve(size) claims the disk space of the job, which holds the video
+        and its copy until ffmpeg is done.
+        """
+        started = time.perf_counter()
+        base, ext = os.path.splitext(path)
+        temp_path = f"{base}.remux.mp4"
+        try:
+            if ext.lower() in MP4_EXTENSIONS and await executors.disk.run(moov_first, path):
+                self.ready += 1
+                return path
+
+            plan = await self._probe(path)
+            if plan is None:
+                self.skipped += 1
+                logger.info(f"Not remuxing {os.path.basename(path)}: codecs can't be copied into MP4")
+                return path
+
+            if reserve:
+                try:
+                    await reserve(2 * os.path.getsize(path))
+                except QuotaExceeded as e:
+                    self.skipped += 1
+                    logger.info(f"Not remuxing {os.path.basename(path)}: {e}")
+                    return path
+
+            cmd = ["ffmpeg", "-v", "error", "-i", path]
+            for index in plan["streams"]:
+                cmd += ["-map", f"0:{index}"]
+            cmd += ["-c", "copy"]
+            if plan["codec"] == "hevc":
+                # Apple and Telegram clients only play HEVC tagged as hvc1
+                cmd += ["-tag:v", "hvc1"]
+            cmd += ["-movflags", "+faststart", "-f", "mp4", "-y", temp_path]
+            with metrics.timer("remux"):
+                returncode, _ = await run_command(cmd, REMUX_TIMEOUT)
+            if returncode != 0 or not os.path.exists(temp_path):
+                raise RuntimeError(f"ffmpeg exited with {returncode}")
+
+            result = f"{base}.mp4"
+            os.replace(temp_path, result)
+            if result != path:
+                os.remove(path)
+        except Exception as e:
+            self.failures += 1
+            logger.error(f"Error remuxing {path}: {e}")
+            logger.error(traceback.format_exc())
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            return path
+        finally:
+            self.seconds += time.perf_counter() - started
+
+        self.remuxed += 1
+        self.bytes += os.path.getsize(result)
+        logger.info(f"Remuxed {os.path.basename(path)} to {os.path.basename(result)}")
+        return result
+
+    def stats(self) -> Dict[str, float]:
+        runs = self.remuxed + self.ready + self.skipped + self.failures
+        return {
+            "remuxed": self.remuxed,
+            "ready": self.ready,
+            "skipped": self.skipped,
+            "failures": self.failures,
+            "bytes": self.bytes,
+            "seconds": self.seconds,
+            "avg_seconds": self.seconds / runs if runs else 0.0,
+        }
+
+
+# Create a single instance
+remuxer = Remuxer()
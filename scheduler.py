@@ -0,0 +1,254 @@
+import time
+import shutil
+import asyncio
+import logging
+import traceback
+from collections import OrderedDict, deque
+from contextvars import ContextVar
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+from config import WORKERS, DOWNLOAD_DIR, MIN_FREE_SPACE
+from executors import executors
+from metrics import metrics
+from storage import disk_usage
+
+logger = logging.getLogger("URLUploader")
+
+# Seconds between free space checks while the disk is under pressure
+DISK_CHECK_INTERVAL = 5
+
+# The job the current task is running, set by the worker that picked it
+current_job: ContextVar[Optional["Job"]] = ContextVar("current_job", default=None)
+
+
+class JobDropped(Exception):
+    """The job was canceled before a worker picked it up"""
+
+
+class Job:
+    """A unit of work queued for one user"""
+    def __init__(
+        self,
+        user_id: int,
+        run: Callable[[], Awaitable],
+        on_position: Optional[Callable[[int], Awaitable]] = None,
+        on_cancel: Optional[Callable[[], None]] = None,  # Called if it is dropped before it runs
+    ):
+        self.user_id = user_id
+        self.run = run
+        self.on_position = on_position
+        self.on_cancel = on_cancel
+        self.position = 0
+        self.enqueued_at = time.time()
+        self.started_at = None
+        # What the job is going to download, once it has picked a format
+        self.expected_size = 0
+        self.format = None
+        # Folder the download lands in, what is already there doesn't need room anymore
+        self.download_path = None
+
+    @property
+    def queue_wait(self) -> float:
+        """Seconds spent waiting in the queue"""
+        return (self.started_at or time.time()) - self.enqueued_at
+
+
+class JobScheduler:
+    """Bounded worker pool that serves users round-robin"""
+    def __init__(self, workers: int = WORKERS, min_free_space: int = MIN_FREE_SPACE, watch_dir: str = DOWNLOAD_DIR):
+        self.worker_count = max(1, workers)
+        self.min_free_space = min_free_space
+        self.watch_dir = watch_dir
+        # user_id -> pending jobs, in round-robin order
+        self.queues: "OrderedDict[int, deque]" = OrderedDict()
+        self.workers = []
+        self.running = 0
+        self.active = set()
+        self.wakeup = None
+        self.disk_pressure = False
+
+    def start(self):
+        """Start the worker tasks on the running event loop"""
+        if self.workers:
+            return
+        self.wakeup = asyncio.Event()
+        self.workers = [
+            asyncio.get_running_loop().create_task(self._worker(i))
+            for i in range(self.worker_count)
+        ]
+        logger.info(f"Job scheduler started with {self.worker_count} workers")
+
+    async def stop(self):
+        """Cancel the worker tasks"""
+        for task in self.workers:
+            task.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+
+    def submit(self, job: Job) -> int:
+        """Queue a job and return its 1-based position in the queue"""
+        self.start()
+        self.queues.setdefault(job.user_id, deque()).append(job)
+        self._update_positions()
+        self.wakeup.set()
+        return job.position
+
+    async def call(self, user_id: int, run: Callable[[], Awaitable]) -> Any:
+        """Queue run() as a job and wait for its result, raises JobDropped if it is canceled while queued"""
+        future = asyncio.get_running_loop().create_future()
+
+        async def job():
+            try:
+                result = await run()
+            except asyncio.CancelledError:
+                future.cancel()
+                raise
+            except Exception as e:
+                # The caller gets the error, the worker has nothing to log
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+
+        def dropped():
+            if not future.done():
+                future.set_exception(JobDropped("Canceled"))
+
+        self.submit(Job(user_id, job, on_cancel=dropped))
+        return await future
+
+    def cancel_user(self, user_id: int) -> int:
+        """Drop all queued (not yet running) jobs of a user"""
+        jobs = self.queues.pop(user_id, None)
+        if not jobs:
+            return 0
+        for job in jobs:
+            if job.on_cancel:
+                try:
+                    job.on_cancel()
+                except Exception as e:
+                    logger.error(f"Cancel callback of a job for user {user_id} failed: {e}")
+        self._update_positions()
+        logger.info(f"Dropped {len(jobs)} queued jobs for user {user_id}")
+        return len(jobs)
+
+    def pending(self) -> int:
+        return sum(len(q) for q in self.queues.values())
+
+    def expect(self, size: int, selector: Optional[str] = None, path: Optional[str] = None):
+        """Record what the job of the calling task is about to download, and where to"""
+        job = current_job.get()
+        if job is not None:
+            job.expected_size = size
+            job.format = selector
+            job.download_path = path
+
+    def expected_bytes(self) -> int:
+        """Bytes the running jobs expect to download"""
+        return sum(job.expected_size for job in self.active)
+
+    def _dispatch_order(self):
+        """Yield queued jobs in the order the workers will pick them up"""
+        queues = [q for q in self.queues.values() if q]
+        depth = 0
+        while queues:
+            for q in queues:
+                yield q[depth]
+            depth += 1
+            queues = [q for q in queues if len(q) > depth]
+
+    def _update_positions(self):
+        """Recompute queue positions and notify jobs whose position changed"""
+        # Jobs that an idle worker picks up right away don't need a position update
+        idle = len(self.workers) - self.running
+        for position, job in enumerate(self._dispatch_order(), start=1):
+            if job.position == position:
+                continue
+            job.position = position
+            if job.on_position and position > idle:
+                asyncio.get_running_loop().create_task(self._notify(job, position))
+
+    async def _notify(self, job: Job, position: int):
+        # The job may have been dispatched before this update got to run
+        if job.started_at is not None:
+            return
+        try:
+            await job.on_position(position)
+        except Exception as e:
+            logger.error(f"Queue position update failed: {e}")
+
+    def _free_after_running(self, jobs: List[Tuple[int, Optional[str]]]) -> int:
+        """Free bytes once running jobs have downloaded the rest of what they expect"""
+        # The free space already lacks what they wrote so far, only the remainder is still to come
+        remaining = sum(max(0, size - disk_usage(path)) if path else size for size, path in jobs)
+        return shutil.disk_usage(self.watch_dir).free - remaining
+
+    async def _has_disk_space(self) -> bool:
+        jobs = [(job.expected_size, job.download_path) for job in self.active if job.expected_size]
+        free = await executors.disk.run(self._free_after_running, jobs)
+        pressure = free < self.min_free_space
+        if pressure != self.disk_pressure:
+            self.disk_pressure = pressure
+            if pressure:
+                logger.warning(f"Low disk space ({free / 1024 / 1024:.0f}MB free after running jobs), holding queued jobs")
+            else:
+                logger.info("Disk space recovered, resuming queued jobs")
+        return not pressure
+
+    async def _next_job(self) -> Job:
+        """Wait for the next job, taking users in turn"""
+        while True:
+            if not self.pending():
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+
+            # Backpressure: don't start new transfers while the disk is nearly full
+            if not await self._has_disk_space():
+                await asyncio.sleep(DISK_CHECK_INTERVAL)
+                continue
+            # Another worker may have taken the last job during the check
+            if not self.pending():
+                continue
+
+            user_id, jobs = next((u, q) for u, q in self.queues.items() if q)
+            job = jobs.popleft()
+            # Move the user to the back of the rotation
+            self.queues.move_to_end(user_id)
+            if not jobs:
+                del self.queues[user_id]
+            self._update_positions()
+            return job
+
+    async def _worker(self, index: int):
+        while True:
+            job = await self._next_job()
+            job.started_at = time.time()
+            self.running += 1
+            self.active.add(job)
+            current_job.set(job)
+            metrics.observe("queue_wait_seconds", job.queue_wait)
+            logger.info(f"Worker {index} picked job for user {job.user_id} after {job.queue_wait:.1f}s in queue")
+            try:
+                await job.run()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Job for user {job.user_id} failed: {e}")
+                logger.error(traceback.format_exc())
+            finally:
+                self.running -= 1
+                self.active.discard(job)
+                current_job.set(None)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "workers": self.worker_count,
+            "running": self.running,
+            "pending": self.pending(),
+            "users": len(self.queues),
+            "expected_bytes": self.expected_bytes(),
+            "disk_pressure": int(self.disk_pressure),
+        }
+
+
+# Create a single instance
+scheduler = JobScheduler()
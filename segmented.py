@@ -0,0 +1,251 @@
+import os
+import json
+import time
+import queue
+import asyncio
+import logging
+import threading
+import requests
+from typing import Callable, Dict, List, Optional, Set, Tuple
+from config import DOWNLOAD_CONNECTIONS
+from http_client import http_client
+from executors import executors
+
+logger = logging.getLogger("URLUploader")
+
+# Files smaller than this are not worth splitting
+MIN_SEGMENTED_SIZE = 4 * 1024 * 1024
+# Smallest range fetched by one request
+MIN_SEGMENT_SIZE = 2 * 1024 * 1024
+# Segments per connection, so fast connections pick up the slack of slow ones
+SEGMENTS_PER_CONNECTION = 4
+# Attempts per segment before the whole download is given up
+SEGMENT_RETRIES = 5
+# Bytes read from the socket per write
+READ_CHUNK_SIZE = 256 * 1024
+REQUEST_TIMEOUT = 30
+# Sidecar of a .part file listing the segments already in it
+SEGMENTS_SUFFIX = ".segments"
+
+DEFAULT_HEADERS = {
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 "
+                  "(KHTML, like Gecko) Chrome/96.0.4664.55 Safari/537.36",
+}
+
+
+class RangesNotSupported(Exception):
+    """The server can't serve this URL in byte ranges"""
+
+
+class SegmentedDownloader:
+    """Fetch a direct URL over several concurrent HTTP range requests"""
+    def __init__(
+        self,
+        url: str,
+        output_path: str,
+        connections: int = DOWNLOAD_CONNECTIONS,
+        headers: Optional[Dict[str, str]] = None,
+        progress: Optional[Callable[[int, int], None]] = None,
+        session: Optional[requests.Session] = None,
+    ):
+        self.url = url
+        self.output_path = output_path
+        self.connections = max(1, connections)
+        self.headers = headers or DEFAULT_HEADERS
+        self.progress = progress
+        self.session = session or http_client.session
+        self.total_bytes = 0
+        self.downloaded_bytes = 0
+        self.lock = threading.Lock()
+        self.abort = threading.Event()
+        self.canceled = False
+        self.error = None
+        # Not plain .part: a yt-dlp fallback to the same path would resume from a kept, sparse file
+        self.part_path = f"{output_path}.segmented.part"
+        self.segment_size = 0
+        self.done: Set[int] = set()  # Start offsets of the segments in the .part file
+
+    def probe(self) -> int:
+        """Return the file size, raises RangesNotSupported if ranges can't be used"""
+        response = self.session.head(self.url, headers=self.headers, allow_redirects=True, timeout=REQUEST_TIMEOUT)
+        if response.ok and response.headers.get("Accept-Ranges", "").lower() == "bytes":
+            size = int(response.headers.get("Content-Length") or 0)
+            if size:
+                self.url = response.url
+                return size
+
+        # Some servers don't advertise ranges on HEAD, ask for the first byte instead
+        headers = dict(self.headers, Range="bytes=0-0")
+        with self.session.get(self.url, headers=headers, stream=True, timeout=REQUEST_TIMEOUT) as response:
+            content_range = response.headers.get("Content-Range", "")
+            if response.status_code != 206 or "/" not in content_range:
+                raise RangesNotSupported(f"HTTP {response.status_code}, no byte range support")
+            size = content_range.rsplit("/", 1)[1]
+            if not size.isdigit():
+                raise RangesNotSupported("Unknown content length")
+            self.url = response.url
+            return int(size)
+
+    def _report(self, count: int):
+        with self.lock:
+            self.downloaded_bytes += count
+            downloaded = self.downloaded_bytes
+        if self.progress:
+            try:
+                self.progress(downloaded, self.total_bytes)
+            except Exception as e:
+                # The progress hook raises to cancel the download
+                self.error = e
+                self.canceled = True
+                self.abort.set()
+
+    def _fetch_segment(self, fd: int, start: int, end: int):
+        """Fetch bytes start..end (inclusive) into the file, retrying on its own"""
+        offset = start
+        for attempt in range(1, SEGMENT_RETRIES + 1):
+            if self.abort.is_set():
+                return
+            try:
+                headers = dict(self.headers, Range=f"bytes={offset}-{end}")
+                with self.session.get(self.url, headers=headers, stream=True, timeout=REQUEST_TIMEOUT) as response:
+                    if response.status_code != 206:
+                        raise IOError(f"HTTP {response.status_code} for range {offset}-{end}")
+                    for chunk in response.iter_content(chunk_size=READ_CHUNK_SIZE):
+                        if self.abort.is_set():
+                            return
+                        # Positional write, segments never overlap
+                        os.pwrite(fd, chunk, offset)
+                        offset += len(chunk)
+                        self._report(len(chunk))
+                if offset > end:
+                    self._mark_done(start)
+                    return
+                raise IOError(f"Range {start}-{end} ended early at {offset}")
+            except Exception as e:
+                if self.abort.is_set():
+                    return
+                if attempt == SEGMENT_RETRIES:
+                    raise
+                # Resume this segment where it stopped
+                logger.warning(f"Segment {start}-{end} failed (attempt {attempt}): {e}, retrying")
+                time.sleep(min(2 ** attempt, 10))
+
+    def _worker(self, fd: int, segments: "queue.Queue"):
+        while not self.abort.is_set():
+            try:
+                start, end = segments.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                self._fetch_segment(fd, start, end)
+            except Exception as e:
+                self.error = e
+                self.abort.set()
+
+    def _mark_done(self, start: int):
+        """Record a finished segment in the sidecar, so a restart keeps it"""
+        with self.lock:
+            self.done.add(start)
+            state = {"size": self.total_bytes, "segment_size": self.segment_size, "done": sorted(self.done)}
+            sidecar = self.part_path + SEGMENTS_SUFFIX
+            with open(sidecar + ".tmp", "w") as f:
+                json.dump(state, f)
+            os.replace(sidecar + ".tmp", sidecar)
+
+    def _load_done(self) -> Set[int]:
+        """Segments a previous run of the same download finished, empty if its files don't match"""
+        try:
+            with open(self.part_path + SEGMENTS_SUFFIX) as f:
+                state = json.load(f)
+            if (
+                state["size"] == self.total_bytes
+                and state["segment_size"] == self.segment_size
+                and os.path.getsize(self.part_path) == self.total_bytes
+            ):
+                return set(state["done"])
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+        return set()
+
+    def _remove_files(self):
+        for path in (self.part_path, self.part_path + SEGMENTS_SUFFIX):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def _open(self, segments: List[Tuple[int, int]]) -> int:
+        """Open the .part file, keeping the segments a previous run finished"""
+        self.done = self._load_done()
+        if self.done:
+            logger.info(f"Resuming {self.part_path} with {len(self.done)} of {len(segments)} segments done")
+        else:
+            self._remove_files()
+        fd = os.open(self.part_path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            # Preallocate so positional writes don't fragment the file
+            if hasattr(os, "posix_fallocate"):
+                os.posix_fallocate(fd, 0, self.total_bytes)
+            else:
+                os.ftruncate(fd, self.total_bytes)
+        except Exception:
+            os.close(fd)
+            self._remove_files()
+            raise
+        return fd
+
+    async def download(self) -> int:
+        """Download the whole file, returns its size
+
+        The segments are fetched on the shared network pool, at most
+        `connections` at a time.
+        """
+        # The caller may have probed already
+        if not self.total_bytes:
+            self.total_bytes = await executors.network.run(self.probe)
+        if self.total_bytes < MIN_SEGMENTED_SIZE:
+            raise RangesNotSupported("File too small to split")
+
+        self.segment_size = max(MIN_SEGMENT_SIZE, -(-self.total_bytes // (self.connections * SEGMENTS_PER_CONNECTION)))
+        ranges = [
+            (start, min(start + self.segment_size, self.total_bytes) - 1)
+            for start in range(0, self.total_bytes, self.segment_size)
+        ]
+        fd = await executors.network.run(self._open, ranges)
+        segments = queue.Queue()
+        for start, end in ranges:
+            if start in self.done:
+                self.downloaded_bytes += end - start + 1
+            else:
+                segments.put((start, end))
+        count = min(self.connections, segments.qsize())
+        logger.info(f"Downloading {self.total_bytes} bytes over {count} connections")
+        if self.downloaded_bytes:
+            self._report(0)
+        workers = asyncio.gather(*(executors.network.run(self._worker, fd, segments) for _ in range(count)))
+        try:
+            await asyncio.shield(workers)
+        except BaseException:
+            # Canceled: the threads run on until they see the abort, the file stays open for them
+            self.abort.set()
+            workers.add_done_callback(lambda _: os.close(fd))
+            raise
+        os.close(fd)
+
+        await executors.network.run(self._finish)
+        return self.total_bytes
+
+    def _finish(self):
+        if self.canceled or (self.abort.is_set() and not self.error):
+            self._remove_files()
+            raise self.error or IOError("Download canceled")
+        if self.error:
+            # Keep the .part file and its sidecar, a retry resumes from the finished segments
+            raise self.error
+        if self.downloaded_bytes < self.total_bytes:
+            self._remove_files()
+            raise IOError(f"Got {self.downloaded_bytes} of {self.total_bytes} bytes")
+        os.replace(self.part_path, self.output_path)
+        os.remove(self.part_path + SEGMENTS_SUFFIX)
+
+    def cancel(self):
+        self.canceled = True
+        self.abort.set()
@@ -0,0 +1,162 @@
+import os
+import math
+import asyncio
+import logging
+from typing import AsyncIterator, Tuple
+from config import SPLIT_SIZE
+from metadata import run_command
+from executors import executors
+from remux import MP4_EXTENSIONS
+
+logger = logging.getLogger("URLUploader")
+
+# Aim this far below the limit, keyframe cuts and bitrate swings overshoot
+SPLIT_HEADROOM = 0.95
+# Times a video part is re-cut shorter when it still came out too big
+MAX_RECUTS = 3
+SPLIT_TIMEOUT = 900
+COPY_CHUNK_SIZE = 8 * 1024 * 1024
+
+
+def needs_split(path: str, limit: int = SPLIT_SIZE) -> bool:
+    return os.path.getsize(path) > limit
+
+
+def copy_range(src: str, dst: str, offset: int, length: int):
+    """Copy length bytes of src starting at offset into a new file"""
+    with open(src, "rb") as fin, open(dst, "wb") as fout:
+        fin.seek(offset)
+        while length > 0:
+            chunk = fin.read(min(COPY_CHUNK_SIZE, length))
+            if not chunk:
+                break
+            fout.write(chunk)
+            length -= len(chunk)
+
+
+async def cut_video(src: str, dst: str, start: float, length: float) -> bool:
+    """Stream-copy a slice of a video, starting at the keyframe before `start`"""
+    cmd = [
+        "ffmpeg",
+        "-v", "error",
+        "-ss", f"{start:.3f}",  # Before -i: the cut lands on a keyframe
+        "-i", src,
+        "-t", f"{length:.3f}",
+        "-map", "0:v?",
+        "-map", "0:a?",
+        "-c", "copy",
+        "-avoid_negative_ts", "make_zero",
+    ]
+    if os.path.splitext(dst)[1].lower() in MP4_EXTENSIONS:
+        # Parts go out as they are, each must stream on its own
+        cmd += ["-movflags", "+faststart"]
+    cmd += ["-y", dst]
+    returncode, _ = await run_command(cmd, SPLIT_TIMEOUT)
+    return returncode == 0 and os.path.exists(dst)
+
+
+async def split_video(path: str, duration: float, limit: int = SPLIT_SIZE) -> AsyncIterator[str]:
+    """Yield playable parts of a video, each cut as the previous one is handed out"""
+    size = os.path.getsize(path)
+    # Part length in seconds, assuming a roughly constant bitrate
+    length = duration * limit * SPLIT_HEADROOM / size
+    base, ext = os.path.splitext(path)
+    start, index = 0.0, 1
+
+    while start < duration:
+        part_path = f"{base}.part{index:03d}{ext}"
+        try:
+            for _ in range(MAX_RECUTS):
+                if not await cut_video(path, part_path, start, length):
+                    raise RuntimeError(f"ffmpeg could not cut part {index}")
+                part_size = os.path.getsize(part_path)
+                if part_size <= limit:
+                    break
+                length *= limit * SPLIT_HEADROOM / part_size
+                logger.info(f"Part {index} came out at {part_size} bytes, re-cutting at {length:.0f}s")
+            else:
+                raise RuntimeError(f"Part {index} is still over the limit")
+        except BaseException:
+            if os.path.exists(part_path):
+                os.remove(part_path)
+            raise
+
+        yield part_path
+        start += length
+        index += 1
+
+
+async def split_bytes(path: str, limit: int = SPLIT_SIZE) -> AsyncIterator[str]:
+    """Yield raw byte slices named file.001, file.002, ... (joinable with cat or 7-Zip)"""
+    size = os.path.getsize(path)
+    for index in range(math.ceil(size / limit)):
+        part_path = f"{path}.{index + 1:03d}"
+        try:
+            await executors.disk.run(copy_range, path, part_path, index * limit, limit)
+        except BaseException:
+            if os.path.exists(part_path):
+                os.remove(part_path)
+            raise
+        yield part_path
+
+
+async def split_file(path: str, duration: float = 0, is_video: bool = False) -> AsyncIterator[Tuple[int, str]]:
+    """Yield (number, path) for each part, cutting the next part while the current one uploads
+
+    Videos with a known duration are split with ffmpeg so every part plays on
+    its own, anything else is split by bytes. A part is only cut once the
+    previous one was taken, so at most two parts are on disk: the one the
+    caller has and the next.
+    """
+    by_video = is_video and duration > 0
+    queue = asyncio.Queue(1)
+
+    async def hand_out(part):
+        try:
+            await queue.put(part)
+        except asyncio.CancelledError:
+            # The consumer stopped while this part waited for the queue
+            if os.path.exists(part):
+                os.remove(part)
+            raise
+        # Don't cut the next part before the consumer is done with the one before this
+        await queue.join()
+
+    async def produce():
+        try:
+            produced = False
+            try:
+                parts = split_video(path, duration) if by_video else split_bytes(path)
+                async for part in parts:
+                    produced = True
+                    await hand_out(part)
+            except Exception as e:
+                if produced or not by_video:
+                    raise
+                logger.warning(f"Could not split video with ffmpeg ({e}), splitting by bytes")
+                async for part in split_bytes(path):
+                    await hand_out(part)
+            await queue.put(None)
+        except Exception as e:
+            await queue.put(e)
+
+    producer = asyncio.create_task(produce())
+    number = 0
+    try:
+        while True:
+            item = await queue.get()
+            queue.task_done()
+            if item is None:
+                return
+            if isinstance(item, Exception):
+                raise item
+            number += 1
+            yield number, item
+    finally:
+        producer.cancel()
+        await asyncio.gather(producer, return_exceptions=True)
+        # Drop a part that was cut ahead but never handed out
+        while not queue.empty():
+            item = queue.get_nowait()
+            if isinstance(item, str) and os.path.exists(item):
+                os.remove(item)
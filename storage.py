@@ -0,0 +1,246 @@
+import os
+import time
+import shutil
+import asyncio
+import logging
+import traceback
+from typing import Dict, List, Optional, Set, Tuple
+from config import DOWNLOAD_DIR, MIN_FREE_SPACE, DISK_QUOTA, RESERVE_TIMEOUT, STORAGE_TTL, JANITOR_INTERVAL
+from executors import executors
+
+logger = logging.getLogger("URLUploader")
+
+# Seconds between space checks while a job waits for room
+SPACE_CHECK_INTERVAL = 5
+
+
+class QuotaExceeded(Exception):
+    """There is no room on disk for this job"""
+
+
+def disk_usage(path: str) -> int:
+    """Bytes taken by a file or everything under a folder"""
+    if not os.path.isdir(path):
+        return os.path.getsize(path) if os.path.exists(path) else 0
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+def last_modified(path: str) -> float:
+    """Newest modification time of a file or of anything under a folder"""
+    newest = os.path.getmtime(path)
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                newest = max(newest, os.path.getmtime(os.path.join(root, name)))
+            except OSError:
+                pass
+    return newest
+
+
+class Reservation:
+    """Disk space held by one job, whose files all live in its own folder"""
+    def __init__(self, manager: "StorageManager", key: str, user_id: int, path: str):
+        self.manager = manager
+        self.key = key
+        self.user_id = user_id
+        self.path = path
+        self.bytes = 0
+        self.created_at = time.time()
+
+    async def claim(self, size: int):
+        """Hold `size` bytes for this job, waits for room or raises QuotaExceeded"""
+        await self.manager.claim(self, size)
+
+    def used(self) -> int:
+        return disk_usage(self.path)
+
+
+class StorageManager:
+    """Reserves space for running jobs in DOWNLOAD_DIR and sweeps up what they leave behind
+
+    Every job downloads into a folder of its own. Before a transfer starts
+    the job claims its expected size. It waits while the quota or the disk
+    is taken by other jobs, and is refused if it could never fit. The
+    janitor deletes files and job folders that no running job owns and
+    that haven't been touched for STORAGE_TTL.
+    """
+    def __init__(
+        self,
+        root: str = DOWNLOAD_DIR,
+        quota: int = DISK_QUOTA,
+        min_free_space: int = MIN_FREE_SPACE,
+        ttl: float = STORAGE_TTL,
+    ):
+        self.root = root
+        self.quota = quota
+        self.min_free_space = min_free_space
+        self.ttl = ttl
+        self.jobs: Dict[str, Reservation] = {}
+        # Folders of queued jobs that will pick up their files again
+        self.pinned: Set[str] = set()
+        self.condition = asyncio.Condition()
+        self.janitor_task = None
+        self.refused = 0
+        self.waits = 0
+        self.swept_files = 0
+        self.swept_bytes = 0
+        os.makedirs(root, exist_ok=True)
+
+    def start(self):
+        """Start the janitor on the running event loop"""
+        if self.janitor_task is None:
+            self.janitor_task = asyncio.get_running_loop().create_task(self._janitor())
+
+    async def stop(self):
+        if self.janitor_task:
+            self.janitor_task.cancel()
+            await asyncio.gather(self.janitor_task, return_exceptions=True)
+            self.janitor_task = None
+
+    def open(self, key: str, user_id: int) -> Reservation:
+        """Register a job and create its folder, nothing is reserved yet"""
+        path = os.path.join(self.root, key)
+        os.makedirs(path, exist_ok=True)
+        reservation = Reservation(self, key, user_id, path)
+        self.jobs[key] = reservation
+        self.pinned.discard(key)
+        return reservation
+
+    def pin(self, key: str):
+        """Keep the folder of a job that is queued to resume from the janitor"""
+        self.pinned.add(key)
+
+    def _fits(self, reservation: Reservation, size: int, others: List[Tuple[int, str]]) -> Optional[bool]:
+        """True if the claim fits on disk now, False if it may fit later, None if it never will
+
+        others holds (reserved bytes, folder) of the other jobs, taken on the
+        event loop, as only the walk over their folders runs in a thread.
+        """
+        # Space other jobs hold but haven't written yet is as good as taken
+        pending = sum(max(0, reserved - disk_usage(path)) for reserved, path in others)
+        needed = max(0, size - reservation.used())
+        if shutil.disk_usage(self.root).free - pending - needed >= self.min_free_space:
+            return True
+        return False if any(reserved for reserved, _ in others) else None
+
+    def _fits_quota(self, size: int, others: List[Tuple[int, str]]) -> Optional[bool]:
+        """Same as _fits for the quota, which only needs the reserved bytes"""
+        if size > self.quota:
+            return None
+        return sum(reserved for reserved, _ in others) + size <= self.quota
+
+    async def claim(self, reservation: Reservation, size: int):
+        if size <= reservation.bytes:
+            return
+        deadline = time.monotonic() + RESERVE_TIMEOUT
+        async with self.condition:
+            waited = False
+            while True:
+                others = [(r.bytes, r.path) for r in self.jobs.values() if r is not reservation]
+                fits = self._fits_quota(size, others) if self.quota else True
+                if fits:
+                    fits = await executors.disk.run(self._fits, reservation, size, others)
+                if fits:
+                    break
+                remaining = deadline - time.monotonic()
+                if fits is None or remaining <= 0:
+                    self.refused += 1
+                    raise QuotaExceeded(f"Not enough disk space for {size / 1024 / 1024:.0f}MB")
+                if not waited:
+                    waited = True
+                    self.waits += 1
+                    logger.info(f"Job {reservation.key} waits for {size} bytes of disk space")
+                try:
+                    await asyncio.wait_for(self.condition.wait(), min(remaining, SPACE_CHECK_INTERVAL))
+                except asyncio.TimeoutError:
+                    pass
+            reservation.bytes = size
+
+    async def release(self, reservation: Reservation, keep_files: bool = False):
+        """Give the space back and delete whatever the job left in its folder"""
+        self.jobs.pop(reservation.key, None)
+        if keep_files:
+            # Resumed after a restart
+            self.pinned.add(reservation.key)
+        else:
+            await executors.disk.run(shutil.rmtree, reservation.path, True)
+        async with self.condition:
+            self.condition.notify_all()
+
+    def _sweep(self) -> int:
+        """Delete orphaned files and job folders older than the TTL, returns bytes freed"""
+        cutoff = time.time() - self.ttl
+        freed = 0
+        for entry in os.scandir(self.root):
+            # Caches keep themselves in size
+            if entry.name.startswith(".") or entry.name in self.jobs or entry.name in self.pinned:
+                continue
+            try:
+                if last_modified(entry.path) > cutoff:
+                    continue
+                size = disk_usage(entry.path)
+                if entry.is_dir(follow_symlinks=False):
+                    shutil.rmtree(entry.path)
+                else:
+                    os.remove(entry.path)
+            except OSError as e:
+                logger.warning(f"Janitor could not remove {entry.path}: {e}")
+                continue
+            freed += size
+            self.swept_files += 1
+            logger.info(f"Janitor removed {entry.name} ({size} bytes)")
+        self.swept_bytes += freed
+        return freed
+
+    async def _janitor(self):
+        while True:
+            try:
+                if await executors.disk.run(self._sweep):
+                    async with self.condition:
+                        self.condition.notify_all()
+            except Exception as e:
+                logger.error(f"Janitor error: {e}")
+                logger.error(traceback.format_exc())
+            await asyncio.sleep(JANITOR_INTERVAL)
+
+    def _walk(self, jobs: List[Tuple[str, int, int, str]]) -> Dict[str, Dict]:
+        jobs_usage, users = {}, {}
+        for key, user_id, reserved, path in jobs:
+            used = disk_usage(path)
+            jobs_usage[key] = {"user_id": user_id, "reserved": reserved, "used": used}
+            user = users.setdefault(user_id, {"jobs": 0, "reserved": 0, "used": 0})
+            user["jobs"] += 1
+            user["reserved"] += reserved
+            user["used"] += used
+        return {"jobs": jobs_usage, "users": users, "free": shutil.disk_usage(self.root).free}
+
+    async def usage(self) -> Dict[str, Dict]:
+        """Reserved and used bytes per running job and per user, and the free space"""
+        # The jobs are read on the loop, only their folders are walked in a thread
+        jobs = [(r.key, r.user_id, r.bytes, r.path) for r in self.jobs.values()]
+        return await executors.disk.run(self._walk, jobs)
+
+    async def stats(self) -> Dict[str, int]:
+        usage = await self.usage()
+        return {
+            "jobs": len(usage["jobs"]),
+            "reserved": sum(job["reserved"] for job in usage["jobs"].values()),
+            "used": sum(job["used"] for job in usage["jobs"].values()),
+            "quota": self.quota,
+            "free": usage["free"],
+            "waits": self.waits,
+            "refused": self.refused,
+            "swept_files": self.swept_files,
+            "swept_bytes": self.swept_bytes,
+        }
+
+
+# Create a single instance
+storage = StorageManager()
@@ -0,0 +1,117 @@
+import os
+import io
+import asyncio
+import hashlib
+import logging
+import shutil
+import traceback
+from typing import Dict, Optional
+from PIL import Image
+from config import DOWNLOAD_DIR
+from http_client import http_client
+from executors import executors
+from metrics import metrics
+
+logger = logging.getLogger("URLUploader")
+
+# Telegram ignores thumbnails larger than 320px on either side or over 200 KB
+THUMBNAIL_MAX_SIZE = 320
+THUMBNAIL_QUALITY = 85
+FETCH_TIMEOUT = 30
+# Oldest cached thumbnails are removed beyond this many files
+MAX_CACHED_THUMBNAILS = 500
+
+CACHE_DIR = os.path.join(DOWNLOAD_DIR, ".thumbcache")
+
+
+def fetch_thumbnail(url: str, path: str):
+    """Download a remote thumbnail and store it as a Telegram-sized JPEG"""
+    response = http_client.get(url, timeout=FETCH_TIMEOUT)
+    response.raise_for_status()
+
+    image = Image.open(io.BytesIO(response.content))
+    # Let the JPEG decoder downscale while decoding instead of after
+    image.draft("RGB", (THUMBNAIL_MAX_SIZE, THUMBNAIL_MAX_SIZE))
+    image = image.convert("RGB")
+    image.thumbnail((THUMBNAIL_MAX_SIZE, THUMBNAIL_MAX_SIZE))
+
+    temp_path = f"{path}.tmp"
+    image.save(temp_path, "JPEG", quality=THUMBNAIL_QUALITY, optimize=True)
+    os.replace(temp_path, path)
+
+
+class ThumbnailService:
+    """Fetches remote thumbnails once per URL, in the background, with a disk cache"""
+    def __init__(self, cache_dir: str = CACHE_DIR, max_entries: int = MAX_CACHED_THUMBNAILS):
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.inflight: Dict[str, asyncio.Task] = {}
+        self.hits = 0
+        self.fetches = 0
+        self.failures = 0
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def cache_path(self, url: str) -> str:
+        return os.path.join(self.cache_dir, f"{hashlib.sha1(url.encode('utf-8')).hexdigest()}.jpg")
+
+    def fetch(self, url: str) -> asyncio.Task:
+        """Start fetching a thumbnail, must be called on the event loop
+
+        Callers asking for the same URL share a single fetch.
+        """
+        task = self.inflight.get(url)
+        if task is None:
+            task = asyncio.get_running_loop().create_task(self._fetch(url))
+            self.inflight[url] = task
+            task.add_done_callback(lambda _: self.inflight.pop(url, None))
+        return task
+
+    async def _fetch(self, url: str) -> Optional[str]:
+        path = self.cache_path(url)
+        if os.path.exists(path):
+            self.hits += 1
+            return path
+
+        self.fetches += 1
+        try:
+            with metrics.timer("thumbnail_fetch"):
+                await executors.network.run(fetch_thumbnail, url, path)
+            logger.info(f"Fetched thumbnail {url}")
+            self._prune()
+            return path
+        except Exception as e:
+            self.failures += 1
+            logger.warning(f"Could not fetch thumbnail {url}: {e}")
+            logger.debug(traceback.format_exc())
+            return None
+
+    def _prune(self):
+        files = [entry for entry in os.scandir(self.cache_dir) if entry.name.endswith(".jpg")]
+        if len(files) <= self.max_entries:
+            return
+        files.sort(key=lambda entry: entry.stat().st_mtime)
+        for entry in files[:len(files) - self.max_entries]:
+            try:
+                os.remove(entry.path)
+            except OSError:
+                pass
+
+    async def get(self, task: asyncio.Task, dest_path: str) -> Optional[str]:
+        """Wait for a fetch and hand out a private copy the upload may delete"""
+        cached = await task
+        if not cached or not os.path.exists(cached):
+            return None
+        await executors.disk.run(shutil.copyfile, cached, dest_path)
+        return dest_path
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "inflight": len(self.inflight),
+            "hits": self.hits,
+            "fetches": self.fetches,
+            "failures": self.failures,
+        }
+
+
+# Create a single instance
+thumbnail_service = ThumbnailService()
@@ -0,0 +1,412 @@
+import os
+import math
+import time
+import inspect
+import asyncio
+import logging
+import threading
+from collections import deque
+from pathlib import PurePath
+from urllib.parse import urlparse
+from typing import Awaitable, Callable, Dict, List, Optional
+from pyrogram import Client, raw, types, utils
+from pyrogram.enums import ParseMode
+from pyrogram.errors import FloodWait
+from pyrogram.session import Session
+from config import STREAM_UPLOAD_BUFFER, UPLOAD_WORKERS, UPLOAD_SESSIONS, UPLOAD_PART_SIZE
+from http_client import http_client
+from executors import executors
+from metrics import metrics
+from downloader import DIRECT_EXTENSIONS
+
+logger = logging.getLogger("URLUploader")
+
+# Only "big" files can be uploaded with a part count known up front
+BIG_FILE_SIZE = 10 * 1024 * 1024
+# Largest file a bot may upload
+TELEGRAM_FILE_LIMIT = 2000 * 1024 * 1024
+# Largest part Telegram accepts, the part size must divide it
+MAX_PART_SIZE = 512 * 1024
+PART_RETRIES = 3
+# Part timings kept for stats()
+TIMING_HISTORY = 2000
+# Seconds a streamed part waits for room in the upload queue before checking for an abort
+PUMP_POLL_INTERVAL = 1
+
+VIDEO_EXTENSIONS = [".mp4", ".mkv", ".avi", ".mov", ".wmv", ".flv", ".webm", ".m4v", ".3gp"]
+
+
+class StreamUnavailable(Exception):
+    """This download can't be uploaded while streaming, use the disk instead"""
+
+
+class UploadState:
+    """One file being uploaded: its parts, progress and first error"""
+    def __init__(self, file_id: int, name: str, file_size: int, part_size: int, progress=None, progress_args=()):
+        self.file_id = file_id
+        self.name = name
+        self.file_size = file_size
+        self.total_parts = math.ceil(file_size / part_size)
+        self.progress = progress
+        self.progress_args = progress_args
+        self.uploaded = 0
+        self.error = None
+        self.abort = threading.Event()
+
+    def fail(self, error: Exception):
+        self.error = self.error or error
+        self.abort.set()
+
+
+class UploadEngine:
+    """Sends the parts of big files over several media sessions in parallel
+
+    `workers` parts are in flight at once, spread over `sessions` connections
+    to the media DC. Failed parts are retried on their own.
+    """
+    def __init__(
+        self,
+        client: Client,
+        workers: int = UPLOAD_WORKERS,
+        sessions: int = UPLOAD_SESSIONS,
+        part_size: int = UPLOAD_PART_SIZE,
+    ):
+        if part_size % 1024 or MAX_PART_SIZE % part_size:
+            raise ValueError(f"Upload part size must be a power of two KiB up to 512 KiB, got {part_size}")
+        self.client = client
+        self.workers = max(1, workers)
+        self.sessions = max(1, min(sessions, self.workers))
+        self.part_size = part_size
+        self.timings = deque(maxlen=TIMING_HISTORY)
+        self.parts = 0
+        self.retries = 0
+        self.bytes = 0
+
+    async def _start_sessions(self) -> List[Session]:
+        client = self.client
+        dc_id = await client.storage.dc_id()
+        auth_key = await client.storage.auth_key()
+        test_mode = await client.storage.test_mode()
+        sessions = [Session(client, dc_id, auth_key, test_mode, is_media=True) for _ in range(self.sessions)]
+        await asyncio.gather(*(session.start() for session in sessions))
+        return sessions
+
+    async def _send_part(self, session: Session, state: UploadState, index: int, data: bytes):
+        """Send one part, retrying it alone if it fails"""
+        attempt = 1
+        while True:
+            started = time.perf_counter()
+            try:
+                # FloodWait is raised to us instead of slept on inside the session, to be counted
+                await session.invoke(raw.functions.upload.SaveBigFilePart(
+                    file_id=state.file_id,
+                    file_part=index,
+                    file_total_parts=state.total_parts,
+                    bytes=data,
+                ), sleep_threshold=0)
+                self.timings.append(time.perf_counter() - started)
+                self.parts += 1
+                self.bytes += len(data)
+                return
+            except FloodWait as e:
+                metrics.count("flood_waits")
+                if e.value > self.client.sleep_threshold:
+                    raise
+                # Waiting isn't a failed attempt
+                logger.warning(f"FloodWait for {e.value}s on upload part {index}")
+                await asyncio.sleep(e.value)
+            except Exception as e:
+                if attempt == PART_RETRIES:
+                    raise
+                self.retries += 1
+                logger.warning(f"Upload of part {index} failed (attempt {attempt}): {e}, retrying")
+                await asyncio.sleep(attempt)
+                attempt += 1
+
+    async def _worker(self, session: Session, queue: asyncio.Queue, state: UploadState):
+        while True:
+            item = await queue.get()
+            if item is None:
+                # Let the other workers see the end too
+                queue.put_nowait(None)
+                return
+            if state.abort.is_set():
+                continue
+
+            index, data = item
+            try:
+                await self._send_part(session, state, index, data)
+                state.uploaded += len(data)
+                if state.progress:
+                    # Like Pyrogram: raising StopTransmission here cancels the upload
+                    current = min(state.uploaded, state.file_size)
+                    result = state.progress(current, state.file_size, *state.progress_args)
+                    if inspect.isawaitable(result):
+                        await result
+            except Exception as e:
+                state.fail(e)
+
+    async def upload(self, state: UploadState, feed: Callable[[asyncio.Queue], Awaitable], queue_size: int = 0):
+        """Run the workers on (index, bytes) parts put in the queue by `feed`, which ends with None"""
+        queue = asyncio.Queue(queue_size or self.workers * 2)
+        sessions = await self._start_sessions()
+        try:
+            feeder = asyncio.ensure_future(feed(queue))
+            workers = [
+                asyncio.create_task(self._worker(sessions[i % len(sessions)], queue, state))
+                for i in range(self.workers)
+            ]
+            # After an error the workers keep draining the queue so the feeder can finish
+            await asyncio.gather(*workers)
+            await feeder
+        finally:
+            await asyncio.gather(*(session.stop() for session in sessions), return_exceptions=True)
+
+        if state.error:
+            raise state.error
+        return raw.types.InputFileBig(id=state.file_id, parts=state.total_parts, name=state.name)
+
+    async def save_file(self, path: str, progress=None, progress_args=()) -> "raw.types.InputFileBig":
+        """Upload a file from disk, a drop-in for Client.save_file with big files"""
+        file_size = os.path.getsize(path)
+        state = UploadState(
+            self.client.rnd_id(), os.path.basename(path), file_size, self.part_size, progress, progress_args
+        )
+
+        async def feed(queue: asyncio.Queue):
+            fd = os.open(path, os.O_RDONLY)
+            try:
+                for index in range(state.total_parts):
+                    if state.abort.is_set():
+                        break
+                    data = await executors.disk.run(os.pread, fd, self.part_size, index * self.part_size)
+                    await queue.put((index, data))
+            finally:
+                os.close(fd)
+                await queue.put(None)
+
+        started = time.perf_counter()
+        async with self.client.save_file_semaphore:
+            file = await self.upload(state, feed)
+        elapsed = time.perf_counter() - started
+        logger.info(
+            f"Uploaded {state.name} ({file_size} bytes) in {elapsed:.1f}s "
+            f"with {self.workers} workers over {self.sessions} sessions"
+        )
+        return file
+
+    async def resend_part(self, path: str, file_id: int, index: int):
+        """Send one part of a file uploaded by save_file again, Telegram reported it missing"""
+        file_size = os.path.getsize(path)
+        state = UploadState(file_id, os.path.basename(path), file_size, self.part_size)
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            data = await executors.disk.run(os.pread, fd, self.part_size, index * self.part_size)
+        finally:
+            os.close(fd)
+        client = self.client
+        session = Session(
+            client, await client.storage.dc_id(), await client.storage.auth_key(),
+            await client.storage.test_mode(), is_media=True
+        )
+        await session.start()
+        try:
+            await self._send_part(session, state, index, data)
+        finally:
+            await session.stop()
+        logger.info(f"Sent missing part {index} of {state.name} again")
+
+    def stats(self) -> Dict[str, float]:
+        timings = sorted(self.timings)
+        return {
+            "parts": self.parts,
+            "retries": self.retries,
+            "bytes": self.bytes,
+            "part_p50": timings[len(timings) // 2] if timings else 0.0,
+            "part_p95": timings[int(len(timings) * 0.95)] if timings else 0.0,
+            "part_max": timings[-1] if timings else 0.0,
+        }
+
+
+class UploaderClient(Client):
+    """Pyrogram client whose big uploads go through the parallel UploadEngine"""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.upload_engine = UploadEngine(self)
+
+    async def invoke(self, query, retries: int = Session.MAX_RETRIES, timeout: float = Session.WAIT_TIMEOUT,
+                     sleep_threshold: float = None):
+        """Client.invoke that counts every FloodWait, Pyrogram would sleep the short ones silently"""
+        if sleep_threshold is None:
+            sleep_threshold = self.sleep_threshold
+        while True:
+            try:
+                return await super().invoke(query, retries, timeout, sleep_threshold=0)
+            except FloodWait as e:
+                metrics.count("flood_waits")
+                if e.value > sleep_threshold >= 0:
+                    raise
+                logger.warning(f"FloodWait for {e.value}s on {type(query).__name__}")
+                await asyncio.sleep(e.value)
+
+    async def save_file(self, path, file_id: int = None, file_part: int = 0, progress=None, progress_args=()):
+        # In-memory files and small files stay with Pyrogram
+        if isinstance(path, (str, PurePath)) and os.path.getsize(path) > BIG_FILE_SIZE:
+            if file_id is not None:
+                # A part of ours went missing, Pyrogram would re-read it with its own part size
+                return await self.upload_engine.resend_part(str(path), file_id, file_part)
+            return await self.upload_engine.save_file(str(path), progress, progress_args)
+        return await super().save_file(path, file_id, file_part, progress, progress_args)
+
+
+class StreamingUpload:
+    """Upload a document to Telegram while it is still being downloaded
+
+    Parts are cut from the HTTP response as it arrives and handed to the
+    upload workers through a small queue, so at most `buffer_parts` parts
+    sit in memory and the download is paced by the upload.
+    """
+    def __init__(
+        self,
+        client,
+        url: str,
+        file_name: str,
+        progress=None,
+        buffer_parts: int = STREAM_UPLOAD_BUFFER,
+    ):
+        self.client = client
+        self.engine = getattr(client, "upload_engine", None) or UploadEngine(client)
+        self.url = url
+        self.file_name = file_name
+        self.progress = progress
+        self.buffer_parts = max(1, buffer_parts)
+        self.response = None
+        self.file_size = 0
+        self.state = None
+
+    async def open(self) -> int:
+        """Start the download and return its size, raises StreamUnavailable if it can't be streamed"""
+        self.response = await executors.network.run(
+            lambda: http_client.get(self.url, stream=True, timeout=30)
+        )
+        headers = self.response.headers
+        try:
+            if not self.response.ok:
+                raise StreamUnavailable(f"HTTP {self.response.status_code}")
+            if "text/html" in headers.get("Content-Type", ""):
+                raise StreamUnavailable("URL does not point to a file")
+            if headers.get("Content-Encoding", "identity") != "identity":
+                # Content-Length would be the compressed size
+                raise StreamUnavailable("Compressed response")
+            self.file_size = int(headers.get("Content-Length") or 0)
+            if not self.file_size:
+                raise StreamUnavailable("Unknown file size")
+            if self.file_size <= BIG_FILE_SIZE:
+                raise StreamUnavailable("File too small to stream")
+            if self.file_size > TELEGRAM_FILE_LIMIT:
+                raise StreamUnavailable("File too big for Telegram")
+        except StreamUnavailable:
+            self.close()
+            raise
+        return self.file_size
+
+    def _pump(self, queue: asyncio.Queue, loop):
+        """Cut the response into upload parts, runs on a network thread"""
+        state = self.state
+        part_size = self.engine.part_size
+
+        def put(item) -> bool:
+            """Wait while the queue is full, the upload paces the download
+
+            Gives up once the upload is aborted, its workers may be gone.
+            """
+            while True:
+                try:
+                    asyncio.run_coroutine_threadsafe(
+                        asyncio.wait_for(queue.put(item), PUMP_POLL_INTERVAL), loop
+                    ).result()
+                    return True
+                except asyncio.TimeoutError:
+                    if state.abort.is_set():
+                        return False
+
+        part = 0
+        buffer = bytearray()
+        try:
+            for chunk in self.response.iter_content(chunk_size=part_size):
+                if state.abort.is_set():
+                    return
+                buffer += chunk
+                while len(buffer) >= part_size:
+                    if not put((part, bytes(buffer[:part_size]))):
+                        return
+                    del buffer[:part_size]
+                    part += 1
+            if buffer:
+                if not put((part, bytes(buffer))):
+                    return
+                part += 1
+            if part != state.total_parts and not state.abort.is_set():
+                raise IOError(f"Download ended after {part} of {state.total_parts} parts")
+        except Exception as e:
+            if not state.abort.is_set():
+                state.fail(e)
+        finally:
+            put(None)
+
+    async def save(self) -> "raw.types.InputFileBig":
+        """Upload every part and return the file to attach to a message"""
+        self.state = UploadState(
+            self.client.rnd_id(), self.file_name, self.file_size, self.engine.part_size, self.progress
+        )
+        loop = asyncio.get_running_loop()
+        return await self.engine.upload(
+            self.state,
+            lambda queue: executors.network.run(self._pump, queue, loop),
+            queue_size=self.buffer_parts,
+        )
+
+    async def send(self, chat_id, caption: str = "", reply_to_message_id: Optional[int] = None):
+        """Upload the file and send it as a document, returns the sent message"""
+        file = await self.save()
+        media = raw.types.InputMediaUploadedDocument(
+            mime_type=self.client.guess_mime_type(self.file_name) or "application/octet-stream",
+            file=file,
+            force_file=True,
+            attributes=[raw.types.DocumentAttributeFilename(file_name=self.file_name)],
+        )
+        r = await self.client.invoke(
+            raw.functions.messages.SendMedia(
+                peer=await self.client.resolve_peer(chat_id),
+                media=media,
+                reply_to_msg_id=reply_to_message_id,
+                random_id=self.client.rnd_id(),
+                **await utils.parse_text_entities(self.client, caption, ParseMode.MARKDOWN, None)
+            )
+        )
+        for update in r.updates:
+            if isinstance(update, (raw.types.UpdateNewMessage, raw.types.UpdateNewChannelMessage)):
+                return await types.Message._parse(
+                    self.client, update.message,
+                    {u.id: u for u in r.users},
+                    {c.id: c for c in r.chats},
+                )
+        return None
+
+    def close(self):
+        if self.state is not None:
+            self.state.abort.set()
+        if self.response is not None:
+            self.response.close()
+
+
+def can_stream(url: str, filename: str) -> bool:
+    """Only direct links to non-video files qualify, videos are probed on disk first"""
+    parsed = urlparse(url)
+    url_ext = os.path.splitext(parsed.path.lower())[1]
+    return (
+        parsed.scheme in ("http", "https")
+        and url_ext in DIRECT_EXTENSIONS
+        and url_ext not in VIDEO_EXTENSIONS
+        and os.path.splitext(filename)[1].lower() not in VIDEO_EXTENSIONS
+    )